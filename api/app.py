@@ -1,18 +1,41 @@
 from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from markupsafe import Markup, escape
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
 from dotenv import load_dotenv
 import uuid
+import signal
+import sys
+import random
 import time
 import threading
 from datetime import datetime
 from PIL import Image
 import io
-import cv2
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import shutil
-from database import Database
+import hashlib
+import re
+import fcntl
+import errno
+import tempfile
+import zipfile
+import websocket
+from urllib.parse import urlparse
+from database import Database, TASK_TRANSITIONS
+from media import generate_media, init_worker, media_filenames, normalize_image
+from workflows import WorkflowRegistry
+from scheduler import PRIORITY_CLASSES, PRIORITY_NAMES, Scheduler, parse_priority, parse_timestamp
+from eta import DurationModel, estimate_queue, processing_seconds
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry
+from PIL import UnidentifiedImageError
+from werkzeug.datastructures import FileStorage
 
 GEMINI_SYSTEM_PROMPT = """# 核心指令：影片提示詞生成器
 
@@ -58,7 +81,7 @@ def expand_prompt():
     user_text = (data.get('text') or '').strip()
     if not user_text:
         return jsonify({'error': '缺少要擴寫的文字'}), 400
-
+    
     try:
         payload = {
             "contents": [
@@ -95,7 +118,7 @@ def favicon():
         ico_path = os.path.join('static', 'favicon.ico')
         if os.path.exists(ico_path):
             return send_file(ico_path, mimetype='image/x-icon')
-
+        
         png_path = os.path.join('static', 'favicon.png')
         if os.path.exists(png_path):
             img = Image.open(png_path).convert('RGBA')
@@ -104,7 +127,7 @@ def favicon():
             img.save(buf, format='ICO', sizes=sizes)
             buf.seek(0)
             return send_file(buf, mimetype='image/x-icon')
-
+        
         return ('', 204)
     except Exception:
         return ('', 204)
@@ -132,32 +155,283 @@ def parse_datetime(value):
             return datetime.now()
     return value
 
+@app.template_filter('highlight_snippet')
+def highlight_snippet(value):
+    """將全文檢索片段的命中標記（\x02/\x03）轉為 <mark>，其餘內容照常跳脫"""
+    escaped = str(escape(value or ''))
+    return Markup(escaped.replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+# 優先級顯示名稱
+PRIORITY_LABELS = {'interactive': '互動預覽', 'normal': '一般', 'batch': '批次'}
+
+@app.template_filter('priority_label')
+def priority_label(value):
+    """優先級數值轉為顯示名稱"""
+    name = PRIORITY_NAMES.get(value, 'normal')
+    return PRIORITY_LABELS.get(name, name)
+
 # 設定
 COMFYUI_HOST = os.getenv('COMFYUI_HOST', 'host.docker.internal')
 COMFYUI_PORT = os.getenv('COMFYUI_PORT', '8188')
 COMFYUI_URL = f"http://{COMFYUI_HOST}:{COMFYUI_PORT}"
+# 多台 ComfyUI 後端（逗號分隔的 URL），未設定時只使用 COMFYUI_HOST/COMFYUI_PORT
+COMFYUI_BACKENDS = os.getenv('COMFYUI_BACKENDS', '')
+# ComfyUI HTTP 呼叫的連線/讀取逾時（秒）與重試次數
+COMFYUI_CONNECT_TIMEOUT = float(os.getenv('COMFYUI_CONNECT_TIMEOUT', '3'))
+COMFYUI_READ_TIMEOUT = float(os.getenv('COMFYUI_READ_TIMEOUT', '10'))
+COMFYUI_DOWNLOAD_TIMEOUT = float(os.getenv('COMFYUI_DOWNLOAD_TIMEOUT', '120'))
+COMFYUI_RETRIES = int(os.getenv('COMFYUI_RETRIES', '2'))
+# 斷路器：連續失敗次數達門檻後暫停呼叫該後端一段時間（秒）
+COMFYUI_BREAKER_THRESHOLD = int(os.getenv('COMFYUI_BREAKER_THRESHOLD', '5'))
+COMFYUI_BREAKER_COOLDOWN = float(os.getenv('COMFYUI_BREAKER_COOLDOWN', '30'))
+# 排隊狀態快照：調度器派送前可接受的快照時間與背景刷新間隔（秒）；頁面與 API 一律使用背景刷新的快照
+QUEUE_SNAPSHOT_TTL = float(os.getenv('QUEUE_SNAPSHOT_TTL', '2'))
+QUEUE_SNAPSHOT_INTERVAL = float(os.getenv('QUEUE_SNAPSHOT_INTERVAL', '5'))
+# 輸入圖片傳送方式：copy = 複製到掛載的 ComfyUI input 目錄；upload = 透過 /upload/image 上傳
+COMFYUI_INPUT_TRANSPORT = os.getenv('COMFYUI_INPUT_TRANSPORT', 'copy')
+# upload 模式下記住已上傳圖片的秒數，過期後重新上傳（ComfyUI 的 input 目錄可能被清理或後端重建）
+COMFYUI_UPLOAD_CACHE_SECONDS = float(os.getenv('COMFYUI_UPLOAD_CACHE_SECONDS', '3600'))
+# 縮圖/預覽動圖背景生成的工作進程數
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+# 上傳圖片預處理：縮放/裁切到工作流程尺寸並去除 EXIF（設為 false 則原樣儲存）與其工作進程數
+PREPROCESS_UPLOADS = os.getenv('PREPROCESS_UPLOADS', 'true').lower() == 'true'
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', '2'))
+# 結果快取：相同請求直接沿用既有影片（設為 false 全域停用）
+RESULT_CACHE = os.getenv('RESULT_CACHE', 'true').lower() == 'true'
+# 額外工作流程模板目錄：{模式}.json 搭配 {模式}.params.json，每 WORKFLOW_RELOAD_INTERVAL 秒檢查變更
+WORKFLOW_DIR = os.getenv('WORKFLOW_DIR', '/app/workflows')
+WORKFLOW_RELOAD_INTERVAL = float(os.getenv('WORKFLOW_RELOAD_INTERVAL', '2'))
+# 影片尺寸上限（寬、高各自的像素數）與幀數上限；上傳圖片會依尺寸解碼縮放，超過時直接拒絕
+MAX_VIDEO_SIDE = int(os.getenv('MAX_VIDEO_SIDE', '1280'))
+MAX_VIDEO_FRAMES = int(os.getenv('MAX_VIDEO_FRAMES', '241'))
+# 批次提交：每批最多項目數，與批次進度推送的檢查間隔（秒）
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+BATCH_PROGRESS_INTERVAL = float(os.getenv('BATCH_PROGRESS_INTERVAL', '1'))
+# 調度：排隊滿幾秒後提升一個優先級（0 停用）
+SCHEDULER_AGING_SECONDS = float(os.getenv('SCHEDULER_AGING_SECONDS', '1800'))
+# 預估等待時間：每種 (模式, 尺寸, 幀數, 後端) 取最近幾筆處理時間的中位數，啟動時從資料庫載入幾筆歷史
+ETA_WINDOW = int(os.getenv('ETA_WINDOW', '50'))
+ETA_HISTORY = int(os.getenv('ETA_HISTORY', '2000'))
+# 事件監聽器使用的 clientId，ComfyUI 依此推送執行事件；未設定時產生一次並保存在資料庫目錄
+COMFYUI_CLIENT_ID = os.getenv('COMFYUI_CLIENT_ID', '')
+# 歷史記錄對帳間隔（秒），僅作為 WebSocket 漏接事件時的慢速備援
+COMFYUI_RECONCILE_INTERVAL = int(os.getenv('COMFYUI_RECONCILE_INTERVAL', '30'))
+# 任務超時（秒）
+TASK_TIMEOUT_SECONDS = int(os.getenv('TASK_TIMEOUT_SECONDS', '1800'))
+# 處理中任務的租約（秒）：本進程每 1/3 租約時間續約，進程結束後租約過期，由重啟後的進程依 prompt_id 接手
+TASK_LEASE_SECONDS = float(os.getenv('TASK_LEASE_SECONDS', '30'))
+# 本進程的租約持有者識別，每次啟動不同
+INSTANCE_ID = uuid.uuid4().hex
+# 提交 prompt 最長可能花費的時間（含重試）；這段時間內 ComfyUI 還查不到剛提交的 prompt 不算遺失
+SUBMIT_GRACE_SECONDS = (COMFYUI_CONNECT_TIMEOUT + COMFYUI_READ_TIMEOUT) * (COMFYUI_RETRIES + 1)
+# 派送深度：每台後端同時送進ComfyUI佇列的任務數，讓下一個任務在目前任務結束時已在GPU佇列中
+DISPATCH_DEPTH = int(os.getenv('DISPATCH_DEPTH', '2'))
 DATABASE_PATH = os.getenv('DATABASE_PATH', '/app/database/history.db')
 
+def persistent_client_id(path):
+    """讀取保存的 clientId，不存在時產生並保存：ComfyUI 只把事件推送給提交時的 clientId，重啟後沿用才收得到先前任務的事件"""
+    try:
+        with open(path, 'r') as f:
+            client_id = f.read().strip()
+        if client_id:
+            return client_id
+    except FileNotFoundError:
+        pass
+    client_id = str(uuid.uuid4())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(client_id)
+    return client_id
+
+COMFYUI_CLIENT_ID = COMFYUI_CLIENT_ID or persistent_client_id(os.path.join(os.path.dirname(DATABASE_PATH), 'comfyui_client_id'))
+
 # 初始化資料庫
 db = Database(DATABASE_PATH)
 
-# 載入工作流程模板
-with open('/app/workflow.json', 'r', encoding='utf-8') as f:
-    WORKFLOW_TEMPLATE = json.load(f)
+# 指標：GET /metrics 以 Prometheus 文字格式輸出；任務數與後端狀態在抓取時才讀取
+def collect_task_counts():
+    """各狀態的任務數；沒有任務的狀態也輸出 0"""
+    counts = dict.fromkeys(TASK_TRANSITIONS, 0)
+    counts.update(db.get_status_counts())
+    return {(status,): count for status, count in counts.items()}
+
+metrics = Registry()
+metrics.gauge('video_api_tasks', '各狀態的任務數', ['status'], collect=collect_task_counts)
+metrics.gauge('video_api_comfyui_queue_depth', 'ComfyUI 佇列中的任務數（最近一次排隊狀態快照）', ['backend'],
+              collect=lambda: {(backend.name,): backend.queue_depth for backend in backend_pool.backends})
+metrics.gauge('video_api_comfyui_up', 'ComfyUI 後端是否可連線（最近一次排隊狀態快照）', ['backend'],
+              collect=lambda: {(backend.name,): int(backend.healthy) for backend in backend_pool.backends})
+SOCKETIO_CLIENTS = metrics.gauge('video_api_socketio_clients', '已連線的 Socket.IO 客戶端數')
+SOCKETIO_CLIENTS.set(0)  # 沒有客戶端連線前也要輸出，以「指標不存在」為條件的告警才不會誤判
+TASK_QUEUE_WAIT = metrics.histogram(
+    'video_api_task_queue_wait_seconds', '提交到 ComfyUI 開始執行的時間', ['priority'],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400))
+TASK_PROCESSING = metrics.histogram(
+    'video_api_task_processing_seconds', 'ComfyUI 開始執行到任務完成的時間（GPU 時間）', ['mode', 'backend'],
+    buckets=(15, 30, 60, 120, 180, 240, 300, 420, 600, 900, 1200, 1800))
+TASK_FINALIZE = metrics.histogram(
+    'video_api_task_finalize_seconds', 'ComfyUI 執行完畢到推送 task_completed 的時間（取回影片與更新資料庫）',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+INGEST_SECONDS = metrics.histogram(
+    'video_api_ingest_seconds', '取回 ComfyUI 輸出影片的時間', ['method'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+INGEST_BYTES = metrics.counter('video_api_ingest_bytes_total', '取回的輸出影片位元組數', ['method'])
+INGEST_COPY_FALLBACK = metrics.counter(
+    'video_api_ingest_copy_fallback_total', '硬連結與 reflink 都無法使用、改為完整複製的次數（reason 為硬連結失敗的 errno）', ['reason'])
+MEDIA_SECONDS = metrics.histogram(
+    'video_api_media_seconds', '工作進程生成縮圖與預覽動圖的時間',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60))
+MEDIA_LATENCY = metrics.histogram(
+    'video_api_media_latency_seconds', '排入縮圖工作到推送 thumbnail_ready 的時間（含等待工作進程）',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120))
+COMFYUI_REQUEST_SECONDS = metrics.histogram(
+    'video_api_comfyui_request_seconds', 'ComfyUI HTTP 呼叫的延遲（含失敗的呼叫；/view 只計到回應標頭）',
+    ['backend', 'method', 'endpoint'])
+COMFYUI_REQUEST_ERRORS = metrics.counter(
+    'video_api_comfyui_request_errors_total', 'ComfyUI HTTP 呼叫失敗次數（timeout、connection、http_<狀態碼>、circuit_open）',
+    ['backend', 'method', 'endpoint', 'reason'])
+
+# 內建工作流程模板與參數對應（參數名稱 → 節點ID.輸入名稱）
+BUILTIN_WORKFLOWS = {
+    'single': ('/app/workflow.json', {
+        'prompt': '6.text',
+        'image': '52.image',
+        'width': '75.value',
+        'height': '76.value',
+        'duration': '77.value',
+        'seed': '57.noise_seed',  # 加入噪聲的取樣器節點，其種子決定生成結果
+        'filename_prefix': '63.filename_prefix'
+    }),
+    'first_last': ('/app/workflow_first_last.json', {
+        'prompt': '22.text',
+        'first_image': '12.image',
+        'last_image': '28.image',
+        'width': '33.value',
+        'height': '34.value',
+        'duration': '35.value',
+        'seed': '4.noise_seed',
+        'filename_prefix': '6.filename_prefix'
+    })
+}
+
+# 載入並編譯工作流程模板；WORKFLOW_DIR 中的模板可覆蓋內建模式或新增模式，變更後不需重啟
+# 只有內建模板載入失敗會中止啟動，WORKFLOW_DIR 中壞掉的檔案記錄錯誤後略過
+workflows = WorkflowRegistry(BUILTIN_WORKFLOWS, WORKFLOW_DIR, WORKFLOW_RELOAD_INTERVAL)
+workflows.refresh(strict=True)
+
+# 隨機種子範圍
+MAX_SEED = 2 ** 48 - 1
 
-# 載入首尾幀工作流程模板
-with open('/app/workflow_first_last.json', 'r', encoding='utf-8') as f:
-    WORKFLOW_FIRST_LAST_TEMPLATE = json.load(f)
+class CircuitOpenError(Exception):
+    """斷路器開啟中，暫停呼叫後端"""
+
+class CircuitBreaker:
+    """連續失敗達門檻即開啟，冷卻後（半開）只放行一個試探請求，成功即關閉、失敗再開啟"""
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None  # 半開時試探請求的放行時間
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.cooldown
+    
+    def allow(self):
+        """關閉時放行；開啟中拒絕；半開時只放行一個試探請求，結果回報前其他呼叫仍被拒絕，恢復中的後端不會一次湧入所有積壓的請求"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.time()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # 試探請求沒有回報結果（例如非預期的例外）時，再過一個冷卻時間放行下一個
+            if self.probe_started_at is not None and now - self.probe_started_at < self.cooldown:
+                return False
+            self.probe_started_at = now
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print("Circuit breaker closed after a successful probe")
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"Circuit breaker opened after {self.failures} consecutive failures")
+                self.opened_at = time.time()
+                self.probe_started_at = None
 
 class ComfyUIClient:
     def __init__(self, base_url):
         self.base_url = base_url
+        self.name = urlparse(base_url).netloc or base_url
+        self.timeout = (COMFYUI_CONNECT_TIMEOUT, COMFYUI_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(COMFYUI_BREAKER_THRESHOLD, COMFYUI_BREAKER_COOLDOWN)
+        
+        # 持久連線池；連線錯誤一律重試，讀取/5xx 只對冪等的 GET 重試，避免重複提交工作流程
+        retry = Retry(
+            total=COMFYUI_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
     
-    def queue_prompt(self, workflow):
-        """提交工作流程到ComfyUI"""
+    def _request(self, method, path, timeout=None, **kwargs):
+        """經由連線池與斷路器送出請求；5xx 與連線錯誤計入失敗，延遲與失敗原因記入指標"""
+        # 歷史記錄路徑帶有 prompt_id，合併為一個端點標籤
+        labels = {'backend': self.name, 'method': method, 'endpoint': '/history' if path.startswith('/history/') else path}
+        if not self.breaker.allow():
+            COMFYUI_REQUEST_ERRORS.inc(reason='circuit_open', **labels)
+            raise CircuitOpenError(f"{self.base_url} 斷路器開啟中，暫停呼叫")
+        start_time = time.time()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.breaker.record_failure()
+            COMFYUI_REQUEST_ERRORS.inc(reason='timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection', **labels)
+            raise
+        finally:
+            COMFYUI_REQUEST_SECONDS.observe(time.time() - start_time, **labels)
+        if response.status_code >= 400:
+            COMFYUI_REQUEST_ERRORS.inc(reason=f"http_{response.status_code}", **labels)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
         try:
-            response = requests.post(f"{self.base_url}/prompt", json={"prompt": workflow})
             response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # stream=True 的回應在 with 區塊之外不會被關閉，錯誤時立即釋放連線
+            response.close()
+            raise
+        return response
+    
+    def queue_prompt(self, workflow, client_id=None, prompt_id=None):
+        """提交工作流程到ComfyUI；指定 prompt_id 時 ComfyUI 沿用該 ID（舊版 ComfyUI 會忽略並自行產生）"""
+        try:
+            payload = {"prompt": workflow}
+            if client_id:
+                # 帶上 client_id，ComfyUI 才會把執行事件推送到我們的 WebSocket 連線
+                payload["client_id"] = client_id
+            if prompt_id:
+                payload["prompt_id"] = prompt_id
+            response = self._request('POST', '/prompt', json=payload)
             return response.json()
         except Exception as e:
             print(f"Error queuing prompt: {e}")
@@ -166,281 +440,1186 @@ class ComfyUIClient:
     def get_queue_status(self):
         """獲取ComfyUI排隊狀態"""
         try:
-            response = requests.get(f"{self.base_url}/queue")
-            response.raise_for_status()
+            response = self._request('GET', '/queue')
             return response.json()
         except Exception as e:
             print(f"Error getting queue status: {e}")
             return None
     
+    def delete_queued(self, prompt_ids):
+        """從ComfyUI佇列移除尚未執行的prompt（不存在的prompt會被忽略）"""
+        try:
+            self._request('POST', '/queue', json={'delete': list(prompt_ids)})
+            return True
+        except Exception as e:
+            print(f"Error deleting queued prompts: {e}")
+            return False
+    
+    def interrupt(self, prompt_id=None):
+        """中斷ComfyUI正在執行的prompt；新版 ComfyUI 在指定的 prompt 不是正在執行的那個時不會中斷"""
+        try:
+            self._request('POST', '/interrupt', json={'prompt_id': prompt_id} if prompt_id else {})
+            return True
+        except Exception as e:
+            print(f"Error interrupting prompt: {e}")
+            return False
+    
     def get_history(self, prompt_id=None):
         """獲取歷史記錄"""
         try:
-            url = f"{self.base_url}/history"
+            path = "/history"
             if prompt_id:
-                url += f"/{prompt_id}"
-            response = requests.get(url)
-            response.raise_for_status()
+                path += f"/{prompt_id}"
+            response = self._request('GET', path)
             return response.json()
         except Exception as e:
             print(f"Error getting history: {e}")
             return None
     
-    def get_image(self, filename, subfolder="", folder_type="output"):
-        """獲取生成的圖片/影片"""
+    def upload_image(self, image_path, filename=None):
+        """上傳圖片到ComfyUI的input目錄"""
+        try:
+            with open(image_path, 'rb') as f:
+                files = {"image": (filename or os.path.basename(image_path), f)}
+                response = self._request('POST', '/upload/image', files=files, data={"overwrite": "true"})
+            return response.json()
+        except Exception as e:
+            print(f"Error uploading image: {e}")
+            return None
+    
+    def download_file(self, filename, dest_path, subfolder="", folder_type="output", chunk_size=1024 * 1024):
+        """以串流方式下載檔案到暫存檔再原子改名，避免整個影片載入記憶體；回傳位元組數"""
+        tmp_path = None
         try:
             params = {
                 "filename": filename,
                 "subfolder": subfolder,
                 "type": folder_type
             }
-            response = requests.get(f"{self.base_url}/view", params=params)
-            response.raise_for_status()
-            return response.content
+            timeout = (COMFYUI_CONNECT_TIMEOUT, COMFYUI_DOWNLOAD_TIMEOUT)
+            with self._request('GET', '/view', timeout=timeout, params=params, stream=True) as response:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix='.part')
+                size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+            os.chmod(tmp_path, 0o644)  # mkstemp 預設 0600
+            os.replace(tmp_path, dest_path)
+            return size
         except Exception as e:
-            print(f"Error getting image: {e}")
+            print(f"Error downloading file: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return None
 
-comfyui_client = ComfyUIClient(COMFYUI_URL)
+def parse_seed(value):
+    """解析表單的種子：留空使用模板預設（None），-1 為隨機，其餘須為非負整數"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    seed = int(value)
+    if seed == -1:
+        return random.randint(0, MAX_SEED)
+    if seed < 0:
+        raise ValueError(seed)
+    return seed
+
+def parse_video_size(width, height, duration):
+    """解析並驗證影片寬、高與幀數，超出範圍時拋出 ValueError；在讀取或預處理上傳圖片之前呼叫"""
+    width, height, duration = int(width), int(height), int(duration)
+    if not (16 <= width <= MAX_VIDEO_SIDE and 16 <= height <= MAX_VIDEO_SIDE and 1 <= duration <= MAX_VIDEO_FRAMES):
+        raise ValueError((width, height, duration))
+    return width, height, duration
+
+def request_fingerprint(template, prompt, image_filenames, width, height, duration, seed=None):
+    """請求指紋：提示詞、輸入圖片內容雜湊、尺寸、時長、模式、實際種子與模板版本都相同時結果相同"""
+    if seed is None:
+        seed = template.defaults['seed']
+    payload = json.dumps({
+        'prompt': prompt,
+        'images': image_filenames,
+        'width': width,
+        'height': height,
+        'duration': duration,
+        'mode': template.name,
+        'seed': seed,
+        'template': template.version
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def request_client_id():
+    """提交者識別：X-Client-Id 標頭或 client_id 表單欄位，沒有時使用來源 IP；供調度器公平分配"""
+    client_id = request.headers.get('X-Client-Id') or request.values.get('client_id') or request.remote_addr
+    return (client_id or '')[:64] or None
 
-def create_workflow(prompt, image_filename, width, height, duration):
-    """根據參數建立工作流程"""
-    import copy
-    workflow = copy.deepcopy(WORKFLOW_TEMPLATE)
+def link_cached_output(cached_task, task_id):
+    """將快取命中任務的影片連結給新任務（硬連結，不佔額外空間，各自刪除互不影響）；影片已不存在時回傳 None"""
+    source_path = f"/app/output/{cached_task['output_filename']}"
+    if not os.path.exists(source_path):
+        return None
+    video_filename = cached_task['output_filename']
+    prefix = f"{cached_task['task_id']}_"
+    if video_filename.startswith(prefix):
+        video_filename = video_filename[len(prefix):]
+    output_filename = f"{task_id}_{video_filename}"
+    link_or_copy(source_path, f"/app/output/{output_filename}")
+    return output_filename
+
+def remove_linked_outputs(output_filenames):
+    """任務沒有建立時刪除已連結給它的快取影片（None 略過）"""
+    for output_filename in output_filenames:
+        if not output_filename:
+            continue
+        try:
+            os.remove(f"/app/output/{output_filename}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting linked output {output_filename}: {e}")
+
+def match_existing(fingerprint, task_id):
+    """查詢相同請求（呼叫端需持有 input_store.lock），回傳 (快取任務, 輸出檔名, 領頭任務ID)
     
-    # 更新參數
-    workflow["6"]["inputs"]["text"] = prompt  # 提示詞
-    workflow["52"]["inputs"]["image"] = image_filename  # 圖片檔名
-    workflow["75"]["inputs"]["value"] = width  # 寬度
-    workflow["76"]["inputs"]["value"] = height  # 高度
-    workflow["77"]["inputs"]["value"] = duration  # 時長
+    已有成功結果時將影片連結給新任務；最近的結果影片已被刪除時改用較早的結果（彼此是各自的連結）。
+    否則若相同請求正在排隊或處理中，新任務跟隨它
+    """
+    for cached_task in db.find_cached_results(fingerprint):
+        output_filename = link_cached_output(cached_task, task_id)
+        if output_filename:
+            return cached_task, output_filename, None
+    leader_task = db.find_inflight_task(fingerprint)
+    return None, None, leader_task['task_id'] if leader_task else None
+
+def find_video_output(outputs):
+    """從ComfyUI輸出節點中找出影片檔名"""
+    for node_id, output in (outputs or {}).items():
+        if 'gifs' in output and output['gifs']:
+            return output['gifs'][0]['filename']
+        elif 'videos' in output and output['videos']:
+            return output['videos'][0]['filename']
+    return None
+
+# ComfyUI 影片輸出檔名前綴；VHS 會存成 {prefix}_{序號:05}.mp4
+OUTPUT_PREFIX = 'wan22__'
+
+def output_prefix(task_id):
+    """任務專屬的輸出檔名前綴，輸出檔可由檔名直接對應回任務"""
+    return f"{OUTPUT_PREFIX}{task_id}"
+
+def task_id_from_output(filename):
+    """從輸出檔名解析 task_id；舊格式（wan22__00001.mp4）或其他檔案回傳 None"""
+    if not filename.startswith(OUTPUT_PREFIX) or not filename.endswith('.mp4'):
+        return None
+    task_id, _, counter = filename[len(OUTPUT_PREFIX):-len('.mp4')].rpartition('_')
+    if not task_id or not counter.isdigit():
+        return None
+    return task_id
+
+class OutputIndex:
+    """ComfyUI 輸出目錄索引：task_id → 影片檔名
+    
+    目錄的 mtime 沒變就不重新掃描；有變化時以 scandir 只讀檔名重建對應表，
+    不對每個檔案 stat，也不需要依修改時間猜測哪個檔案屬於哪個任務。
+    掛載卷上 inotify 不一定可靠（例如 Docker Desktop），因此以目錄 mtime 判斷變化。
+    """
     
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        self._dir_mtime = None
+        self._lock = threading.Lock()
+    
+    def refresh(self):
+        """目錄有變化時重建索引"""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return
+        
+        with self._lock:
+            if mtime == self._dir_mtime:
+                return
+            files = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    task_id = task_id_from_output(entry.name)
+                    # 同一任務重跑時序號遞增，保留最新的一個
+                    if task_id and entry.name > files.get(task_id, ''):
+                        files[task_id] = entry.name
+            self.files = files
+            self._dir_mtime = mtime
     
-    # 確保有輸出節點 - 將節點63標記為輸出
-    if "63" in workflow:
-        workflow["63"]["_meta"]["save_output"] = True
+    def lookup(self, task_id):
+        """查詢任務的輸出影片檔名，找不到時回傳 None"""
+        self.refresh()
+        filename = self.files.get(task_id)
+        if filename and os.path.exists(os.path.join(self.directory, filename)):
+            return filename
+        
+        # 同一個 mtime 刻度內的變更可能沒被偵測到，直接檢查第一個序號的檔名
+        filename = f"{output_prefix(task_id)}_00001.mp4"
+        if os.path.exists(os.path.join(self.directory, filename)):
+            return filename
+        return None
+
+# Linux FICLONE ioctl（btrfs/XFS 等支援 reflink 的檔案系統）
+FICLONE = 0x40049409
+# 已警告過的完整複製原因，每種原因只提示一次
+copy_fallback_warned = set()
+
+def link_or_copy(src_path, dest_path):
+    """同一掛載點時以硬連結或 reflink 取代完整複製；回傳實際使用的方式
+    
+    硬連結與 reflink 都不能跨掛載點（EXDEV），即使兩個 bind mount 位於同一個檔案系統
+    """
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    
+    try:
+        os.link(src_path, dest_path)
+        return 'hardlink'
+    except OSError as e:
+        link_error = e
+    
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        shutil.copystat(src_path, dest_path)
+        return 'reflink'
+    except OSError:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+    
+    reason = errno.errorcode.get(link_error.errno, 'OSError')
+    INGEST_COPY_FALLBACK.inc(reason=reason)
+    if reason not in copy_fallback_warned:
+        copy_fallback_warned.add(reason)
+        hint = '; put COMFYUI_OUTPUT_DIR and /app/output on the same mount (see docker-compose.yaml)' if link_error.errno == errno.EXDEV else ''
+        print(f"[INGEST] Hardlink/reflink unavailable ({reason}: {src_path} -> {dest_path}), falling back to full copy{hint}")
+    shutil.copy2(src_path, dest_path)
+    return 'copy'
+
+def ingest_video(task_id, video_filename, backend):
+    """將ComfyUI輸出的影片取回到我們的輸出目錄，回傳 {path, method, bytes, seconds}；失敗時回傳 None"""
+    output_path = f"/app/output/{task_id}_{video_filename}"
+    start_time = time.time()
     
-    return workflow
+    # 首先嘗試掛載的目錄
+    comfyui_video_path = os.path.join(backend.output_dir, video_filename) if backend.output_dir else None
+    if comfyui_video_path and os.path.exists(comfyui_video_path):
+        method = link_or_copy(comfyui_video_path, output_path)
+        size = os.path.getsize(output_path)
+    else:
+        # 如果檔案不存在，嘗試使用API串流下載
+        method = 'download'
+        size = backend.client.download_file(video_filename, output_path)
+        if size is None:
+            print(f"Failed to get video file: {video_filename}")
+            return None
+    
+    elapsed = time.time() - start_time
+    INGEST_SECONDS.observe(elapsed, method=method)
+    INGEST_BYTES.inc(size, method=method)
+    print(f"[INGEST] Task {task_id}: {video_filename} via {method}, {size} bytes in {elapsed:.3f}s")
+    return {'path': output_path, 'method': method, 'bytes': size, 'seconds': elapsed}
+
+def fail_task(task_id, error_msg):
+    """將任務標記為失敗並通知前端；任務已結束或已刪除時不做任何事"""
+    if not db.update_task_status(task_id, 'failed', error_message=error_msg):
+        return
+    socketio.emit('task_failed', {
+        'task_id': task_id,
+        'error': error_msg
+    })
+    
+    # 跟隨任務改由其中一個自行派送
+    finish_followers(task_id)
+    
+    # 空出派送名額，喚醒調度器
+    dispatcher.wake()
+
+def stop_comfyui_prompt(task):
+    """停止任務在 ComfyUI 上的工作並停止監聽：排隊中的從佇列移除，執行中的中斷
+    
+    回傳 'interrupted'、'dequeued'；ComfyUI 呼叫失敗、無法確認已停止時回傳 'unknown'，任務沒有送進 ComfyUI 時回傳 None
+    """
+    prompt_id = task.get('comfyui_prompt_id')
+    if not prompt_id:
+        return None
+    backend = backend_pool.get(task.get('comfyui_backend'))
+    # 取走監聽登記，中斷後的 execution_interrupted 事件不會再把任務標記為失敗
+    backend.listener.claim(prompt_id)
+    
+    # 先從佇列移除再檢查是否正在執行：刪除與檢查之間開始執行的 prompt 也會被中斷
+    deleted = backend.client.delete_queued([prompt_id])
+    queue_status = backend.client.get_queue_status()
+    if queue_status is None:
+        action, error = 'unknown', 'queue status unavailable'
+    elif prompt_id in {item[1] for item in queue_status.get('queue_running', [])}:
+        action, error = ('interrupted', None) if backend.client.interrupt(prompt_id) else ('unknown', 'interrupt failed')
+    elif not deleted or prompt_id in {item[1] for item in queue_status.get('queue_pending', [])}:
+        action, error = 'unknown', 'delete from queue failed'
+    else:
+        action, error = 'dequeued', None
+    queue_snapshot.wake()
+    # 呼叫端已先轉換任務狀態，對帳不會再以這個 prompt 重新登記
+    backend.listener.release(prompt_id)
+    if error:
+        print(f"[CANCEL] Task {task['task_id']}: could not confirm prompt {prompt_id} stopped on {backend.name}: {error}")
+    else:
+        print(f"[CANCEL] Task {task['task_id']}: prompt {prompt_id} {action} on {backend.name}")
+    return action
 
-def create_first_last_workflow(prompt, first_image_filename, last_image_filename, width, height, duration):
-    """根據參數建立首尾幀工作流程"""
-    import copy
-    workflow = copy.deepcopy(WORKFLOW_FIRST_LAST_TEMPLATE)
+def cancel_task(task, requeue=False):
+    """取消排隊中或處理中的任務；requeue 時（搶佔）中斷處理中的任務後放回排隊，保留原本的優先級與跟隨任務
     
-    # 更新參數
-    workflow["22"]["inputs"]["text"] = prompt  # 提示詞
-    workflow["12"]["inputs"]["image"] = first_image_filename  # 首幀圖片
-    workflow["28"]["inputs"]["image"] = last_image_filename  # 尾幀圖片
-    workflow["33"]["inputs"]["value"] = width  # 寬度
-    workflow["34"]["inputs"]["value"] = height  # 高度
-    workflow["35"]["inputs"]["value"] = duration  # 時長
+    立即空出派送名額並喚醒調度器；回傳 ComfyUI 上的處理結果（見 stop_comfyui_prompt），任務已結束時回傳 False
+    """
+    task_id = task['task_id']
+    if requeue:
+        if not db.requeue_task(task_id, task.get('comfyui_prompt_id')):
+            return False
+        action = stop_comfyui_prompt(task)
+        socketio.emit('task_requeued', {'task_id': task_id, 'status': 'pending'})
+    else:
+        if not db.update_task_status(task_id, 'cancelled'):
+            return False
+        # 以轉換後的記錄停止 ComfyUI 上的工作：轉換前一刻才被派送的任務也會有 prompt_id
+        action = stop_comfyui_prompt(db.get_task(task_id) or task)
+        socketio.emit('task_cancelled', {'task_id': task_id, 'status': 'cancelled'})
+        # 跟隨任務改由其中一個自行派送
+        if not task.get('leader_task_id'):
+            finish_followers(task_id)
     
-    # 確保有輸出節點 - 將節點6標記為輸出
-    if "6" in workflow:
-        workflow["6"]["_meta"]["save_output"] = True
+    dispatcher.wake()
+    return action
+
+def finish_followers(leader_task_id, output_path=None):
+    """領頭任務結束後處理跟隨任務：成功時各自連結同一支影片並完成，否則改由最早的跟隨任務自行派送
     
-    return workflow
+    在 input_store.lock 內進行，與新增任務時的跟隨判斷互斥，不會漏掉剛加入的跟隨任務
+    """
+    with input_store.lock:
+        if not output_path:
+            new_leader = db.release_followers(leader_task_id)
+            if new_leader:
+                print(f"[DEDUP] Task {leader_task_id} did not complete; {new_leader} now runs on its own")
+                dispatcher.wake()
+            return
+        
+        leader = {'task_id': leader_task_id, 'output_filename': os.path.basename(output_path)}
+        followers = db.get_followers(leader_task_id)
+        for follower in followers:
+            output_filename = link_cached_output(leader, follower['task_id'])
+            db.update_task_status(follower['task_id'], 'completed', output_filename=output_filename)
+            socketio.emit('task_completed', {
+                'task_id': follower['task_id'],
+                'status': 'completed',
+                'output_filename': output_filename
+            })
+            schedule_media(follower['task_id'], f"/app/output/{output_filename}")
+        if followers:
+            print(f"[DEDUP] Task {leader_task_id}: output shared with {len(followers)} follower(s)")
 
-def generate_thumbnail(video_path, thumbnail_path):
-    """生成影片縮圖"""
+def complete_task(task_id, prompt_id, outputs=None):
+    """處理已執行完畢的ComfyUI任務：取回影片、生成縮圖並更新狀態"""
+    start_time = time.time()
     try:
-        cap = cv2.VideoCapture(video_path)
-        ret, frame = cap.read()
-        if ret:
-            # 調整縮圖大小
-            height, width = frame.shape[:2]
-            aspect_ratio = width / height
-            if aspect_ratio > 1:
-                new_width = 320
-                new_height = int(320 / aspect_ratio)
-            else:
-                new_height = 320
-                new_width = int(320 * aspect_ratio)
-            
-            resized_frame = cv2.resize(frame, (new_width, new_height))
-            cv2.imwrite(thumbnail_path, resized_frame)
-            cap.release()
-            return True
+        task = db.get_task(task_id)
+        if not task:
+            return  # 任務已被刪除
+        backend = backend_pool.get(task.get('comfyui_backend'))
+        video_filename = find_video_output(outputs)
+        
+        if not video_filename:
+            # WebSocket 事件可能缺少快取節點的輸出，改以歷史記錄補齊
+            history = backend.client.get_history(prompt_id)
+            if history and prompt_id in history:
+                task_info = history[prompt_id]
+                video_filename = find_video_output(task_info.get('outputs'))
+                
+                status_info = task_info.get('status', {})
+                if not video_filename and status_info.get('status_str') == 'error':
+                    fail_task(task_id, str(status_info.get('messages')))
+                    return
+        
+        output_path = None
+        if video_filename:
+            ingest = ingest_video(task_id, video_filename, backend)
+            output_path = ingest['path'] if ingest else None
+        else:
+            print(f"[DEBUG] Task {task_id}: No video filename found in outputs")
+            # 備用檢測：由輸出目錄索引以 task_id 查詢該任務的影片
+            video_filename = backend.output_index.lookup(task_id) if backend.output_index else None
+            if video_filename:
+                source_path = os.path.join(backend.output_dir, video_filename)
+                output_path = f"/app/output/{task_id}_{video_filename}"
+                method = link_or_copy(source_path, output_path)
+                print(f"[BACKUP] Video file ingested from {source_path} to {output_path} via {method}")
+        
+        if not output_path:
+            fail_task(task_id, '無法取得輸出影片')
+            return
+        
+        # 更新資料庫；任務已被其他路徑結束或已刪除時不再通知
+        if not db.update_task_status(task_id, 'completed', output_filename=f"{task_id}_{video_filename}"):
+            print(f"Task {task_id} is no longer processing; completion ignored")
+            return
+        
+        # 以這次的處理時間更新預估模型
+        seconds = processing_seconds(dict(task, completed_at=datetime.now().isoformat()))
+        eta_model.record(task, seconds, backend.name)
+        if seconds:
+            TASK_PROCESSING.observe(seconds, mode=task.get('generation_mode') or 'single', backend=backend.name)
+        
+        # 發送WebSocket通知
+        socketio.emit('task_completed', {
+            'task_id': task_id,
+            'status': 'completed',
+            'output_filename': f"{task_id}_{video_filename}"
+        })
+        TASK_FINALIZE.observe(time.time() - start_time)
+        
+        # 空出派送名額，喚醒調度器
+        dispatcher.wake()
+        
+        # 相同請求的跟隨任務共用這支影片
+        finish_followers(task_id, output_path)
+        
+        # 縮圖與預覽動圖不在關鍵路徑上，交給背景 process pool
+        schedule_media(task_id, output_path)
+    
+    except Exception as e:
+        print(f"Error completing task {task_id}: {e}")
+        fail_task(task_id, f'處理輸出失敗: {str(e)}')
+
+class WorkerPool:
+    """CPU 密集工作的 process pool；工作進程崩潰後自動重建"""
+    
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def _get(self, restart=False):
+        with self._lock:
+            if self._executor is None or restart:
+                # 使用 fork：spawn/forkserver 的工作進程會重新執行 app.py（資料庫、事件監聽等）。
+                # fork 時資料庫寫入等線程已在執行，工作進程只執行 media 模組的函數，
+                # 並由 init_worker 換掉可能被其他線程鎖住的 stdout/stderr
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                                     mp_context=multiprocessing.get_context('fork'))
+            return self._executor
+    
+    def start(self):
+        """啟動時先建立工作進程，第一個上傳或縮圖不必等待進程啟動"""
+        executor = self._get()
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+    
+    def submit(self, fn, *args):
+        try:
+            return self._get().submit(fn, *args)
+        except BrokenProcessPool:
+            return self._get(restart=True).submit(fn, *args)
+
+# 縮圖/預覽動圖與上傳圖片預處理各用一組工作進程，上傳不必排在縮圖後面
+media_pool = WorkerPool(THUMBNAIL_WORKERS)
+preprocess_pool = WorkerPool(PREPROCESS_WORKERS)
+
+def schedule_media(task_id, video_path):
+    """將縮圖與預覽動圖交給背景 process pool，完成後更新資料庫並推送 thumbnail_ready"""
+    scheduled_at = time.time()
+    future = media_pool.submit(generate_media, video_path, '/app/thumbnails', task_id)
+    future.add_done_callback(lambda f: on_media_ready(task_id, f, scheduled_at))
+
+def remove_media_files(task_id, extra=None):
+    """刪除任務的縮圖與預覽動圖，回傳實際刪除的檔名"""
+    filenames = media_filenames(task_id)
+    if extra and extra not in filenames:
+        filenames.append(extra)
+    
+    deleted = []
+    for filename in filenames:
+        path = f"/app/thumbnails/{filename}"
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+                deleted.append(filename)
+            except Exception as e:
+                print(f"Error deleting thumbnail file {path}: {e}")
+    return deleted
+
+def on_media_ready(task_id, future, scheduled_at=None):
+    """背景縮圖完成：寫回資料庫並推送 thumbnail_ready；scheduled_at 為排入工作的時間"""
+    try:
+        result = future.result()
     except Exception as e:
-        print(f"Error generating thumbnail: {e}")
-    return False
+        print(f"Error generating media for {task_id}: {e}")
+        return
+    if not result:
+        return
+    
+    if not db.get_task(task_id):
+        remove_media_files(task_id)  # 生成期間任務已被刪除
+        return
+    
+    db.update_task_media(task_id, result['thumbnail_filename'], result['preview_filename'])
+    print(f"[MEDIA] Task {task_id}: {len(result['thumbnails'])} thumbnails"
+          f"{' + preview' if result['preview_filename'] else ''} in {result['seconds']:.2f}s")
+    socketio.emit('thumbnail_ready', {
+        'task_id': task_id,
+        'thumbnail_filename': result['thumbnail_filename'],
+        'preview_filename': result['preview_filename'],
+        'thumbnails': result['thumbnails']
+    })
+    MEDIA_SECONDS.observe(result['seconds'])
+    if scheduled_at:
+        MEDIA_LATENCY.observe(time.time() - scheduled_at)
 
-def monitor_task(task_id, prompt_id):
-    """監控任務進度"""
-    max_attempts = 1800  # 最多等待30分鐘
-    attempt = 0
+def finish_prompt(prompt_id, target, *args):
+    """在背景線程收尾已被取走監聽登記的 prompt，結束後解除收尾標記"""
+    def run():
+        try:
+            target(*args)
+        finally:
+            backend_pool.release(prompt_id)
+    threading.Thread(target=run, daemon=True).start()
+
+def on_prompt_finished(task_id, prompt_id, outputs):
+    """事件監聽器回呼：任務執行完畢"""
+    finish_prompt(prompt_id, complete_task, task_id, prompt_id, outputs)
+
+def on_prompt_failed(task_id, prompt_id, error_msg):
+    """事件監聽器回呼：任務執行失敗"""
+    finish_prompt(prompt_id, fail_task, task_id, error_msg)
+
+def on_prompt_started(task_id, prompt_id):
+    """事件監聽器回呼：任務已從ComfyUI佇列進入執行，重設開始時間並記錄提交到開始執行的時間"""
+    if not db.update_task_status(task_id, 'processing'):
+        return
+    task = db.get_task(task_id)
+    if task:
+        TASK_QUEUE_WAIT.observe(max(0.0, time.time() - parse_timestamp(task['created_at'])),
+                                priority=PRIORITY_NAMES.get(task.get('priority'), 'normal'))
+
+def on_prompt_progress(task_id, prompt_id, progress):
+    """事件監聽器回呼：節點執行進度，只推送到該任務的房間"""
+    socketio.emit('task_progress', dict(progress, task_id=task_id), to=task_id)
+
+def on_comfyui_status(status):
+    """事件監聽器回呼：ComfyUI排隊狀態改變，喚醒背景線程刷新共用快照（內容改變時才會推送）
+    
+    不在 WebSocket 線程上抓取：查詢所有後端期間，完成與進度事件不必排在後面等待
+    """
+    queue_snapshot.wake()
+
+def on_queue_snapshot_changed(queue_status):
+    """排隊狀態快照改變時推送給前端"""
+    if queue_status:
+        # 發送排隊狀態更新
+        socketio.emit('queue_update', queue_status)
+
+class ComfyUIEventListener:
+    """以單一長連線監聽 ComfyUI /ws 事件，將完成與失敗分派到對應任務"""
+    
+    def __init__(self, ws_url, client_id, on_finished, on_failed, on_started=None, on_progress=None, on_status=None, on_reconnect=None):
+        self.ws_url = ws_url
+        self.client_id = client_id
+        self.on_finished = on_finished
+        self.on_failed = on_failed
+        self.on_started = on_started
+        self.on_progress = on_progress
+        self.on_status = on_status
+        self.on_reconnect = on_reconnect
+        self.reconnect_delay = 5
+        self.connected = False
+        self._lock = threading.Lock()
+        self._watched = {}  # prompt_id -> {'task_id': ..., 'outputs': {...}, 'node': ..., 'started': ...}
+        self._finishing = set()  # 已被取走、收尾（取回影片、標記失敗等）尚未結束的 prompt_id
+        self._thread = None
+    
+    def watch(self, prompt_id, task_id):
+        """登記要監聽的 prompt_id；收尾中的 prompt 不會重新登記，回傳 False"""
+        with self._lock:
+            if prompt_id in self._finishing:
+                return False
+            self._watched.setdefault(prompt_id, {'task_id': task_id, 'outputs': {}, 'node': None, 'started': time.time()})
+            return True
+    
+    def claim(self, prompt_id):
+        """取走監聽登記並標記為收尾中；回傳 None 表示已由其他路徑處理，避免重複完成
+        
+        收尾結束後由呼叫端呼叫 release()，在那之前對帳無法以 watch() 讓這個 prompt 被再次取走
+        """
+        with self._lock:
+            entry = self._watched.pop(prompt_id, None)
+            if entry:
+                self._finishing.add(prompt_id)
+            return entry
     
-    while attempt < max_attempts:
+    def release(self, prompt_id):
+        """收尾結束（任務已不再以這個 prompt 處理中）後解除收尾標記"""
+        with self._lock:
+            self._finishing.discard(prompt_id)
+    
+    def start(self):
+        """啟動背景監聽線程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            try:
+                ws = websocket.WebSocketApp(
+                    f"{self.ws_url}?clientId={self.client_id}",
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close
+                )
+                ws.run_forever(ping_interval=30, ping_timeout=10)
+            except Exception as e:
+                print(f"ComfyUI WebSocket error: {e}")
+            self.connected = False
+            time.sleep(self.reconnect_delay)
+    
+    def _on_open(self, ws):
+        print(f"Connected to ComfyUI WebSocket {self.ws_url}")
+        self.connected = True
+        # 斷線期間可能漏接事件，重連後立即對帳一次
+        if self.on_reconnect:
+            threading.Thread(target=self.on_reconnect, daemon=True).start()
+    
+    def _on_error(self, ws, error):
+        print(f"ComfyUI WebSocket error: {error}")
+    
+    def _on_close(self, ws, close_status_code, close_msg):
+        self.connected = False
+    
+    def _on_message(self, ws, message):
+        if not isinstance(message, str):
+            return  # 預覽圖等二進位訊息
         try:
-            # 檢查ComfyUI歷史記錄
-            history = comfyui_client.get_history(prompt_id)
-            print(f"[DEBUG] Task {task_id}: Checking history for prompt_id {prompt_id}")
+            msg = json.loads(message)
+        except ValueError:
+            return
+        self.handle_event(msg.get('type'), msg.get('data') or {})
+    
+    def handle_event(self, event_type, data):
+        """處理單一 ComfyUI 事件"""
+        if event_type == 'status':
+            if self.on_status:
+                self.on_status(data.get('status'))
+            return
+        
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        
+        if event_type == 'execution_start':
+            with self._lock:
+                entry = self._watched.get(prompt_id)
+                if entry:
+                    # 從 ComfyUI 真正開始執行時起算經過時間，不含排隊時間
+                    entry['started'] = time.time()
+            if entry and self.on_started:
+                self.on_started(entry['task_id'], prompt_id)
+        
+        elif event_type == 'executing' and data.get('node') is not None:
+            with self._lock:
+                entry = self._watched.get(prompt_id)
+                if entry:
+                    entry['node'] = data['node']
+            if entry:
+                self._emit_progress(entry, prompt_id, data['node'], None, None)
+        
+        elif event_type == 'progress':
+            with self._lock:
+                entry = self._watched.get(prompt_id)
+            if entry:
+                node = data.get('node') or entry['node']
+                self._emit_progress(entry, prompt_id, node, data.get('value'), data.get('max'))
+        
+        elif event_type == 'executed':
+            with self._lock:
+                entry = self._watched.get(prompt_id)
+                if entry and data.get('node') is not None:
+                    entry['outputs'][data['node']] = data.get('output') or {}
+        
+        elif event_type == 'execution_success' or (event_type == 'executing' and data.get('node') is None):
+            entry = self.claim(prompt_id)
+            if entry:
+                self.on_finished(entry['task_id'], prompt_id, entry['outputs'])
+        
+        elif event_type == 'execution_error':
+            entry = self.claim(prompt_id)
+            if entry:
+                error_msg = data.get('exception_message') or str(data)
+                self.on_failed(entry['task_id'], prompt_id, error_msg)
+        
+        elif event_type == 'execution_interrupted':
+            entry = self.claim(prompt_id)
+            if entry:
+                self.on_failed(entry['task_id'], prompt_id, '任務已被中斷')
+    
+    def _emit_progress(self, entry, prompt_id, node, value, max_value):
+        if not self.on_progress:
+            return
+        self.on_progress(entry['task_id'], prompt_id, {
+            'node': node,
+            'value': value,
+            'max': max_value,
+            'elapsed': round(time.time() - entry['started'], 1)
+        })
+
+def queued_prompt_ids(queue_status):
+    """ComfyUI 佇列（執行中 + 排隊中）的 prompt_id；無法取得佇列時回傳 None"""
+    if queue_status is None:
+        return None
+    return {item[1] for key in ('queue_running', 'queue_pending') for item in queue_status.get(key, [])}
+
+def reconcile_processing_tasks(force=False):
+    """以 ComfyUI 的佇列與歷史記錄（依 comfyui_prompt_id）對帳處理中的任務，並處理超時
+    
+    只處理本進程持有租約的任務，以及租約已過期、前一個進程留下的任務（force 時不論租約一律接手）：
+    已完成的取回影片、失敗的標記失敗、仍在 ComfyUI 佇列中的恢復監聽，ComfyUI 已沒有記錄的（例如 ComfyUI 重啟清空佇列）重新排隊。
+    後端無法連線時不做判斷，留待下一輪。回傳各結果的任務數
+    """
+    summary = {'adopted': 0, 'completed': 0, 'failed': 0, 'requeued': 0}
+    try:
+        now = time.time()
+        queues = {}
+        for task in db.get_all_tasks(status='processing', limit=-1):
+            task_id = task['task_id']
+            prompt_id = task.get('comfyui_prompt_id')
+            if not prompt_id:
+                continue
             
-            if history and prompt_id in history:
+            adopted = task.get('lease_owner') != INSTANCE_ID
+            if not db.claim_lease(task_id, INSTANCE_ID, now + TASK_LEASE_SECONDS, now, force):
+                continue  # 其他進程仍持有租約
+            
+            backend = backend_pool.get(task.get('comfyui_backend'))
+            event_listener = backend.listener
+            
+            # 重啟或重連後補登記，讓 WebSocket 事件可以找到任務；收尾中的 prompt 已由其他路徑完成，不再對帳
+            if not event_listener.watch(prompt_id, task_id):
+                continue
+            
+            # 每個後端先取一次佇列再逐一查歷史：兩次查詢之間完成的任務會出現在歷史記錄中，不會被誤判為遺失
+            if backend.name not in queues:
+                queues[backend.name] = queued_prompt_ids(backend.client.get_queue_status())
+            queued = queues[backend.name]
+            history = backend.client.get_history(prompt_id)
+            if history is None or queued is None:
+                continue
+            
+            if prompt_id in history:
                 task_info = history[prompt_id]
-                print(f"[DEBUG] Task {task_id}: Found task info in history")
+                status_info = task_info.get('status', {})
                 
-                if 'outputs' in task_info:
-                    # 任務完成
-                    outputs = task_info['outputs']
-                    print(f"[DEBUG] Task {task_id}: Found outputs: {list(outputs.keys())}")
-                    
-                    # 尋找影片輸出
-                    video_filename = None
-                    for node_id, output in outputs.items():
-                        print(f"[DEBUG] Task {task_id}: Checking node {node_id}: {list(output.keys())}")
-                        if 'gifs' in output and output['gifs']:
-                            video_filename = output['gifs'][0]['filename']
-                            print(f"[DEBUG] Task {task_id}: Found gif output: {video_filename}")
-                            break
-                        elif 'videos' in output and output['videos']:
-                            video_filename = output['videos'][0]['filename']
-                            print(f"[DEBUG] Task {task_id}: Found video output: {video_filename}")
-                            break
-                    
-                    if video_filename:
-                        # 檢查ComfyUI輸出目錄中的影片檔案
-                        # 首先嘗試掛載的目錄
-                        comfyui_video_path = os.path.join(COMFYUI_OUTPUT_DIR, video_filename)
-                        
-                        output_path = f"/app/output/{task_id}_{video_filename}"
-                        
-                        video_processed = False
-                        
-                        if os.path.exists(comfyui_video_path):
-                            # 複製影片檔案到我們的輸出目錄
-                            shutil.copy2(comfyui_video_path, output_path)
-                            video_processed = True
-                            print(f"Video file copied from {comfyui_video_path} to {output_path}")
-                        else:
-                            # 如果檔案不存在，嘗試使用API下載
-                            video_content = comfyui_client.get_image(video_filename)
-                            if video_content:
-                                with open(output_path, 'wb') as f:
-                                    f.write(video_content)
-                                video_processed = True
-                                print(f"Video file downloaded via API: {video_filename}")
-                            else:
-                                print(f"Failed to get video file: {video_filename}")
-                        
-                        if video_processed:
-                            # 生成縮圖
-                            thumbnail_filename = f"{task_id}_thumb.jpg"
-                            thumbnail_path = f"/app/thumbnails/{thumbnail_filename}"
-                            generate_thumbnail(output_path, thumbnail_path)
-                            
-                            # 更新資料庫
-                            db.update_task_status(
-                                task_id, 
-                                'completed',
-                                output_filename=f"{task_id}_{video_filename}",
-                                thumbnail_filename=thumbnail_filename
-                            )
-                            
-                            # 發送WebSocket通知
-                            socketio.emit('task_completed', {
-                                'task_id': task_id,
-                                'status': 'completed',
-                                'output_filename': f"{task_id}_{video_filename}",
-                                'thumbnail_filename': thumbnail_filename
-                            })
-                            
-                            # 處理下一個排隊中的任務
-                            process_next_task()
-                            
-                            return
-                    else:
-                        print(f"[DEBUG] Task {task_id}: No video filename found in outputs")
-                        # 備用檢測：掃描ComfyUI輸出目錄中的最新文件
-                        try:
-                            comfyui_output_dir = COMFYUI_OUTPUT_DIR
-                            if os.path.exists(comfyui_output_dir):
-                                # 獲取所有wan22開頭的mp4文件，按修改時間排序
-                                output_files = []
-                                for filename in os.listdir(comfyui_output_dir):
-                                    if filename.startswith('wan22__') and filename.endswith('.mp4'):
-                                        filepath = os.path.join(comfyui_output_dir, filename)
-                                        mtime = os.path.getmtime(filepath)
-                                        output_files.append((filename, mtime, filepath))
-                                
-                                # 按修改時間排序，最新的在前
-                                output_files.sort(key=lambda x: x[1], reverse=True)
-                                
-                                if output_files:
-                                    latest_file = output_files[0]
-                                    # 檢查文件是否在任務開始後創建
-                                    task_start_time = time.time() - (attempt * 2)  # 估算任務開始時間
-                                    if latest_file[1] > task_start_time:
-                                        video_filename = latest_file[0]
-                                        output_path = f"/app/output/{task_id}_{video_filename}"
-                                        
-                                        # 複製文件
-                                        shutil.copy2(latest_file[2], output_path)
-                                        print(f"[BACKUP] Video file copied from {latest_file[2]} to {output_path}")
-                                        
-                                        # 生成縮圖
-                                        thumbnail_filename = f"{task_id}_thumb.jpg"
-                                        thumbnail_path = f"/app/thumbnails/{thumbnail_filename}"
-                                        generate_thumbnail(output_path, thumbnail_path)
-                                        
-                                        # 更新資料庫
-                                        db.update_task_status(
-                                            task_id, 
-                                            'completed',
-                                            output_filename=f"{task_id}_{video_filename}",
-                                            thumbnail_filename=thumbnail_filename
-                                        )
-                                        
-                                        # 發送WebSocket通知
-                                        socketio.emit('task_completed', {
-                                            'task_id': task_id,
-                                            'status': 'completed',
-                                            'output_filename': f"{task_id}_{video_filename}",
-                                            'thumbnail_filename': thumbnail_filename
-                                        })
-                                        
-                                        return
-                        except Exception as backup_e:
-                            print(f"[DEBUG] Backup detection failed: {backup_e}")
+                if status_info.get('status_str') == 'error':
+                    if event_listener.claim(prompt_id):
+                        on_prompt_failed(task_id, prompt_id, str(status_info.get('messages')))
+                        summary['failed'] += 1
+                    continue
                 
-                elif 'status' in task_info and task_info['status'].get('completed', False):
-                    # 檢查是否有錯誤
-                    if 'status' in task_info and 'messages' in task_info['status']:
-                        error_msg = str(task_info['status']['messages'])
-                        db.update_task_status(task_id, 'failed', error_message=error_msg)
-                        socketio.emit('task_failed', {
-                            'task_id': task_id,
-                            'error': error_msg
-                        })
-                        
-                        # 處理下一個排隊中的任務
-                        process_next_task()
-                        
-                        return
+                if task_info.get('outputs') and status_info.get('completed', True):
+                    if event_listener.claim(prompt_id):
+                        on_prompt_finished(task_id, prompt_id, task_info['outputs'])
+                        summary['completed'] += 1
+                    continue
             
-            # 檢查排隊狀態
-            queue_status = comfyui_client.get_queue_status()
-            if queue_status:
-                # 發送排隊狀態更新
-                socketio.emit('queue_update', queue_status)
+            elif prompt_id in queued:
+                if adopted:
+                    summary['adopted'] += 1
+                    print(f"[RECOVER] Task {task_id}: prompt {prompt_id} still queued on {backend.name}, monitoring resumed")
             
-            time.sleep(2)
-            attempt += 1
+            elif task.get('started_at') and now - datetime.fromisoformat(task['started_at']).timestamp() > SUBMIT_GRACE_SECONDS:
+                # 不在佇列也不在歷史：ComfyUI 已遺失這個 prompt。提交後的寬限期內可能還在送出中，不判斷
+                if event_listener.claim(prompt_id):
+                    if db.requeue_task(task_id, prompt_id):
+                        summary['requeued'] += 1
+                        print(f"[RECOVER] Task {task_id}: prompt {prompt_id} unknown to {backend.name}, requeued")
+                    event_listener.release(prompt_id)
+                continue
             
+            # 超時檢查
+            if task.get('started_at'):
+                try:
+                    started_time = datetime.fromisoformat(task['started_at'])
+                except ValueError:
+                    continue
+                if (datetime.now() - started_time).total_seconds() > TASK_TIMEOUT_SECONDS:
+                    if event_listener.claim(prompt_id):
+                        on_prompt_failed(task_id, prompt_id, '任務超時')
+                        summary['failed'] += 1
+        
+        if summary['requeued']:
+            dispatcher.wake()
+        if any(summary.values()):
+            print(f"[RECOVER] Reconciled processing tasks: {summary}")
+    except Exception as e:
+        print(f"Error reconciling tasks: {e}")
+    return summary
+
+def lease_heartbeat_loop():
+    """定期為本進程處理中任務的租約續約"""
+    while True:
+        time.sleep(TASK_LEASE_SECONDS / 3)
+        try:
+            db.renew_leases(INSTANCE_ID, time.time() + TASK_LEASE_SECONDS)
         except Exception as e:
-            print(f"Error monitoring task {task_id}: {e}")
-            time.sleep(5)
-            attempt += 1
+            print(f"Error renewing task leases: {e}")
+
+def release_leases_and_exit(signum, frame):
+    """容器停止（SIGTERM）時讓租約立即過期，重啟後的進程不必等租約過期即可接手"""
+    try:
+        print(f"[LEASE] Released {db.release_leases(INSTANCE_ID)} task lease(s) on shutdown")
+    finally:
+        sys.exit(0)
+
+def reconcile_loop():
+    """定期執行對帳"""
+    while True:
+        time.sleep(COMFYUI_RECONCILE_INTERVAL)
+        reconcile_processing_tasks()
+
+def content_hash_filename(file_path):
+    """以檔案內容的 SHA-256 命名，相同圖片在 ComfyUI 端只會有一份"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    ext = os.path.splitext(file_path)[1].lower() or '.png'
+    return f"{sha256.hexdigest()[:32]}{ext}"
+
+# 以內容雜湊命名的檔名：SHA-256 前 32 個十六進位字元 + 副檔名
+CONTENT_HASH_FILENAME = re.compile(r'^[0-9a-f]{32}\.[a-z0-9]{1,5}$')
+
+class InputStore:
+    """以內容雜湊命名的輸入圖片庫
     
-    # 超時
-    db.update_task_status(task_id, 'failed', error_message='任務超時')
-    socketio.emit('task_failed', {
-        'task_id': task_id,
-        'error': '任務超時'
-    })
+    相同圖片只存一份，供多個任務與 ComfyUI 工作流程共用；引用數由資料庫觸發器隨 task_history 維護。
+    放入檔案 + 新增任務，以及刪除任務 + 刪除歸零檔案，都必須在 lock 內進行，
+    避免剛被釋放的檔案在刪除前又被新任務引用。
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+    
+    def spool(self, file_storage):
+        """串流寫入暫存檔並同時計算雜湊，回傳 (暫存路徑, 雜湊檔名)；不需持有 lock"""
+        ext = os.path.splitext(file_storage.filename or '')[1].lower()
+        if not re.match(r'^\.[a-z0-9]{1,5}$', ext):
+            ext = '.png'
+        
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: file_storage.stream.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, f"{sha256.hexdigest()[:32]}{ext}"
+    
+    def preprocess(self, tmp_path, width, height):
+        """在工作進程中將暫存圖片正規化為工作流程尺寸，回傳 (正規化後的暫存路徑, 雜湊檔名)；不需持有 lock"""
+        try:
+            return preprocess_pool.submit(normalize_image, tmp_path, self.directory, width, height).result()
+        finally:
+            os.remove(tmp_path)
+    
+    def preprocess_many(self, jobs):
+        """在工作進程中並行正規化多張暫存圖片：jobs 為 {key: (暫存路徑, 寬, 高)}，回傳 {key: (暫存路徑, 雜湊檔名)}
+        
+        同一張來源圖片可能以多種尺寸正規化，因此不刪除來源暫存檔；不需持有 lock
+        """
+        futures = {key: preprocess_pool.submit(normalize_image, tmp_path, self.directory, width, height)
+                   for key, (tmp_path, width, height) in jobs.items()}
+        results = {}
+        error = None
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                error = error or e
+        if error:
+            for tmp_path, _ in results.values():
+                os.remove(tmp_path)
+            raise error
+        return results
+    
+    def save_upload(self, file_storage, width, height):
+        """儲存上傳圖片到暫存檔（必要時先正規化），回傳 (暫存路徑, 雜湊檔名)；之後以 commit 放入圖片庫"""
+        tmp_path, filename = self.spool(file_storage)
+        if PREPROCESS_UPLOADS:
+            return self.preprocess(tmp_path, width, height)
+        return tmp_path, filename
+    
+    def commit(self, tmp_path, filename):
+        """將暫存檔放入圖片庫；已有相同內容時直接丟棄暫存檔（呼叫端需持有 lock）
+        
+        回傳是否新放入檔案：新增任務失敗時，只有新放入的檔案沒有其他任務引用，可以刪除
+        """
+        path = os.path.join(self.directory, filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        return True
+    
+    def remove(self, filenames):
+        """刪除已無任務引用的圖片（呼叫端需持有 lock），回傳實際刪除的檔名"""
+        deleted = []
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    deleted.append(filename)
+                except Exception as e:
+                    print(f"Error deleting input file {path}: {e}")
+        return deleted
+
+input_store = InputStore('/app/input')
+
+class ComfyUIBackend:
+    """單一 ComfyUI 後端：HTTP 客戶端、事件監聽器與輸入/輸出檔案傳輸方式"""
+    
+    def __init__(self, base_url, input_dir=None, output_dir=None):
+        self.base_url = base_url.rstrip('/')
+        self.name = urlparse(self.base_url).netloc or self.base_url
+        # 與本容器共用的 ComfyUI input/output 目錄；None 表示沒有共用檔案系統，改走 HTTP 傳輸
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.output_index = OutputIndex(output_dir) if output_dir else None
+        self.client = ComfyUIClient(self.base_url)
+        ws_scheme = 'wss' if self.base_url.startswith('https') else 'ws'
+        self.listener = ComfyUIEventListener(
+            f"{ws_scheme}://{self.name}/ws",
+            COMFYUI_CLIENT_ID,
+            on_finished=on_prompt_finished,
+            on_failed=on_prompt_failed,
+            on_started=on_prompt_started,
+            on_progress=on_prompt_progress,
+            on_status=on_comfyui_status,
+            on_reconnect=reconcile_processing_tasks
+        )
+        self.healthy = False
+        self.queue = None
+        self._staged = {}  # 已上傳到此後端的雜湊檔名 → 上傳時間（僅 upload 模式）
+    
+    @property
+    def queue_depth(self):
+        """ComfyUI 佇列中的任務數（執行中 + 排隊中，包含其他客戶端送出的任務）"""
+        if not self.queue:
+            return 0
+        return len(self.queue.get('queue_running', [])) + len(self.queue.get('queue_pending', []))
+    
+    def refresh_queue(self):
+        """更新排隊狀態；取得失敗即視為不健康"""
+        self.queue = self.client.get_queue_status()
+        self.healthy = self.queue is not None
+        return self.queue
+    
+    def stage_input(self, filename):
+        """確保輸入圖片已存在於此後端的 input 目錄，回傳工作流程要引用的雜湊檔名；失敗時回傳 None"""
+        local_path = f"/app/input/{filename}"
+        # 新任務的輸入圖片已以內容雜湊命名，不需要重新讀檔計算
+        if CONTENT_HASH_FILENAME.match(filename):
+            comfyui_filename = filename
+        else:
+            comfyui_filename = content_hash_filename(local_path)
+        
+        if self.input_dir:
+            # 共用目錄每次都檢查檔案是否還在：ComfyUI 的 input 目錄可能被清理
+            comfyui_image_path = os.path.join(self.input_dir, comfyui_filename)
+            if not os.path.exists(comfyui_image_path):
+                shutil.copy2(local_path, comfyui_image_path)
+            return comfyui_filename
+        
+        now = time.time()
+        if now - self._staged.get(comfyui_filename, 0) < COMFYUI_UPLOAD_CACHE_SECONDS:
+            return comfyui_filename
+        
+        # 直接把檔案串流上傳到 ComfyUI，不需要共用檔案系統
+        if self.client.upload_image(local_path, comfyui_filename) is None:
+            return None
+        
+        if len(self._staged) >= 1000:
+            self._staged = {name: staged_at for name, staged_at in self._staged.items()
+                            if now - staged_at < COMFYUI_UPLOAD_CACHE_SECONDS}
+        self._staged[comfyui_filename] = now
+        return comfyui_filename
+    
+    def forget_inputs(self, filenames):
+        """ComfyUI 拒絕 prompt（例如找不到輸入圖片）時丟棄上傳記錄，下次提交重新上傳"""
+        for filename in filenames:
+            self._staged.pop(filename, None)
+
+class ComfyUIBackendPool:
+    """多台 ComfyUI 後端，依佇列深度將任務派送到最空閒的健康後端"""
+    
+    def __init__(self, backends):
+        self.backends = backends
+        self._by_name = {backend.name: backend for backend in backends}
+        self._unknown = set()  # 已記錄過的未知後端名稱，每個只記錄一次
     
-    # 處理下一個排隊中的任務
-    process_next_task()
+    @property
+    def default(self):
+        return self.backends[0]
+    
+    def get(self, name):
+        """依名稱取得後端；舊資料沒有記錄後端、或記錄的後端已從 COMFYUI_BACKENDS 移除時使用預設後端"""
+        backend = self._by_name.get(name)
+        if backend:
+            return backend
+        if name and name not in self._unknown:
+            self._unknown.add(name)
+            print(f"[BACKEND] Unknown backend {name}, using default backend {self.default.name}")
+        return self.default
+    
+    def start(self):
+        """啟動所有後端的事件監聽"""
+        for backend in self.backends:
+            backend.listener.start()
+    
+    def release(self, prompt_id):
+        """解除各後端事件監聽器對 prompt_id 的收尾標記（prompt_id 在各後端間不會重複）"""
+        for backend in self.backends:
+            backend.listener.release(prompt_id)
+    
+    def pick(self, inflight, depth):
+        """選出最空閒的健康後端；inflight 為各後端由我們派送、尚未完成的任務數
+        
+        健康狀態與佇列深度取自最近一次排隊狀態快照
+        """
+        candidates = []
+        for backend in self.backends:
+            backend_inflight = inflight.get(backend.name, 0)
+            if backend_inflight >= depth or not backend.healthy:
+                continue
+            candidates.append((backend.queue_depth, backend_inflight, backend))
+        
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: (c[0], c[1]))[2]
+    
+    def get_queue_status(self):
+        """合併所有後端的排隊狀態；全部無法連線時回傳 None"""
+        merged = {'queue_running': [], 'queue_pending': [], 'backends': []}
+        for backend in self.backends:
+            queue = backend.refresh_queue()
+            merged['backends'].append({
+                'name': backend.name,
+                'healthy': backend.healthy,
+                'queue_depth': backend.queue_depth
+            })
+            if queue:
+                # 只保留 [number, prompt_id]，不把整份工作流程推送給每個瀏覽器
+                merged['queue_running'].extend(item[:2] for item in queue.get('queue_running', []))
+                merged['queue_pending'].extend(item[:2] for item in queue.get('queue_pending', []))
+        
+        if not any(b['healthy'] for b in merged['backends']):
+            return None
+        return merged
+
+def create_backend_pool():
+    """依 COMFYUI_BACKENDS 建立後端池；未設定時使用 COMFYUI_HOST/COMFYUI_PORT"""
+    urls = [url.strip() for url in COMFYUI_BACKENDS.split(',') if url.strip()] or [COMFYUI_URL]
+    backends = []
+    for i, url in enumerate(urls):
+        if '://' not in url:
+            url = f"http://{url}"
+        if i == 0:
+            # 第一台後端沿用 docker-compose 掛載的共用目錄
+            input_dir = '/app/comfyui_input' if COMFYUI_INPUT_TRANSPORT == 'copy' else None
+            backends.append(ComfyUIBackend(url, input_dir, COMFYUI_OUTPUT_DIR))
+        else:
+            backends.append(ComfyUIBackend(url))
+    return ComfyUIBackendPool(backends)
+
+backend_pool = create_backend_pool()
+
+class QueueSnapshot:
+    """共用的 ComfyUI 排隊狀態快照：由背景線程刷新、同時只有一個線程在抓取，內容改變時才通知"""
+    
+    def __init__(self, fetch, on_change=None):
+        self.fetch = fetch
+        self.on_change = on_change
+        self._value = None
+        self._fetched_at = 0
+        self._stale = False
+        self._refreshing = False
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+    
+    def get(self, max_age=None):
+        """回傳最近一次的快照，不對 ComfyUI 發出請求（尚未抓取過時除外）
+        
+        max_age 供調度器使用：快照超過 max_age 秒（或已 invalidate）時同步重新抓取
+        """
+        with self._cond:
+            if max_age is None and self._fetched_at:
+                return self._value
+            if max_age is not None and not self._stale and time.time() - self._fetched_at < max_age:
+                return self._value
+        return self.refresh()
+    
+    def refresh(self):
+        """重新抓取；已有線程在抓取時等待其結果而不重複請求"""
+        with self._cond:
+            if self._refreshing:
+                self._cond.wait_for(lambda: not self._refreshing)
+                return self._value
+            # 抓取期間的 invalidate() 會讓下一次帶 max_age 的 get() 再抓一次
+            self._refreshing = True
+            self._stale = False
+        
+        value = None
+        try:
+            value = self.fetch()
+        except Exception as e:
+            print(f"Error refreshing queue snapshot: {e}")
+        
+        with self._cond:
+            changed = value != self._value
+            self._value = value
+            self._fetched_at = time.time()
+            self._refreshing = False
+            self._cond.notify_all()
+        
+        if changed and self.on_change:
+            self.on_change(value)
+        return value
+    
+    def invalidate(self):
+        """下次帶 max_age 的 get() 強制重新抓取"""
+        with self._cond:
+            self._stale = True
+    
+    def wake(self):
+        """請背景線程立即刷新，呼叫端不等待 ComfyUI 回應"""
+        self._wake.set()
+    
+    def run_forever(self, interval):
+        """背景定期刷新；wake() 時提前刷新"""
+        while True:
+            self._wake.clear()
+            self.refresh()
+            self._wake.wait(interval)
+
+queue_snapshot = QueueSnapshot(backend_pool.get_queue_status, on_change=on_queue_snapshot_changed)
 
 @app.route('/')
 def index():
@@ -450,7 +1629,7 @@ def index():
         local_queue = db.get_queue_status()
         
         # 獲取ComfyUI排隊狀態
-        comfyui_queue = comfyui_client.get_queue_status()
+        comfyui_queue = queue_snapshot.get()
         
         # 獲取最近5個任務
         recent_tasks = db.get_all_tasks(limit=5)
@@ -473,22 +1652,46 @@ def history():
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
     status = request.args.get('status', '')
+    after = parse_page_cursor(request.args.get('after'))
+    before = parse_page_cursor(request.args.get('before'))
+    last = request.args.get('last') == '1'
     
     # 每頁顯示9個任務
     limit = 9
-    offset = (page - 1) * limit
     
-    # 獲取任務和總數
-    if search:
-        tasks = db.search_tasks(search, limit, offset)
-        total_count = db.count_tasks(status if status else None, search)
-    else:
-        tasks = db.get_all_tasks(limit, offset, status if status else None)
-        total_count = db.count_tasks(status if status else None)
+    # 獲取總數（無搜尋時讀取增量維護的狀態計數，搜尋時走全文檢索）
+    total_count = db.count_tasks(status if status else None, search if search else None)
     
     # 計算總頁數
     import math
     total_pages = math.ceil(total_count / limit) if total_count > 0 else 1
+    page = max(1, min(page, total_pages))
+    
+    if search:
+        offset = (page - 1) * limit
+        tasks = db.search_tasks(search, limit, offset, status if status else None)
+        has_prev, has_next = page > 1, page < total_pages
+    elif after or before or last or page == 1:
+        # 首頁、上/下一頁、末頁沿 (created_at, id) 游標取資料，不用 OFFSET；
+        # 末頁只取餘數筆，讓頁面切分與頁碼一致
+        page_size = total_count - (total_pages - 1) * limit if last else limit
+        tasks, has_more = db.get_tasks_page(max(page_size, 1), status if status else None,
+                                            after=after, before=before, from_end=last)
+        if last:
+            page = total_pages
+            has_prev, has_next = total_pages > 1, False
+        elif before:
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = after is not None, has_more
+    else:
+        # 直接跳到指定頁碼時才退回 OFFSET
+        offset = (page - 1) * limit
+        tasks = db.get_all_tasks(limit, offset, status if status else None)
+        has_prev, has_next = page > 1, page < total_pages
+    
+    prev_cursor = format_page_cursor(tasks[0]) if tasks else None
+    next_cursor = format_page_cursor(tasks[-1]) if tasks else None
     
     # 計算分頁範圍
     start_page = max(1, page - 2)
@@ -502,7 +1705,25 @@ def history():
                          total_count=total_count,
                          total_pages=total_pages,
                          start_page=start_page,
-                         end_page=end_page)
+                         end_page=end_page,
+                         has_prev=has_prev,
+                         has_next=has_next,
+                         prev_cursor=prev_cursor,
+                         next_cursor=next_cursor)
+
+def format_page_cursor(task):
+    """將任務的 (created_at, id) 編成分頁游標"""
+    return f"{task['created_at']}|{task['id']}"
+
+def parse_page_cursor(value):
+    """解析分頁游標，格式錯誤時回傳 None"""
+    if not value or '|' not in value:
+        return None
+    created_at, _, row_id = value.rpartition('|')
+    try:
+        return (created_at, int(row_id))
+    except ValueError:
+        return None
 
 @app.route('/task/<task_id>')
 def task_detail(task_id):
@@ -520,19 +1741,17 @@ def queue_status():
         local_queue = db.get_queue_status()
         
         # 獲取ComfyUI排隊狀態
-        comfyui_queue = comfyui_client.get_queue_status()
+        comfyui_queue = queue_snapshot.get()
         
-        # 獲取處理中和排隊中的任務
+        # 獲取處理中的任務與依預定派送順序排列的排隊任務
         processing_tasks = db.get_all_tasks(status='processing')
-        pending_tasks = db.get_all_tasks(status='pending')
-        
-        # 計算等待時間
-        wait_times = calculate_estimated_wait_time(pending_tasks, processing_tasks)
+        estimates, order, _ = forecast_queue()
+        pending_tasks = [task for task in map(db.get_task, [task['task_id'] for task in order[:50]]) if task]
         
         # 將等待時間添加到任務資料中
-        wait_time_dict = {wt['task_id']: wt['wait_time_minutes'] for wt in wait_times}
         for task in pending_tasks:
-            task['estimated_wait_time'] = wait_time_dict.get(task['task_id'], 0)
+            estimate = estimates.get(task['task_id'])
+            task['estimated_wait_time'] = round(estimate['wait_seconds'] / 60, 1) if estimate else 0
         
         # 獲取當前時間
         now = datetime.now()
@@ -556,341 +1775,609 @@ def queue_status():
 @app.route('/api/generate', methods=['POST'])
 def generate_video():
     """生成影片API"""
+    uploads = []  # (暫存路徑, 雜湊檔名)
     try:
         # 獲取參數
         prompt = request.form.get('prompt', '').strip()
-        width = int(request.form.get('width', 480))
-        height = int(request.form.get('height', 832))
-        duration = int(request.form.get('duration', 81))  # 改為預設5秒
-        generation_mode = request.form.get('mode', 'single')  # 生成模式
+        generation_mode = request.form.get('mode', 'single')  # 生成模式（工作流程模板名稱）
         
         if not prompt:
             return jsonify({'error': '請輸入提示詞'}), 400
         
+        template = workflows.get(generation_mode)
+        if not template:
+            return jsonify({'error': '無效的生成模式'}), 400
+        
+        try:
+            width, height, duration = parse_video_size(request.form.get('width', 480), request.form.get('height', 832),
+                                                       request.form.get('duration', 81))  # 預設5秒
+        except ValueError:
+            return jsonify({'error': f'寬高須介於 16 到 {MAX_VIDEO_SIDE}，幀數須介於 1 到 {MAX_VIDEO_FRAMES}'}), 400
+        try:
+            seed = parse_seed(request.form.get('seed'))
+        except ValueError:
+            return jsonify({'error': '種子必須是非負整數（-1 表示隨機）'}), 400
+        try:
+            priority = parse_priority(request.form.get('priority'))
+        except ValueError:
+            return jsonify({'error': f"優先級必須是 {'、'.join(PRIORITY_CLASSES)} 之一"}), 400
+        use_cache = request.form.get('use_cache', 'true').lower() == 'true'
+        
         # 生成任務ID
         task_id = str(uuid.uuid4())
         
-        if generation_mode == 'single':
-            # 單圖模式
-            if 'image' not in request.files:
-                return jsonify({'error': '請上傳圖片'}), 400
-            
-            image_file = request.files['image']
-            if image_file.filename == '':
-                return jsonify({'error': '請選擇圖片檔案'}), 400
-            
-            # 儲存上傳的圖片到本地input目錄
-            image_filename = f"{task_id}_{image_file.filename}"
-            image_path = f"/app/input/{image_filename}"
-            image_file.save(image_path)
-            
-            # 同時複製到ComfyUI的input目錄
-            comfyui_image_path = f"/app/comfyui_input/{image_filename}"
-            shutil.copy2(image_path, comfyui_image_path)
-            
-            # 儲存到資料庫，初始狀態為pending
-            db.add_task(task_id, prompt, image_filename, width, height, duration, generation_mode)
-            
-            # 檢查是否有正在處理的任務
-            processing_tasks = db.get_all_tasks(status='processing')
-            
-            if len(processing_tasks) == 0:
-                # 沒有正在處理的任務，可以立即開始處理
-                return start_task_processing(task_id, prompt, image_filename, width, height, duration, generation_mode)
-            else:
-                # 有任務正在處理，保持pending狀態
-                return jsonify({
-                    'success': True,
-                    'task_id': task_id,
-                    'message': '任務已加入排隊，等待處理中...',
-                    'status': 'pending'
-                })
+        # 模板的圖片參數即上傳欄位：單圖模式為 image，首尾幀模式為 first_image 與 last_image
+        image_files = [request.files.get(field) for field in template.image_params]
+        if not all(image_files):
+            return jsonify({'error': '請上傳圖片' if len(image_files) == 1 else '請上傳首幀和尾幀圖片'}), 400
+        if any(image_file.filename == '' for image_file in image_files):
+            return jsonify({'error': '請選擇圖片檔案' if len(image_files) == 1 else '請選擇首幀和尾幀圖片檔案'}), 400
         
-        elif generation_mode == 'first_last':
-            # 首尾幀模式
-            if 'first_image' not in request.files or 'last_image' not in request.files:
-                return jsonify({'error': '請上傳首幀和尾幀圖片'}), 400
-            
-            first_image_file = request.files['first_image']
-            last_image_file = request.files['last_image']
-            
-            if first_image_file.filename == '' or last_image_file.filename == '':
-                return jsonify({'error': '請選擇首幀和尾幀圖片檔案'}), 400
-            
-            # 儲存首幀圖片
-            first_image_filename = f"{task_id}_first_{first_image_file.filename}"
-            first_image_path = f"/app/input/{first_image_filename}"
-            first_image_file.save(first_image_path)
-            
-            # 儲存尾幀圖片
-            last_image_filename = f"{task_id}_last_{last_image_file.filename}"
-            last_image_path = f"/app/input/{last_image_filename}"
-            last_image_file.save(last_image_path)
-            
-            # 複製到ComfyUI的input目錄
-            comfyui_first_image_path = f"/app/comfyui_input/{first_image_filename}"
-            comfyui_last_image_path = f"/app/comfyui_input/{last_image_filename}"
-            shutil.copy2(first_image_path, comfyui_first_image_path)
-            shutil.copy2(last_image_path, comfyui_last_image_path)
-            
-            # 儲存到資料庫，初始狀態為pending
-            db.add_task(task_id, prompt, first_image_filename, width, height, duration, generation_mode, last_image_filename)
-            
-            # 檢查是否有正在處理的任務
-            processing_tasks = db.get_all_tasks(status='processing')
-            
-            if len(processing_tasks) == 0:
-                # 沒有正在處理的任務，可以立即開始處理
-                return start_task_processing_first_last(task_id, prompt, first_image_filename, last_image_filename, width, height, duration, generation_mode)
-            else:
-                # 有任務正在處理，保持pending狀態
-                return jsonify({
-                    'success': True,
-                    'task_id': task_id,
-                    'message': '任務已加入排隊，等待處理中...',
-                    'status': 'pending'
-                })
+        # 以內容雜湊存入本地input目錄，相同圖片只存一份
+        for image_file in image_files:
+            uploads.append(input_store.save_upload(image_file, width, height))
         
-        else:
-            return jsonify({'error': '無效的生成模式'}), 400
+        image_filenames = [filename for _, filename in uploads]
+        fingerprint = request_fingerprint(template, prompt, image_filenames, width, height, duration, seed)
         
-    except Exception as e:
-        print(f"Error in generate_video: {e}")
-        return jsonify({'error': f'伺服器錯誤: {str(e)}'}), 500
-
-def start_task_processing(task_id, prompt, image_filename, width, height, duration, generation_mode='single'):
-    """開始處理任務"""
-    try:
-        # 建立工作流程
-        workflow = create_workflow(prompt, image_filename, width, height, duration)
-        
-        # 提交到ComfyUI
-        result = comfyui_client.queue_prompt(workflow)
-        if not result:
-            db.update_task_status(task_id, 'failed', error_message='ComfyUI連接失敗')
-            return jsonify({'error': 'ComfyUI連接失敗'}), 500
+        # 儲存到資料庫，初始狀態為pending；查詢與新增都在 lock 內，與領頭任務結束時的跟隨任務處理互斥
+        with input_store.lock:
+            created = []
+            cached_task = output_filename = leader_task_id = None
+            try:
+                for tmp_path, filename in uploads:
+                    if input_store.commit(tmp_path, filename):
+                        created.append(filename)
+                
+                # 結果快取：相同請求已有成功結果時直接沿用（completed）；
+                # 相同請求正在排隊或處理中時成為跟隨任務，不另外佔用GPU
+                if use_cache and RESULT_CACHE:
+                    cached_task, output_filename, leader_task_id = match_existing(fingerprint, task_id)
+                db.add_task(task_id, prompt, image_filenames[0], width, height, duration, generation_mode,
+                            image_filenames[1] if len(image_filenames) > 1 else None,
+                            seed=seed, request_fingerprint=fingerprint, output_filename=output_filename,
+                            leader_task_id=leader_task_id, priority=priority, client_id=request_client_id())
+            except Exception:
+                # 任務沒有建立：這次新放入的圖片與連結給新任務的快取影片沒有任何任務引用，一併刪除
+                input_store.remove(created)
+                remove_linked_outputs([output_filename])
+                raise
         
-        prompt_id = result.get('prompt_id')
-        if not prompt_id:
-            db.update_task_status(task_id, 'failed', error_message='提交任務失敗')
-            return jsonify({'error': '提交任務失敗'}), 500
+        if output_filename:
+            print(f"[CACHE] Task {task_id}: reused output of {cached_task['task_id']}")
+            socketio.emit('task_completed', {
+                'task_id': task_id,
+                'status': 'completed',
+                'output_filename': output_filename
+            })
+            schedule_media(task_id, f"/app/output/{output_filename}")
+            return jsonify({
+                'success': True,
+                'task_id': task_id,
+                'message': '相同的請求已有生成結果，直接沿用既有影片',
+                'status': 'completed',
+                'cached_from': cached_task['task_id']
+            })
         
-        # 更新狀態為processing
-        db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id)
+        if leader_task_id:
+            print(f"[DEDUP] Task {task_id}: following in-flight task {leader_task_id}")
+            return jsonify({
+                'success': True,
+                'task_id': task_id,
+                'message': '相同的請求正在處理中，完成後會直接取得同一支影片',
+                'status': 'pending',
+                'leader_task_id': leader_task_id
+            })
         
-        # 啟動監控線程
-        monitor_thread = threading.Thread(target=monitor_task, args=(task_id, prompt_id))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        # 由調度器負責提交，避免並發請求同時判斷「沒有處理中任務」
+        dispatcher.wake()
         
         return jsonify({
             'success': True,
             'task_id': task_id,
-            'prompt_id': prompt_id,
-            'message': '任務已提交，正在處理中...',
-            'status': 'processing'
+            'message': '任務已加入排隊，等待處理中...',
+            'status': 'pending'
         })
-        
+    
+    except UnidentifiedImageError:
+        return jsonify({'error': '無法讀取圖片檔案'}), 400
     except Exception as e:
-        print(f"Error starting task processing: {e}")
-        db.update_task_status(task_id, 'failed', error_message=f'啟動處理失敗: {str(e)}')
-        return jsonify({'error': f'啟動處理失敗: {str(e)}'}), 500
+        print(f"Error in generate_video: {e}")
+        return jsonify({'error': f'伺服器錯誤: {str(e)}'}), 500
+    finally:
+        # 清除未放入圖片庫的暫存檔（出錯時已儲存的上傳）
+        for tmp_path, _ in uploads:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class BatchRequestError(Exception):
+    """批次清單或上傳檔案不正確"""
+
+def load_batch_manifest(archive=None):
+    """讀取批次清單：manifest 表單欄位或檔案，或 zip 中的 manifest.json
+    
+    清單為項目列表，或 {"defaults": {...}, "items": [...]}；回傳套用預設值後的項目
+    """
+    try:
+        raw = request.form.get('manifest')
+        if raw is None and 'manifest' in request.files:
+            raw = request.files['manifest'].read().decode('utf-8')
+        if raw is None and archive and 'manifest.json' in archive.namelist():
+            raw = archive.read('manifest.json').decode('utf-8')
+        if raw is None:
+            raise BatchRequestError('請提供批次清單（manifest）')
+        manifest = json.loads(raw)
+    except ValueError:
+        raise BatchRequestError('批次清單不是有效的 JSON')
+    
+    defaults = {}
+    if isinstance(manifest, dict):
+        defaults = manifest.get('defaults') or {}
+        manifest = manifest.get('items')
+    if not isinstance(manifest, list) or not manifest or not isinstance(defaults, dict):
+        raise BatchRequestError('批次清單必須是非空的項目列表')
+    if len(manifest) > BATCH_MAX_ITEMS:
+        raise BatchRequestError(f'每批最多 {BATCH_MAX_ITEMS} 個項目')
+    
+    items = []
+    for index, item in enumerate(manifest, 1):
+        if not isinstance(item, dict):
+            raise BatchRequestError(f'第 {index} 項格式錯誤')
+        items.append(dict(defaults, **item))
+    return items
 
-def start_task_processing_first_last(task_id, prompt, first_image_filename, last_image_filename, width, height, duration, generation_mode='first_last'):
-    """開始處理首尾幀任務"""
+def batch_sources(archive=None):
+    """清單可引用的圖片：多檔上傳（files 欄位）以原始檔名引用，zip 以成員路徑引用"""
+    sources = {}
+    for file_storage in request.files.getlist('files'):
+        if file_storage.filename:
+            sources[file_storage.filename] = file_storage
+    if archive:
+        for info in archive.infolist():
+            if not info.is_dir() and info.filename != 'manifest.json':
+                sources[info.filename] = info
+    return sources
+
+def parse_batch_item(index, item, sources):
+    """驗證批次項目，預設值與 /api/generate 相同，但優先級預設為 batch"""
+    prompt = str(item.get('prompt') or '').strip()
+    if not prompt:
+        raise BatchRequestError(f'第 {index} 項缺少提示詞')
+    
+    template = workflows.get(str(item.get('mode', 'single')))
+    if not template:
+        raise BatchRequestError(f'第 {index} 項的生成模式無效')
+    
     try:
-        # 建立首尾幀工作流程
-        workflow = create_first_last_workflow(prompt, first_image_filename, last_image_filename, width, height, duration)
+        width, height, duration = parse_video_size(item.get('width', 480), item.get('height', 832), item.get('duration', 81))
+        seed = parse_seed(str(item['seed']) if item.get('seed') is not None else None)
+        priority = parse_priority(item.get('priority'), default=PRIORITY_CLASSES['batch'])
+    except (TypeError, ValueError):
+        raise BatchRequestError(f'第 {index} 項的尺寸、時長、種子或優先級無效（寬高上限 {MAX_VIDEO_SIDE}，幀數上限 {MAX_VIDEO_FRAMES}）')
+    
+    images = []
+    for field in template.image_params:
+        name = item.get(field)
+        if not name:
+            raise BatchRequestError(f'第 {index} 項缺少圖片欄位 {field}')
+        if name not in sources:
+            raise BatchRequestError(f'第 {index} 項引用的圖片 {name} 不在上傳檔案中')
+        images.append(name)
+    
+    return {
+        'template': template,
+        'prompt': prompt,
+        'width': width,
+        'height': height,
+        'duration': duration,
+        'seed': seed,
+        'priority': priority,
+        'images': images,
+        'use_cache': str(item.get('use_cache', True)).lower() != 'false'
+    }
+
+def spool_batch_source(source, archive=None):
+    """將上傳檔案或 zip 成員串流寫入圖片庫的暫存檔，回傳 (暫存路徑, 雜湊檔名)"""
+    if isinstance(source, zipfile.ZipInfo):
+        with archive.open(source) as stream:
+            return input_store.spool(FileStorage(stream, filename=source.filename))
+    return input_store.spool(source)
+
+def batch_summary(batch_id):
+    """批次彙總：總數、各狀態任務數、已結束數與是否全部結束"""
+    counts = db.get_batch_counts(batch_id)
+    total = sum(counts.values())
+    done = total - counts.get('pending', 0) - counts.get('processing', 0)
+    return {
+        'batch_id': batch_id,
+        'total': total,
+        'counts': dict({'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}, **counts),
+        'done': done,
+        'finished': total > 0 and done == total
+    }
+
+class BatchProgress:
+    """批次進度推送：定期彙總進行中的批次，內容改變時推送 batch_progress 到 batch:{batch_id} 房間，
+    全部結束後停止追蹤。任務狀態在多處改變，集中在此輪詢比在每個改變點各自通知簡單"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}  # batch_id → 上次推送的彙總
+        self._lock = threading.Lock()
+    
+    def watch(self, batch_id):
+        """開始追蹤批次（新批次或有客戶端訂閱時）"""
+        with self._lock:
+            self._watched.setdefault(batch_id, None)
+    
+    def poll(self):
+        """檢查所有追蹤中的批次並推送有變化的彙總"""
+        with self._lock:
+            watched = dict(self._watched)
+        for batch_id, last in watched.items():
+            summary = batch_summary(batch_id)
+            if summary != last:
+                socketio.emit('batch_progress', summary, to=f"batch:{batch_id}")
+            with self._lock:
+                if summary['finished'] or not summary['total']:
+                    self._watched.pop(batch_id, None)
+                else:
+                    self._watched[batch_id] = summary
+    
+    def run_forever(self):
+        """背景定期檢查"""
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling batch progress: {e}")
+            time.sleep(self.interval)
+
+batch_progress = BatchProgress(BATCH_PROGRESS_INTERVAL)
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch():
+    """批次生成影片API：一份清單搭配多個圖片檔或一個 zip，在同一個交易中新增所有任務"""
+    archive = None
+    spooled = {}   # 圖片名稱 → (暫存路徑, 雜湊檔名)
+    prepared = {}  # (圖片名稱, 寬, 高) → (暫存路徑, 雜湊檔名)
+    try:
+        if 'archive' in request.files:
+            try:
+                archive = zipfile.ZipFile(request.files['archive'].stream)
+            except zipfile.BadZipFile:
+                raise BatchRequestError('archive 不是有效的 zip 檔')
         
-        # 提交到ComfyUI
-        result = comfyui_client.queue_prompt(workflow)
-        if not result:
-            db.update_task_status(task_id, 'failed', error_message='ComfyUI連接失敗')
-            return jsonify({'error': 'ComfyUI連接失敗'}), 500
+        items = load_batch_manifest(archive)
+        sources = batch_sources(archive)
+        specs = [parse_batch_item(index, item, sources) for index, item in enumerate(items, 1)]
         
-        prompt_id = result.get('prompt_id')
-        if not prompt_id:
-            db.update_task_status(task_id, 'failed', error_message='提交任務失敗')
-            return jsonify({'error': '提交任務失敗'}), 500
+        # 每個被引用的檔案只串流到磁碟一次；正規化依尺寸分組，在工作進程中並行
+        for spec in specs:
+            for name in spec['images']:
+                if name not in spooled:
+                    spooled[name] = spool_batch_source(sources[name], archive)
+        keys = {(name, spec['width'], spec['height']) for spec in specs for name in spec['images']}
+        if PREPROCESS_UPLOADS:
+            prepared = input_store.preprocess_many({key: (spooled[key[0]][0], key[1], key[2]) for key in keys})
+        else:
+            prepared = {key: spooled[key[0]] for key in keys}
+        
+        batch_id = str(uuid.uuid4())
+        client_id = request_client_id()
+        rows = []
+        results = []
+        leaders = {}  # 同一批中相同請求的第一個任務
+        with input_store.lock:
+            created = []
+            try:
+                for tmp_path, filename in set(prepared.values()):
+                    if input_store.commit(tmp_path, filename):
+                        created.append(filename)
+                
+                for index, spec in enumerate(specs):
+                    task_id = str(uuid.uuid4())
+                    image_filenames = [prepared[(name, spec['width'], spec['height'])][1] for name in spec['images']]
+                    fingerprint = request_fingerprint(spec['template'], spec['prompt'], image_filenames,
+                                                      spec['width'], spec['height'], spec['duration'], spec['seed'])
+                    
+                    cached_task = output_filename = leader_task_id = None
+                    if spec['use_cache'] and RESULT_CACHE:
+                        cached_task, output_filename, leader_task_id = match_existing(fingerprint, task_id)
+                        if not output_filename and not leader_task_id:
+                            leader_task_id = leaders.get(fingerprint)
+                            leaders.setdefault(fingerprint, task_id)
+                    
+                    rows.append({
+                        'task_id': task_id,
+                        'prompt': spec['prompt'],
+                        'image_filename': image_filenames[0],
+                        'second_image_filename': image_filenames[1] if len(image_filenames) > 1 else None,
+                        'width': spec['width'],
+                        'height': spec['height'],
+                        'duration': spec['duration'],
+                        'generation_mode': spec['template'].name,
+                        'seed': spec['seed'],
+                        'request_fingerprint': fingerprint,
+                        'output_filename': output_filename,
+                        'leader_task_id': leader_task_id,
+                        'batch_id': batch_id,
+                        'priority': spec['priority'],
+                        'client_id': client_id
+                    })
+                    result = {'index': index, 'task_id': task_id, 'status': 'completed' if output_filename else 'pending'}
+                    if cached_task:
+                        result['cached_from'] = cached_task['task_id']
+                    if leader_task_id:
+                        result['leader_task_id'] = leader_task_id
+                    results.append(result)
+                
+                db.add_tasks(rows)
+            except Exception:
+                # 任務沒有建立：這次新放入的圖片與連結給新任務的快取影片沒有任何任務引用，一併刪除
+                input_store.remove(created)
+                remove_linked_outputs(row['output_filename'] for row in rows)
+                raise
+        
+        for row in rows:
+            if row['output_filename']:
+                socketio.emit('task_completed', {
+                    'task_id': row['task_id'],
+                    'status': 'completed',
+                    'output_filename': row['output_filename']
+                })
+                schedule_media(row['task_id'], f"/app/output/{row['output_filename']}")
         
-        # 更新狀態為processing
-        db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id)
+        cached = sum(1 for row in rows if row['output_filename'])
+        following = sum(1 for row in rows if row['leader_task_id'])
+        print(f"[BATCH] {batch_id}: {len(rows)} tasks ({cached} cached, {following} following), {len(spooled)} images")
         
-        # 啟動監控線程
-        monitor_thread = threading.Thread(target=monitor_task, args=(task_id, prompt_id))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        batch_progress.watch(batch_id)
+        dispatcher.wake()
         
         return jsonify({
             'success': True,
-            'task_id': task_id,
-            'prompt_id': prompt_id,
-            'message': '首尾幀任務已提交，正在處理中...',
-            'status': 'processing'
+            'batch_id': batch_id,
+            'total': len(rows),
+            'message': f'已加入 {len(rows)} 個任務',
+            'tasks': results
         })
-        
+    
+    except BatchRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except UnidentifiedImageError:
+        return jsonify({'error': '無法讀取圖片檔案'}), 400
     except Exception as e:
-        print(f"Error starting first_last task processing: {e}")
-        db.update_task_status(task_id, 'failed', error_message=f'啟動處理失敗: {str(e)}')
-        return jsonify({'error': f'啟動處理失敗: {str(e)}'}), 500
+        print(f"Error in generate_batch: {e}")
+        return jsonify({'error': f'伺服器錯誤: {str(e)}'}), 500
+    finally:
+        # 清除未放入圖片庫的暫存檔（正規化的來源檔，或出錯時的所有暫存檔）
+        for tmp_path, _ in list(spooled.values()) + list(prepared.values()):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if archive:
+            archive.close()
+
+@app.route('/api/batch/<batch_id>')
+def get_batch_status(batch_id):
+    """批次進度API：彙總與各任務狀態"""
+    summary = batch_summary(batch_id)
+    if not summary['total']:
+        return jsonify({'error': '批次不存在'}), 404
+    summary['tasks'] = db.get_batch_tasks(batch_id)
+    return jsonify(summary)
 
-def start_task_processing_internal(task_id, prompt, image_filename, width, height, duration):
-    """內部使用的開始處理任務函數（不返回Flask響應）"""
+@app.route('/api/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_batch_api(batch_id):
+    """取消批次API：排隊中的任務一次取消，處理中的逐一從 ComfyUI 移除或中斷"""
+    tasks = db.get_batch_tasks(batch_id)
+    if not tasks:
+        return jsonify({'error': '批次不存在'}), 404
+    
+    cancelled, leaders = db.cancel_batch(batch_id)
+    # 其他請求跟隨著被取消的任務時，改由其中一個自行派送
+    for leader_task_id in leaders:
+        finish_followers(leader_task_id)
+    
+    unconfirmed = []  # 無法確認 ComfyUI 已停止處理的任務
+    for task_id in [task['task_id'] for task in tasks if task['status'] == 'processing']:
+        task = db.get_task(task_id)
+        action = cancel_task(task) if task else False
+        if action is not False:
+            cancelled += 1
+        if action == 'unknown':
+            unconfirmed.append(task_id)
+    
+    dispatcher.wake()
+    summary = batch_summary(batch_id)
+    summary['cancelled'] = cancelled
+    summary['unconfirmed'] = unconfirmed
+    return jsonify(summary)
+
+def submit_task(task, backend):
+    """將排隊中的任務提交到指定的ComfyUI後端並轉為processing（僅由調度器呼叫）
+    
+    失敗一律經由 fail_task：推送 task_failed、釋放跟隨任務並喚醒調度器
+    """
+    task_id = task['task_id']
+    generation_mode = task.get('generation_mode', 'single')
     try:
-        # 建立工作流程
-        workflow = create_workflow(prompt, image_filename, width, height, duration)
-        
-        # 提交到ComfyUI
-        result = comfyui_client.queue_prompt(workflow)
-        if not result:
-            db.update_task_status(task_id, 'failed', error_message='ComfyUI連接失敗')
+        template = workflows.get(generation_mode)
+        if not template:
+            fail_task(task_id, f'找不到工作流程模板: {generation_mode}')
             return False
         
-        prompt_id = result.get('prompt_id')
-        if not prompt_id:
-            db.update_task_status(task_id, 'failed', error_message='提交任務失敗')
-            return False
+        # 將輸入圖片傳送到該後端（共用目錄複製或 /upload/image 上傳），工作流程只引用雜湊檔名
+        input_filenames = [task['image_filename'], task['second_image_filename']][:len(template.image_params)]
+        comfyui_filenames = []
+        for filename in input_filenames:
+            comfyui_filename = backend.stage_input(filename)
+            if not comfyui_filename:
+                fail_task(task_id, '上傳圖片到ComfyUI失敗')
+                return False
+            comfyui_filenames.append(comfyui_filename)
         
-        # 更新狀態為processing
-        db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id)
+        # 以編譯好的模板產生工作流程，只複製被修改的節點
+        workflow = template.render(
+            prompt=task['prompt'],
+            width=task['width'],
+            height=task['height'],
+            duration=task['duration'],
+            seed=task.get('seed'),
+            filename_prefix=output_prefix(task_id),
+            **dict(zip(template.image_params, comfyui_filenames))
+        )
         
-        # 啟動監控線程
-        monitor_thread = threading.Thread(target=monitor_task, args=(task_id, prompt_id))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        # 先記錄 prompt_id 與租約再提交：提交途中進程中斷時，重啟後仍能以 prompt_id 向 ComfyUI 查詢，不會重複執行
+        prompt_id = str(uuid.uuid4())
+        if not db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id, comfyui_backend=backend.name,
+                                     lease_owner=INSTANCE_ID, lease_expires_at=time.time() + TASK_LEASE_SECONDS):
+            return False  # 任務已被刪除
         
-        print(f"Task {task_id} started processing with prompt_id {prompt_id}")
-        return True
-        
-    except Exception as e:
-        print(f"Error starting task processing: {e}")
-        db.update_task_status(task_id, 'failed', error_message=f'啟動處理失敗: {str(e)}')
-        return False
-
-def start_task_processing_first_last_internal(task_id, prompt, first_image_filename, last_image_filename, width, height, duration, generation_mode='first_last'):
-    """內部使用的開始處理首尾幀任務函數（不返回Flask響應）"""
-    try:
-        # 建立首尾幀工作流程
-        workflow = create_first_last_workflow(prompt, first_image_filename, last_image_filename, width, height, duration)
+        # 登記到該後端的事件監聽器，由 WebSocket 事件通知完成
+        backend.listener.watch(prompt_id, task_id)
         
         # 提交到ComfyUI
-        result = comfyui_client.queue_prompt(workflow)
-        if not result:
-            db.update_task_status(task_id, 'failed', error_message='ComfyUI連接失敗')
+        result = backend.client.queue_prompt(workflow, COMFYUI_CLIENT_ID, prompt_id)
+        if not result or not result.get('prompt_id'):
+            backend.listener.claim(prompt_id)
+            backend.forget_inputs(comfyui_filenames)
+            fail_task(task_id, 'ComfyUI連接失敗' if not result else '提交任務失敗')
+            backend.listener.release(prompt_id)
             return False
         
-        prompt_id = result.get('prompt_id')
-        if not prompt_id:
-            db.update_task_status(task_id, 'failed', error_message='提交任務失敗')
-            return False
+        if result['prompt_id'] != prompt_id:
+            # 舊版 ComfyUI 不接受指定的 prompt_id
+            backend.listener.claim(prompt_id)
+            backend.listener.release(prompt_id)
+            prompt_id = result['prompt_id']
+            backend.listener.watch(prompt_id, task_id)
+            db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id)
         
-        # 更新狀態為processing
-        db.update_task_status(task_id, 'processing', comfyui_prompt_id=prompt_id)
-        
-        # 啟動監控線程
-        monitor_thread = threading.Thread(target=monitor_task, args=(task_id, prompt_id))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        # 提交途中任務被取消或刪除時撤回
+        current = db.get_task(task_id)
+        if not current or current['status'] != 'processing':
+            stop_comfyui_prompt({'task_id': task_id, 'comfyui_prompt_id': prompt_id, 'comfyui_backend': backend.name})
+            return True
         
-        print(f"First-last task {task_id} started processing with prompt_id {prompt_id}")
+        print(f"Task {task_id} (mode: {generation_mode}) started processing on {backend.name} with prompt_id {prompt_id}")
         return True
-        
+    
     except Exception as e:
-        print(f"Error starting first_last task processing: {e}")
-        db.update_task_status(task_id, 'failed', error_message=f'啟動處理失敗: {str(e)}')
+        print(f"Error starting task processing: {e}")
+        fail_task(task_id, f'啟動處理失敗: {str(e)}')
         return False
 
-def calculate_estimated_wait_time(pending_tasks, processing_tasks):
-    """計算預估等待時間"""
-    # 處理時間常數（分鐘）
-    PROCESSING_TIME = {
-        81: 4,   # 5秒影片需要4分鐘
-        129: 7   # 8秒影片需要7分鐘
+def forecast_queue(quote=None):
+    """以學習的處理時間與調度順序預估處理中與排隊任務的開始、完成時間
+    
+    quote 為假設現在提交的任務（task_id 為 None，不寫入資料庫），用於報價；
+    回傳 ({task_id: 預估}, 排隊任務的預定派送順序, {後端: 清空排隊所需秒數})
+    """
+    now = time.time()
+    pending = db.get_dispatch_candidates()
+    for task in pending:
+        task['submitted'] = parse_timestamp(task['created_at'])
+    if quote:
+        pending.append(dict(quote, id=float('inf'), task_id=None, submitted=now))
+    order = scheduler.order(pending, db.get_running_by_client(), now)
+    
+    # 各後端的處理中任務依派送先後排列，第一個為正在執行的任務
+    running = {}
+    for task in sorted(db.get_all_tasks(limit=-1, status='processing'), key=lambda task: task['id']):
+        running.setdefault(backend_pool.get(task.get('comfyui_backend')).name, []).append(task)
+    backends = [backend.name for backend in backend_pool.backends if backend.healthy] or \
+               [backend.name for backend in backend_pool.backends]
+    
+    estimates, drain = estimate_queue(eta_model, order, running, backends, now)
+    return estimates, order, drain
+
+def format_estimate(estimate, now=None):
+    """預估結果轉為 API 格式"""
+    now = now or time.time()
+    return {
+        'wait_seconds': round(estimate['wait_seconds']),
+        'processing_seconds': round(estimate['finish_seconds'] - estimate['wait_seconds']),
+        'estimated_start': datetime.fromtimestamp(now + estimate['wait_seconds']).isoformat(timespec='seconds'),
+        'estimated_completion': datetime.fromtimestamp(now + estimate['finish_seconds']).isoformat(timespec='seconds'),
+        'backend': estimate['backend']
     }
+
+class TaskDispatcher:
+    """調度迴圈：唯一負責 pending → processing 轉換，讓 ComfyUI 佇列中維持 depth 個任務"""
     
-    total_wait_time = 0
+    def __init__(self, depth, poll_interval=10):
+        self.depth = max(1, depth)
+        self.poll_interval = poll_interval
+        self._wake_event = threading.Event()
+        self._thread = None
     
-    # 計算當前處理中任務的剩餘時間
-    if processing_tasks:
-        current_task = processing_tasks[0]
-        duration = current_task.get('duration', 81)
-        processing_time = PROCESSING_TIME.get(duration, 4)
-        
-        # 計算已處理時間
-        if current_task.get('started_at'):
+    def wake(self):
+        """通知調度器有新任務或空出的名額"""
+        self._wake_event.set()
+    
+    def start(self):
+        """啟動背景調度線程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            self._wake_event.wait(timeout=self.poll_interval)
+            self._wake_event.clear()
             try:
-                started_time = datetime.fromisoformat(current_task['started_at'].replace('Z', '+00:00'))
-                elapsed_minutes = (datetime.now() - started_time).total_seconds() / 60
-                remaining_time = max(0, processing_time - elapsed_minutes)
-                total_wait_time += remaining_time
-            except:
-                # 如果無法解析時間，使用預設剩餘時間
-                total_wait_time += processing_time / 2  # 假設已處理一半
-        else:
-            total_wait_time += processing_time
-    
-    # 為每個排隊任務添加等待時間
-    wait_times = []
-    for i, task in enumerate(pending_tasks):
-        duration = task.get('duration', 81)
-        task_processing_time = PROCESSING_TIME.get(duration, 4)
-        
-        # 當前任務的等待時間 = 前面所有任務的處理時間總和
-        task_wait_time = total_wait_time
-        wait_times.append({
-            'task_id': task['task_id'],
-            'wait_time_minutes': round(task_wait_time, 1)
-        })
-        
-        # 累加這個任務的處理時間到總等待時間
-        total_wait_time += task_processing_time
+                self.dispatch_pending()
+            except Exception as e:
+                print(f"Error dispatching tasks: {e}")
     
-    return wait_times
-
-def process_next_task():
-    """處理下一個排隊中的任務"""
-    try:
-        with app.app_context():
-            # 獲取最早的pending任務
-            pending_tasks = db.get_all_tasks(status='pending', limit=1)
+    def next_task(self):
+        """依優先級、客戶端公平分配與短任務優先挑出下一個排隊任務（見 scheduler.py）"""
+        candidates = db.get_dispatch_candidates()
+        if not candidates:
+            return None
+        for candidate in candidates:
+            candidate['submitted'] = parse_timestamp(candidate['created_at'])
+        choice = scheduler.pick(candidates, db.get_running_by_client(), time.time())
+        return db.get_task(choice['task_id'])
+    
+    def dispatch_pending(self):
+        """補滿各後端的 ComfyUI 佇列直到達到派送深度"""
+        while True:
+            task = self.next_task()
+            if not task:
+                return
             
-            if pending_tasks:
-                task = pending_tasks[0]
-                task_id = task['task_id']
-                generation_mode = task.get('generation_mode', 'single')
-                
-                print(f"Starting next task: {task_id} (mode: {generation_mode})")
-                
-                if generation_mode == 'first_last':
-                    # 首尾幀模式
-                    success = start_task_processing_first_last_internal(
-                        task_id,
-                        task['prompt'],
-                        task['image_filename'],  # 首幀圖片
-                        task['second_image_filename'],  # 尾幀圖片
-                        task['width'],
-                        task['height'],
-                        task['duration'],
-                        generation_mode
-                    )
-                else:
-                    # 單圖模式
-                    success = start_task_processing_internal(
-                        task_id,
-                        task['prompt'],
-                        task['image_filename'],
-                        task['width'],
-                        task['height'],
-                        task['duration']
-                    )
-                
-                if success:
-                    print(f"Successfully started processing task {task_id}")
-                else:
-                    print(f"Failed to start processing task {task_id}")
+            # 沒有記錄後端的舊任務算在預設後端上
+            inflight = {}
+            for name, count in db.get_backend_load().items():
+                name = backend_pool.get(name).name
+                inflight[name] = inflight.get(name, 0) + count
             
-    except Exception as e:
-        print(f"Error processing next task: {e}")
+            queue_snapshot.get(max_age=QUEUE_SNAPSHOT_TTL)
+            backend = backend_pool.pick(inflight, self.depth)
+            if not backend:
+                return
+            
+            submitted = submit_task(task, backend)
+            # 佇列深度已改變，下一輪派送前重新抓取
+            queue_snapshot.invalidate()
+            if submitted:
+                print(f"Successfully started processing task {task['task_id']}")
+            else:
+                # 失敗通知與跟隨任務已由 submit_task 經 fail_task 處理
+                print(f"Failed to start processing task {task['task_id']}")
+
+scheduler = Scheduler(aging_seconds=SCHEDULER_AGING_SECONDS)
+dispatcher = TaskDispatcher(DISPATCH_DEPTH)
+
+# 處理時間模型：以最近完成的任務建立，之後每完成一個任務更新一次；舊資料沒有記錄後端時算在預設後端上
+eta_model = DurationModel(window=ETA_WINDOW)
+eta_history = db.get_processing_history(ETA_HISTORY)
+for row in eta_history:
+    row['comfyui_backend'] = backend_pool.get(row['comfyui_backend']).name
+print(f"[ETA] Loaded {eta_model.load(eta_history)} completed task(s) into the processing time model")
 
 @app.route('/api/task/<task_id>')
 def get_task_status(task_id):
@@ -900,17 +2387,74 @@ def get_task_status(task_id):
         return jsonify({'error': '任務不存在'}), 404
     return jsonify(task)
 
+@app.route('/api/task/<task_id>/eta')
+def get_task_eta(task_id):
+    """任務的預估開始與完成時間；跟隨任務沿用領頭任務的預估"""
+    task = db.get_task(task_id)
+    if not task:
+        return jsonify({'error': '任務不存在'}), 404
+    if task['status'] not in ('pending', 'processing'):
+        return jsonify({'task_id': task_id, 'status': task['status'], 'eta': None})
+    
+    estimates, order, _ = forecast_queue()
+    estimate = estimates.get(task.get('leader_task_id') or task_id)
+    position = next((index + 1 for index, item in enumerate(order) if item['task_id'] == (task.get('leader_task_id') or task_id)), None)
+    return jsonify({
+        'task_id': task_id,
+        'status': task['status'],
+        'position': position,
+        'eta': format_estimate(estimate) if estimate else None
+    })
+
+@app.route('/api/eta')
+def get_eta_quote():
+    """排隊預估：現在提交一個任務（mode、width、height、duration、priority、client_id 查詢參數）的等待與完成時間"""
+    template = workflows.get(request.args.get('mode', 'single'))
+    if not template:
+        return jsonify({'error': '無效的生成模式'}), 400
+    try:
+        quote = {
+            'generation_mode': template.name,
+            'width': int(request.args.get('width', 480)),
+            'height': int(request.args.get('height', 832)),
+            'duration': int(request.args.get('duration', 81)),
+            'priority': parse_priority(request.args.get('priority')),
+            'client_id': request_client_id()
+        }
+    except ValueError:
+        return jsonify({'error': f"寬度、高度、幀數必須是整數，優先級必須是 {'、'.join(PRIORITY_CLASSES)} 之一"}), 400
+    
+    now = time.time()
+    estimates, order, drain = forecast_queue(quote)
+    position = next(index + 1 for index, item in enumerate(order) if item['task_id'] is None)
+    return jsonify({
+        'quote': dict(format_estimate(estimates[None], now), position=position),
+        'pending': len(order) - 1,
+        'backends': {name: round(seconds) for name, seconds in drain.items()},
+        'model': eta_model.snapshot()
+    })
+
+@app.route('/api/workflows')
+def list_workflows():
+    """列出可用的工作流程模板（生成模式）與其參數"""
+    return jsonify({'workflows': [template.describe() for template in workflows.all()]})
+
 @app.route('/api/queue')
 def get_queue_status_api():
     """獲取排隊狀態API"""
     local_queue = db.get_queue_status()
-    comfyui_queue = comfyui_client.get_queue_status()
+    comfyui_queue = queue_snapshot.get()
     
     return jsonify({
         'local_queue': local_queue,
         'comfyui_queue': comfyui_queue
     })
 
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus 文字格式的指標"""
+    return metrics.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """下載檔案"""
@@ -945,87 +2489,135 @@ def serve_input_image(filename):
 
 @app.route('/api/recover-stuck-tasks', methods=['POST'])
 def recover_stuck_tasks():
-    """手動恢復卡住的任務API"""
+    """手動恢復卡住的任務API：不論租約，先依 prompt_id 向 ComfyUI 對帳，查不到記錄的再由輸出目錄索引找影片"""
     try:
-        # 查找處理中的任務
-        processing_tasks = db.get_all_tasks(status='processing')
-        recovered_count = 0
+        summary = reconcile_processing_tasks(force=True)
+        recovered_count = summary['completed'] + summary['failed'] + summary['requeued']
+        
+        # 對帳後仍在處理中的任務
+        processing_tasks = db.get_all_tasks(status='processing', limit=-1)
         
         for task in processing_tasks:
             task_id = task['task_id']
             
-            # 查找ComfyUI輸出目錄中最新的文件
+            # 由輸出目錄索引以 task_id 查詢該任務的影片，不再猜測最新的檔案
             try:
-                comfyui_output_dir = COMFYUI_OUTPUT_DIR
-                if os.path.exists(comfyui_output_dir):
-                    # 獲取所有wan22開頭的mp4文件，按修改時間排序
-                    output_files = []
-                    for filename in os.listdir(comfyui_output_dir):
-                        if filename.startswith('wan22__') and filename.endswith('.mp4'):
-                            filepath = os.path.join(comfyui_output_dir, filename)
-                            mtime = os.path.getmtime(filepath)
-                            output_files.append((filename, mtime, filepath))
+                backend = backend_pool.get(task.get('comfyui_backend'))
+                video_filename = backend.output_index.lookup(task_id) if backend.output_index else None
+                if video_filename:
+                    # 取走監聽登記，之後的完成事件不會再處理一次；已被取走表示其他路徑正在完成這個任務
+                    if task.get('comfyui_prompt_id') and not backend.listener.claim(task['comfyui_prompt_id']):
+                        continue
                     
-                    # 按修改時間排序，最新的在前
-                    output_files.sort(key=lambda x: x[1], reverse=True)
+                    # 檢查是否已經有對應的輸出文件
+                    expected_output = f"{task_id}_{video_filename}"
+                    output_path = f"/app/output/{expected_output}"
                     
-                    if output_files:
-                        # 檢查是否已經有對應的輸出文件
-                        expected_output = f"{task_id}_{output_files[0][0]}"
-                        output_path = f"/app/output/{expected_output}"
-                        
+                    try:
                         if not os.path.exists(output_path):
-                            # 複製最新的文件
-                            latest_file = output_files[0]
-                            shutil.copy2(latest_file[2], output_path)
-                        
-                        # 生成縮圖
-                        thumbnail_filename = f"{task_id}_thumb.jpg"
-                        thumbnail_path = f"/app/thumbnails/{thumbnail_filename}"
-                        generate_thumbnail(output_path, thumbnail_path)
+                            link_or_copy(os.path.join(backend.output_dir, video_filename), output_path)
                         
                         # 更新資料庫
-                        db.update_task_status(
-                            task_id, 
-                            'completed',
-                            output_filename=expected_output,
-                            thumbnail_filename=thumbnail_filename
-                        )
-                        
-                        # 發送WebSocket通知
-                        socketio.emit('task_completed', {
-                            'task_id': task_id,
-                            'status': 'completed',
-                            'output_filename': expected_output,
-                            'thumbnail_filename': thumbnail_filename
-                        })
-                        
-                        recovered_count += 1
-                        
+                        completed = db.update_task_status(task_id, 'completed', output_filename=expected_output)
+                    finally:
+                        if task.get('comfyui_prompt_id'):
+                            backend.listener.release(task['comfyui_prompt_id'])
+                    if not completed:
+                        continue
+                    
+                    # 發送WebSocket通知
+                    socketio.emit('task_completed', {
+                        'task_id': task_id,
+                        'status': 'completed',
+                        'output_filename': expected_output
+                    })
+                    
+                    # 跟隨任務共用影片，並在背景生成縮圖
+                    finish_followers(task_id, output_path)
+                    schedule_media(task_id, output_path)
+                    
+                    recovered_count += 1
+            
             except Exception as e:
                 print(f"Error recovering task {task_id}: {e}")
         
         return jsonify({
             'success': True,
             'message': f'已恢復 {recovered_count} 個卡住的任務',
-            'recovered_count': recovered_count
+            'recovered_count': recovered_count,
+            'reconciled': summary
         })
-        
+    
     except Exception as e:
         print(f"Error in recover_stuck_tasks: {e}")
         return jsonify({'error': f'恢復失敗: {str(e)}'}), 500
 
+@app.route('/api/task/<task_id>/cancel', methods=['POST'])
+def cancel_task_api(task_id):
+    """取消任務API：排隊中的直接取消，處理中的從 ComfyUI 佇列移除或中斷執行"""
+    task = db.get_task(task_id)
+    if not task:
+        return jsonify({'error': '任務不存在'}), 404
+    if task['status'] not in ('pending', 'processing'):
+        return jsonify({'error': '任務已結束，無法取消'}), 409
+    
+    action = cancel_task(task)
+    if action is False:
+        return jsonify({'error': '任務已結束，無法取消'}), 409
+    return jsonify({
+        'success': True,
+        'message': '任務已取消，但無法確認 ComfyUI 已停止處理' if action == 'unknown' else '任務已取消',
+        'task_id': task_id,
+        'status': 'cancelled',
+        'comfyui': action
+    })
+
+@app.route('/api/task/<task_id>/preempt', methods=['POST'])
+def preempt_task_api(task_id):
+    """搶佔任務API：中斷處理中的任務並放回排隊，讓出 GPU 給更高優先級的任務"""
+    task = db.get_task(task_id)
+    if not task:
+        return jsonify({'error': '任務不存在'}), 404
+    if task['status'] != 'processing':
+        return jsonify({'error': '只能搶佔處理中的任務'}), 409
+    
+    action = cancel_task(task, requeue=True)
+    if action is False:
+        return jsonify({'error': '任務已結束，無法搶佔'}), 409
+    return jsonify({
+        'success': True,
+        'message': '任務已重新排隊，但無法確認 ComfyUI 已停止處理' if action == 'unknown' else '任務已中斷並重新排隊',
+        'task_id': task_id,
+        'status': 'pending',
+        'comfyui': action
+    })
+
 @app.route('/api/delete/<task_id>', methods=['DELETE'])
 def delete_task(task_id):
     """刪除任務API"""
     try:
-        # 從資料庫獲取任務資訊並刪除記錄
-        task = db.delete_task(task_id)
+        # 處理中的任務先停止 ComfyUI 上的工作，不留下沒人要的生成
+        task = db.get_task(task_id)
+        if task and task['status'] == 'processing':
+            stop_comfyui_prompt(task)
+        
+        # 從資料庫獲取任務資訊並刪除記錄，同時刪除已無任務引用的輸入圖片
+        with input_store.lock:
+            task = db.delete_task(task_id)
+            freed_inputs = input_store.remove(task['freed_inputs']) if task else []
         
         if not task:
             return jsonify({'error': '任務不存在'}), 404
         
-        deleted_files = []
+        # 刪除的是尚未完成的領頭任務時，跟隨任務改由其中一個自行派送
+        if task['status'] in ('pending', 'processing') and not task.get('leader_task_id'):
+            finish_followers(task_id)
+        
+        # 空出派送名額
+        if task['status'] == 'processing':
+            dispatcher.wake()
+        
+        deleted_files = list(freed_inputs)
         
         # 刪除輸出影片檔案
         if task.get('output_filename'):
@@ -1037,22 +2629,15 @@ def delete_task(task_id):
                 except Exception as e:
                     print(f"Error deleting output file {output_path}: {e}")
         
-        # 刪除縮圖檔案
-        if task.get('thumbnail_filename'):
-            thumbnail_path = f"/app/thumbnails/{task['thumbnail_filename']}"
-            if os.path.exists(thumbnail_path):
-                try:
-                    os.remove(thumbnail_path)
-                    deleted_files.append(task['thumbnail_filename'])
-                except Exception as e:
-                    print(f"Error deleting thumbnail file {thumbnail_path}: {e}")
+        # 刪除縮圖與預覽動圖檔案
+        deleted_files.extend(remove_media_files(task_id, task.get('thumbnail_filename')))
         
         return jsonify({
             'success': True,
             'message': '任務已刪除',
             'deleted_files': deleted_files
         })
-        
+    
     except Exception as e:
         print(f"Error deleting task {task_id}: {e}")
         return jsonify({'error': f'刪除失敗: {str(e)}'}), 500
@@ -1061,12 +2646,44 @@ def delete_task(task_id):
 def handle_connect():
     """WebSocket連接"""
     print('Client connected')
+    SOCKETIO_CLIENTS.inc()
     emit('connected', {'message': '已連接到伺服器'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """WebSocket斷開連接"""
     print('Client disconnected')
+    SOCKETIO_CLIENTS.dec()
+
+@socketio.on('subscribe_task')
+def handle_subscribe_task(data):
+    """加入任務房間，接收該任務的 task_progress 事件"""
+    task_id = (data or {}).get('task_id')
+    if task_id:
+        join_room(task_id)
+
+@socketio.on('unsubscribe_task')
+def handle_unsubscribe_task(data):
+    """離開任務房間"""
+    task_id = (data or {}).get('task_id')
+    if task_id:
+        leave_room(task_id)
+
+@socketio.on('subscribe_batch')
+def handle_subscribe_batch(data):
+    """加入批次房間，立即收到目前的彙總，之後接收 batch_progress 事件"""
+    batch_id = (data or {}).get('batch_id')
+    if batch_id:
+        join_room(f"batch:{batch_id}")
+        emit('batch_progress', batch_summary(batch_id))
+        batch_progress.watch(batch_id)
+
+@socketio.on('unsubscribe_batch')
+def handle_unsubscribe_batch(data):
+    """離開批次房間"""
+    batch_id = (data or {}).get('batch_id')
+    if batch_id:
+        leave_room(f"batch:{batch_id}")
 
 if __name__ == '__main__':
     # 確保目錄存在
@@ -1075,5 +2692,21 @@ if __name__ == '__main__':
     os.makedirs('/app/thumbnails', exist_ok=True)
     os.makedirs('/app/database', exist_ok=True)
     
+    # 預先建立工作進程
+    media_pool.start()
+    if PREPROCESS_UPLOADS:
+        preprocess_pool.start()
+    
+    # 啟動 ComfyUI 事件監聽、對帳與調度線程
+    backend_pool.start()
+    threading.Thread(target=reconcile_loop, daemon=True).start()
+    threading.Thread(target=lease_heartbeat_loop, daemon=True).start()
+    threading.Thread(target=queue_snapshot.run_forever, args=(QUEUE_SNAPSHOT_INTERVAL,), daemon=True).start()
+    threading.Thread(target=batch_progress.run_forever, daemon=True).start()
+    dispatcher.start()
+    
+    # 停止時釋放租約
+    signal.signal(signal.SIGTERM, release_leases_and_exit)
+    
     # 啟動應用
     socketio.run(app, host='0.0.0.0', port=5005, debug=False, allow_unsafe_werkzeug=True)
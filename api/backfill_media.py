@@ -0,0 +1,159 @@
+"""重建已完成任務的縮圖與預覽動圖
+
+掃描 task_history 中已完成的任務，以多進程並行補齊缺少、過期或損壞的衍生媒體。
+輸出以暫存檔寫入後再換名，中斷後重新執行即可接續：已是最新的檔案會被跳過。
+
+用法（容器內）：
+    python backfill_media.py                 # 補齊缺少或比影片舊的檔案
+    python backfill_media.py --verify        # 另外解碼檢查既有檔案是否損壞
+    python backfill_media.py --force         # 全部重建（例如調整了縮圖品質）
+    python backfill_media.py --task <task_id> --dry-run
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotenv import load_dotenv
+from PIL import Image
+from database import Database
+from media import generate_media, has_preview, media_filenames, preview_filename
+
+load_dotenv()
+
+# 暫存檔超過這個時間（秒）沒有更新才視為中斷殘留；較新的可能正由執行中的 app 寫入
+PARTIAL_MAX_AGE = 600
+
+def is_fresh(path, source_mtime, verify=False):
+    """輸出檔存在、非空、不比來源影片舊；verify 時另外以 Pillow 檢查檔案完整性"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if stat.st_size == 0 or stat.st_mtime < source_mtime:
+        return False
+    if verify:
+        try:
+            with Image.open(path) as image:
+                image.verify()
+        except Exception:
+            return False
+    return True
+
+def needs_rebuild(task, output_dir, thumbnail_dir, verify=False):
+    """判斷任務的衍生媒體是否需要重建；回傳 (影片路徑, 是否需要)，影片不存在時路徑為 None"""
+    video_path = os.path.join(output_dir, task['output_filename'])
+    try:
+        source_mtime = os.path.getmtime(video_path)
+    except FileNotFoundError:
+        return None, False
+    
+    preview = preview_filename(task['task_id'])
+    for filename in media_filenames(task['task_id']):
+        if filename != preview and not is_fresh(os.path.join(thumbnail_dir, filename), source_mtime, verify):
+            return video_path, True
+    
+    # 舊任務沒有預覽動圖欄位，視為需要重建；單一影格的影片不會有預覽動圖，縮圖齊全即可，否則每次執行都會重建
+    if task.get('preview_filename') != preview or not is_fresh(os.path.join(thumbnail_dir, preview), source_mtime, verify):
+        return video_path, has_preview(video_path)
+    return video_path, False
+
+def iter_completed_tasks(db, batch_size=500):
+    """以 keyset 分頁逐批讀取已完成任務，不一次載入整個歷史"""
+    cursor = None
+    while True:
+        tasks, has_more = db.get_tasks_page(batch_size, status='completed', after=cursor)
+        for task in tasks:
+            yield task
+        if not has_more or not tasks:
+            return
+        cursor = (tasks[-1]['created_at'], tasks[-1]['id'])
+
+def remove_partial_files(thumbnail_dir, max_age=PARTIAL_MAX_AGE):
+    """清除上次中斷留下的暫存檔；只刪除超過 max_age 秒未更新的，不影響 app 正在寫入的檔案"""
+    removed = 0
+    cutoff = time.time() - max_age
+    for entry in os.scandir(thumbnail_dir):
+        if not entry.name.endswith('.part'):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass  # 寫入完成已換名
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description='重建已完成任務的縮圖與預覽動圖')
+    parser.add_argument('--database', default=os.getenv('DATABASE_PATH', '/app/database/history.db'), help='SQLite 資料庫路徑')
+    parser.add_argument('--output-dir', default='/app/output', help='影片目錄')
+    parser.add_argument('--thumbnail-dir', default='/app/thumbnails', help='縮圖目錄')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='工作進程數（預設為 CPU 核心數）')
+    parser.add_argument('--task', action='append', default=[], help='只處理指定任務（可重複）')
+    parser.add_argument('--force', action='store_true', help='忽略既有檔案，全部重建')
+    parser.add_argument('--verify', action='store_true', help='解碼檢查既有檔案，損壞時重建')
+    parser.add_argument('--dry-run', action='store_true', help='只列出需要重建的任務')
+    args = parser.parse_args()
+    
+    os.makedirs(args.thumbnail_dir, exist_ok=True)
+    removed = remove_partial_files(args.thumbnail_dir)
+    if removed:
+        print(f"已清除 {removed} 個超過 {PARTIAL_MAX_AGE // 60} 分鐘未更新的暫存檔")
+    
+    db = Database(args.database)
+    if args.task:
+        tasks = [task for task in (db.get_task(task_id) for task_id in args.task) if task]
+        tasks = [task for task in tasks if task['status'] == 'completed' and task.get('output_filename')]
+    else:
+        tasks = (task for task in iter_completed_tasks(db) if task.get('output_filename'))
+    
+    # 先挑出需要重建的任務；檢查只看檔案時間與大小，很便宜
+    pending = []
+    scanned = missing_video = 0
+    for task in tasks:
+        scanned += 1
+        video_path, rebuild = needs_rebuild(task, args.output_dir, args.thumbnail_dir, args.verify)
+        if video_path is None:
+            missing_video += 1
+        elif rebuild or args.force:
+            pending.append((task['task_id'], video_path))
+    
+    print(f"掃描 {scanned} 個已完成任務：{len(pending)} 個需要重建，{missing_video} 個找不到影片")
+    if args.dry_run:
+        for task_id, video_path in pending:
+            print(f"  {task_id}  {video_path}")
+        return
+    if not pending:
+        return
+    
+    start = time.monotonic()
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {
+            pool.submit(generate_media, video_path, args.thumbnail_dir, task_id): task_id
+            for task_id, video_path in pending
+        }
+        for future in as_completed(futures):
+            task_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = None
+                print(f"Error generating media for {task_id}: {e}")
+            
+            if result:
+                # 每完成一個就寫回，資料庫記錄與檔案保持一致，中斷也不會遺失進度
+                db.update_task_media(task_id, result['thumbnail_filename'], result['preview_filename'])
+                done += 1
+            else:
+                failed += 1
+            
+            finished = done + failed
+            if finished % 50 == 0 or finished == len(pending):
+                elapsed = time.monotonic() - start
+                print(f"[{finished}/{len(pending)}] 成功 {done}，失敗 {failed}，{finished / elapsed:.1f} 個/秒")
+    
+    print(f"完成：重建 {done} 個任務，失敗 {failed} 個，耗時 {time.monotonic() - start:.1f} 秒")
+
+if __name__ == '__main__':
+    main()
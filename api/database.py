@@ -1,18 +1,122 @@
 import sqlite3
 import os
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 import json
 
+# 任務狀態轉換：目標狀態 → 允許的來源狀態；來源不符的更新不生效（例如已完成的任務不會再被標記為失敗）
+TASK_TRANSITIONS = {
+    'pending': ('processing',),               # ComfyUI 已沒有這個 prompt（例如 ComfyUI 重啟清空佇列）時重新排隊
+    'processing': ('pending', 'processing'),  # processing → processing 為開始執行時重設 started_at
+    'completed': ('pending', 'processing'),   # pending → completed 為跟隨任務共用領頭任務的影片
+    'failed': ('pending', 'processing'),
+    'cancelled': ('pending', 'processing')
+}
+
+def short_grams(text):
+    """單字與雙字詞索引的內容：文字中每個字元與相鄰兩個字元，以空白分隔
+    
+    trigram 無法查詢 1~2 個字的詞（中文常見，例如「貓」、「女孩」），改以這份內容建立的索引查詢；
+    含空白或標點的組合不收錄，這類短詞由呼叫端退回 LIKE
+    """
+    text = (text or '').lower()
+    grams = dict.fromkeys(c for c in text if c.isalnum())
+    grams.update(dict.fromkeys(a + b for a, b in zip(text, text[1:]) if (a + b).isalnum()))
+    return ' '.join(grams)
+
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, busy_timeout=30, pool_size=8, write_batch_size=64):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.write_batch_size = write_batch_size
+        # 讀取用連線池；Flask 每個請求都在新線程上，不適合 thread-local 連線
+        self._pool = queue.Queue(maxsize=pool_size)
+        # 所有寫入都交給單一寫入線程，依序（可批次）在同一個交易中執行
+        self._write_queue = queue.Queue()
         self.init_database()
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+    
+    def _connect(self):
+        """建立連線並套用 WAL、synchronous=NORMAL 與 busy timeout"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # 單字/雙字詞索引的觸發器會呼叫
+        conn.create_function('short_grams', 1, short_grams, deterministic=True)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        return conn
+    
+    @contextmanager
+    def _read(self):
+        """從連線池借出讀取連線"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def _write(self, fn):
+        """將寫入函數交給寫入線程執行並等待結果；fn 接收連線並回傳結果"""
+        future = Future()
+        self._write_queue.put((fn, future))
+        return future.result()
+    
+    def _writer_loop(self):
+        """單一寫入線程：一次取出多筆寫入，在同一個交易中執行，每筆以 SAVEPOINT 隔離錯誤"""
+        conn = self._connect()
+        conn.isolation_level = None  # 自行管理交易
+        while True:
+            batch = [self._write_queue.get()]
+            while len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            results = []
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for fn, future in batch:
+                    conn.execute('SAVEPOINT write_item')
+                    try:
+                        results.append((future, fn(conn), None))
+                        conn.execute('RELEASE SAVEPOINT write_item')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO SAVEPOINT write_item')
+                        conn.execute('RELEASE SAVEPOINT write_item')
+                        results.append((future, None, e))
+                conn.execute('COMMIT')
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                for fn, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            # 提交後才回覆，呼叫端之後的讀取一定看得到這次寫入
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
     
     def init_database(self):
         """初始化資料庫表格"""
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
-        with sqlite3.connect(self.db_path) as conn:
+        conn = self._connect()
+        try:
             cursor = conn.cursor()
             
             # 建立任務歷史表
@@ -34,7 +138,17 @@ class Database:
                     output_filename TEXT,
                     thumbnail_filename TEXT,
                     error_message TEXT,
-                    comfyui_prompt_id TEXT
+                    comfyui_prompt_id TEXT,
+                    comfyui_backend TEXT,
+                    preview_filename TEXT,
+                    seed INTEGER,
+                    request_fingerprint TEXT,
+                    leader_task_id TEXT,
+                    batch_id TEXT,
+                    priority INTEGER NOT NULL DEFAULT 1,
+                    client_id TEXT,
+                    lease_owner TEXT,
+                    lease_expires_at REAL
                 )
             ''')
             
@@ -49,68 +163,549 @@ class Database:
             except sqlite3.OperationalError:
                 pass  # 欄位已存在
             
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN comfyui_backend TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN preview_filename TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN seed INTEGER')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN request_fingerprint TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN leader_task_id TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN batch_id TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN priority INTEGER NOT NULL DEFAULT 1')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN client_id TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            # 處理中任務的租約：持有者（進程）與到期時間（epoch 秒），持有者定期續約
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN lease_owner TEXT')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
+            try:
+                cursor.execute('ALTER TABLE task_history ADD COLUMN lease_expires_at REAL')
+            except sqlite3.OperationalError:
+                pass  # 欄位已存在
+            
             # 建立索引
+            # (status, created_at, id) 與 (created_at, id) 對應歷史頁的篩選與排序，
+            # 可直接沿索引做 keyset 分頁；單欄的 status / created_at 索引是其前綴，已不需要
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_id ON task_history(task_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_status ON task_history(status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON task_history(created_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_status_created_at ON task_history(status, created_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_created_at_id ON task_history(created_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_request_fingerprint ON task_history(request_fingerprint, status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_leader_task_id ON task_history(leader_task_id) WHERE leader_task_id IS NOT NULL')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_batch_id ON task_history(batch_id, status) WHERE batch_id IS NOT NULL')
+            cursor.execute('DROP INDEX IF EXISTS idx_status')
+            cursor.execute('DROP INDEX IF EXISTS idx_created_at')
             
-            conn.commit()
-    
-    def add_task(self, task_id, prompt, image_filename, width, height, duration, generation_mode='single', second_image_filename=None):
-        """新增任務到資料庫"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+            # 各狀態任務數，由觸發器隨寫入增量維護，避免每次請求都 COUNT(*) 全表
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'task_status_counts'")
+            counts_exist = cursor.fetchone() is not None
             cursor.execute('''
-                INSERT INTO task_history 
-                (task_id, prompt, image_filename, second_image_filename, generation_mode, width, height, duration, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-            ''', (task_id, prompt, image_filename, second_image_filename, generation_mode, width, height, duration))
-            conn.commit()
-            return cursor.lastrowid
-    
-    def update_task_status(self, task_id, status, **kwargs):
-        """更新任務狀態"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+                CREATE TABLE IF NOT EXISTS task_status_counts (
+                    status TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if not counts_exist:
+                cursor.execute('''
+                    INSERT INTO task_status_counts (status, count)
+                    SELECT status, COUNT(*) FROM task_history GROUP BY status
+                ''')
             
-            # 建立動態更新語句
-            update_fields = ['status = ?']
-            values = [status]
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_task_counts_insert
+                AFTER INSERT ON task_history
+                BEGIN
+                    INSERT INTO task_status_counts (status, count) VALUES (NEW.status, 1)
+                    ON CONFLICT(status) DO UPDATE SET count = count + 1;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_task_counts_delete
+                AFTER DELETE ON task_history
+                BEGIN
+                    UPDATE task_status_counts SET count = count - 1 WHERE status = OLD.status;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_task_counts_update
+                AFTER UPDATE OF status ON task_history
+                WHEN OLD.status IS NOT NEW.status
+                BEGIN
+                    UPDATE task_status_counts SET count = count - 1 WHERE status = OLD.status;
+                    INSERT INTO task_status_counts (status, count) VALUES (NEW.status, 1)
+                    ON CONFLICT(status) DO UPDATE SET count = count + 1;
+                END
+            ''')
             
-            if status == 'processing':
-                update_fields.append('started_at = ?')
-                values.append(datetime.now().isoformat())
-            elif status == 'completed':
-                update_fields.append('completed_at = ?')
-                values.append(datetime.now().isoformat())
+            # 輸入圖片引用數：以內容雜湊命名的圖片可被多個任務共用，引用數歸零才刪除檔案
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'input_blobs'")
+            blobs_exist = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS input_blobs (
+                    filename TEXT PRIMARY KEY,
+                    refcount INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if not blobs_exist:
+                cursor.execute('''
+                    INSERT INTO input_blobs (filename, refcount)
+                    SELECT filename, COUNT(*) FROM (
+                        SELECT image_filename AS filename FROM task_history
+                        UNION ALL
+                        SELECT second_image_filename FROM task_history WHERE second_image_filename IS NOT NULL
+                    )
+                    GROUP BY filename
+                ''')
             
-            for key, value in kwargs.items():
-                if key in ['output_filename', 'thumbnail_filename', 'error_message', 'comfyui_prompt_id']:
-                    update_fields.append(f'{key} = ?')
-                    values.append(value)
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_input_blobs_insert
+                AFTER INSERT ON task_history
+                BEGIN
+                    INSERT INTO input_blobs (filename, refcount) VALUES (NEW.image_filename, 1)
+                    ON CONFLICT(filename) DO UPDATE SET refcount = refcount + 1;
+                    INSERT INTO input_blobs (filename, refcount)
+                    SELECT NEW.second_image_filename, 1 WHERE NEW.second_image_filename IS NOT NULL
+                    ON CONFLICT(filename) DO UPDATE SET refcount = refcount + 1;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_input_blobs_delete
+                AFTER DELETE ON task_history
+                BEGIN
+                    UPDATE input_blobs SET refcount = refcount - 1 WHERE filename = OLD.image_filename;
+                    UPDATE input_blobs SET refcount = refcount - 1 WHERE filename = OLD.second_image_filename;
+                END
+            ''')
             
-            values.append(task_id)
+            # 全文檢索：trigram 分詞不依賴空白斷詞，適合中文提示詞；以觸發器與主表同步
+            try:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'task_history_fts'")
+                fts_exist = cursor.fetchone() is not None
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS task_history_fts USING fts5(
+                        prompt, image_filename,
+                        content='task_history', content_rowid='id',
+                        tokenize='trigram'
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_fts_insert
+                    AFTER INSERT ON task_history
+                    BEGIN
+                        INSERT INTO task_history_fts (rowid, prompt, image_filename)
+                        VALUES (NEW.id, NEW.prompt, NEW.image_filename);
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_fts_delete
+                    AFTER DELETE ON task_history
+                    BEGIN
+                        INSERT INTO task_history_fts (task_history_fts, rowid, prompt, image_filename)
+                        VALUES ('delete', OLD.id, OLD.prompt, OLD.image_filename);
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_fts_update
+                    AFTER UPDATE OF prompt, image_filename ON task_history
+                    BEGIN
+                        INSERT INTO task_history_fts (task_history_fts, rowid, prompt, image_filename)
+                        VALUES ('delete', OLD.id, OLD.prompt, OLD.image_filename);
+                        INSERT INTO task_history_fts (rowid, prompt, image_filename)
+                        VALUES (NEW.id, NEW.prompt, NEW.image_filename);
+                    END
+                ''')
+                if not fts_exist:
+                    cursor.execute("INSERT INTO task_history_fts (task_history_fts) VALUES ('rebuild')")
+                
+                # 1~2 個字的詞：另建單字/雙字詞索引（rowid 與 task_history.id 相同），同樣由觸發器同步
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'task_history_grams'")
+                grams_exist = cursor.fetchone() is not None
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS task_history_grams USING fts5(
+                        grams, tokenize='unicode61 remove_diacritics 0'
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_grams_insert
+                    AFTER INSERT ON task_history
+                    BEGIN
+                        INSERT INTO task_history_grams (rowid, grams)
+                        VALUES (NEW.id, short_grams(NEW.prompt || ' ' || NEW.image_filename));
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_grams_delete
+                    AFTER DELETE ON task_history
+                    BEGIN
+                        DELETE FROM task_history_grams WHERE rowid = OLD.id;
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg_task_grams_update
+                    AFTER UPDATE OF prompt, image_filename ON task_history
+                    BEGIN
+                        UPDATE task_history_grams SET grams = short_grams(NEW.prompt || ' ' || NEW.image_filename)
+                        WHERE rowid = NEW.id;
+                    END
+                ''')
+                if not grams_exist:
+                    cursor.execute('''
+                        INSERT INTO task_history_grams (rowid, grams)
+                        SELECT id, short_grams(prompt || ' ' || image_filename) FROM task_history
+                    ''')
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # SQLite 未編入 FTS5 或版本過舊（trigram 需 3.34+），退回 LIKE 搜尋
+                print(f"全文檢索不可用，改用 LIKE 搜尋: {e}")
+                self.fts_enabled = False
             
-            cursor.execute(f'''
+            conn.commit()
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _fts_queries(search_term):
+        """將搜尋字串轉為 FTS5 查詢；以空白分隔的每個詞都必須出現
+        
+        回傳 (trigram 查詢, 單字/雙字詞查詢)，沒有對應的詞時為 None。
+        3 個字以上的詞查 trigram 索引，1~2 個字的詞查單字/雙字詞索引；短詞含標點時回傳 None，由呼叫端改用 LIKE
+        """
+        terms = search_term.split()
+        if not terms or any(len(term) < 3 and not term.isalnum() for term in terms):
+            return None
+        
+        def match(terms):
+            return ' '.join('"' + term.replace('"', '""') + '"' for term in terms) or None
+        return match([term for term in terms if len(term) >= 3]), match([term for term in terms if len(term) < 3])
+    
+    def _search_clause(self, search_term):
+        """搜尋條件，回傳 (FROM, WHERE, 參數, 片段欄位, 排序)，任務表別名為 t
+        
+        有 3 個字以上的詞時依 trigram 相關度排序並附提示詞片段；只有短詞時以單字/雙字詞索引篩選，依時間排序
+        """
+        queries = self._fts_queries(search_term) if self.fts_enabled else None
+        if not queries:
+            return ('task_history t', '(t.prompt LIKE ? OR t.image_filename LIKE ?)',
+                    [f'%{search_term}%', f'%{search_term}%'], 'NULL', 't.created_at DESC, t.id DESC')
+        
+        trigram_query, gram_query = queries
+        conditions = []
+        params = []
+        if trigram_query:
+            conditions.append('task_history_fts MATCH ?')
+            params.append(trigram_query)
+        if gram_query:
+            conditions.append('t.id IN (SELECT rowid FROM task_history_grams WHERE task_history_grams MATCH ?)')
+            params.append(gram_query)
+        
+        if trigram_query:
+            return ('task_history_fts JOIN task_history t ON t.id = task_history_fts.rowid', ' AND '.join(conditions), params,
+                    "snippet(task_history_fts, 0, char(2), char(3), '…', 24)", 'task_history_fts.rank, t.created_at DESC')
+        return 'task_history t', ' AND '.join(conditions), params, 'NULL', 't.created_at DESC, t.id DESC'
+    
+    TASK_INSERT = '''
+        INSERT INTO task_history 
+        (task_id, prompt, image_filename, second_image_filename, generation_mode, width, height, duration, status,
+         seed, request_fingerprint, output_filename, started_at, completed_at, leader_task_id, batch_id, priority, client_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    @staticmethod
+    def _task_values(task_id, prompt, image_filename, width, height, duration, generation_mode='single', second_image_filename=None,
+                     seed=None, request_fingerprint=None, output_filename=None, leader_task_id=None, batch_id=None,
+                     priority=1, client_id=None):
+        """TASK_INSERT 的參數；帶 output_filename 時（結果快取命中）直接以 completed 狀態新增"""
+        status = 'completed' if output_filename else 'pending'
+        now = datetime.now().isoformat() if output_filename else None
+        return (task_id, prompt, image_filename, second_image_filename, generation_mode, width, height, duration, status,
+                seed, request_fingerprint, output_filename, now, now, leader_task_id, batch_id, priority, client_id)
+    
+    def add_task(self, task_id, prompt, image_filename, width, height, duration, generation_mode='single', second_image_filename=None,
+                 seed=None, request_fingerprint=None, output_filename=None, leader_task_id=None, batch_id=None,
+                 priority=1, client_id=None):
+        """新增任務到資料庫；帶 output_filename 時（結果快取命中）直接以 completed 狀態新增，
+        帶 leader_task_id 時為跟隨任務：不會被派送，等待相同請求的領頭任務完成；
+        priority 越小越先派送，client_id 為提交者，供調度器公平分配"""
+        values = self._task_values(task_id, prompt, image_filename, width, height, duration, generation_mode, second_image_filename,
+                                   seed, request_fingerprint, output_filename, leader_task_id, batch_id, priority, client_id)
+        
+        def write(conn):
+            return conn.execute(self.TASK_INSERT, values).lastrowid
+        return self._write(write)
+    
+    def add_tasks(self, tasks):
+        """在同一個交易中新增多筆任務；tasks 為 add_task 參數的 dict 列表，任一筆失敗則全部不新增"""
+        rows = [self._task_values(**task) for task in tasks]
+        
+        def write(conn):
+            conn.executemany(self.TASK_INSERT, rows)
+            return len(rows)
+        return self._write(write)
+    
+    def update_task_status(self, task_id, status, **kwargs):
+        """依 TASK_TRANSITIONS 更新任務狀態；回傳是否生效（任務不存在或目前狀態不允許轉換時為 False）"""
+        # 建立動態更新語句
+        update_fields = ['status = ?']
+        values = [status]
+        
+        if status == 'processing':
+            update_fields.append('started_at = ?')
+            values.append(datetime.now().isoformat())
+        else:
+            # 離開 processing 即釋放租約
+            update_fields.extend(['lease_owner = NULL', 'lease_expires_at = NULL'])
+            if status == 'completed':
+                update_fields.append('completed_at = ?')
+                values.append(datetime.now().isoformat())
+        
+        for key, value in kwargs.items():
+            if key in ['output_filename', 'thumbnail_filename', 'error_message', 'comfyui_prompt_id', 'comfyui_backend',
+                       'lease_owner', 'lease_expires_at']:
+                update_fields.append(f'{key} = ?')
+                values.append(value)
+        
+        sources = TASK_TRANSITIONS[status]
+        values.append(task_id)
+        values.extend(sources)
+        
+        def write(conn):
+            cursor = conn.execute(f'''
                 UPDATE task_history 
                 SET {', '.join(update_fields)}
-                WHERE task_id = ?
+                WHERE task_id = ? AND status IN ({', '.join('?' * len(sources))})
             ''', values)
-            conn.commit()
+            return cursor.rowcount > 0
+        return self._write(write)
+    
+    def requeue_task(self, task_id, prompt_id):
+        """ComfyUI 已沒有任務的 prompt 時退回排隊，清除提交資訊；prompt_id 已變更（已重新提交）時不生效"""
+        def write(conn):
+            cursor = conn.execute('''
+                UPDATE task_history 
+                SET status = 'pending', comfyui_prompt_id = NULL, comfyui_backend = NULL, started_at = NULL,
+                    lease_owner = NULL, lease_expires_at = NULL
+                WHERE task_id = ? AND status = 'processing' AND comfyui_prompt_id = ?
+            ''', (task_id, prompt_id))
+            return cursor.rowcount > 0
+        return self._write(write)
+    
+    def claim_lease(self, task_id, owner, expires_at, now, force=False):
+        """取得處理中任務的租約：自己持有、沒有持有者或租約已過期時成功（force 時一律成功）"""
+        def write(conn):
+            cursor = conn.execute('''
+                UPDATE task_history 
+                SET lease_owner = ?, lease_expires_at = ?
+                WHERE task_id = ? AND status = 'processing'
+                  AND (? OR lease_owner IS NULL OR lease_owner = ? OR lease_expires_at IS NULL OR lease_expires_at < ?)
+            ''', (owner, expires_at, task_id, bool(force), owner, now))
+            return cursor.rowcount > 0
+        return self._write(write)
+    
+    def renew_leases(self, owner, expires_at):
+        """為持有者所有處理中任務的租約續約，回傳續約的任務數"""
+        def write(conn):
+            cursor = conn.execute('''
+                UPDATE task_history 
+                SET lease_expires_at = ?
+                WHERE status = 'processing' AND lease_owner = ?
+            ''', (expires_at, owner))
+            return cursor.rowcount
+        return self._write(write)
+    
+    def release_leases(self, owner):
+        """進程結束前讓租約立即過期，下一個進程不必等待即可接手，回傳釋放的任務數"""
+        def write(conn):
+            cursor = conn.execute('''
+                UPDATE task_history 
+                SET lease_expires_at = 0
+                WHERE status = 'processing' AND lease_owner = ?
+            ''', (owner,))
+            return cursor.rowcount
+        return self._write(write)
+    
+    def update_task_media(self, task_id, thumbnail_filename, preview_filename=None):
+        """更新任務的縮圖與預覽動圖（背景生成完成後呼叫，不改變任務狀態）"""
+        def write(conn):
+            conn.execute('''
+                UPDATE task_history 
+                SET thumbnail_filename = ?, preview_filename = ?
+                WHERE task_id = ?
+            ''', (thumbnail_filename, preview_filename, task_id))
+        self._write(write)
     
     def get_task(self, task_id):
         """獲取單個任務資訊"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._read() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM task_history WHERE task_id = ?', (task_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    def find_cached_results(self, request_fingerprint, limit=10):
+        """以請求指紋查詢成功的相同請求，最近完成的在前；呼叫端依序檢查影片檔是否仍存在"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM task_history 
+                WHERE request_fingerprint = ? AND status = 'completed' AND output_filename IS NOT NULL
+                ORDER BY completed_at DESC
+                LIMIT ?
+            ''', (request_fingerprint, limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def find_inflight_task(self, request_fingerprint):
+        """查詢相同請求指紋、尚在排隊或處理中的領頭任務，沒有時回傳 None"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM task_history 
+                WHERE request_fingerprint = ? AND status IN ('pending', 'processing') AND leader_task_id IS NULL
+                ORDER BY id
+                LIMIT 1
+            ''', (request_fingerprint,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def get_followers(self, leader_task_id):
+        """獲取仍在等待該領頭任務的跟隨任務"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM task_history 
+                WHERE leader_task_id = ? AND status = 'pending'
+                ORDER BY id
+            ''', (leader_task_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def release_followers(self, leader_task_id):
+        """領頭任務失敗或被刪除時，最早的跟隨任務改為領頭自行派送，其餘改為跟隨它；回傳新的領頭任務ID"""
+        def write(conn):
+            rows = conn.execute('''
+                SELECT task_id FROM task_history 
+                WHERE leader_task_id = ? AND status = 'pending'
+                ORDER BY id
+            ''', (leader_task_id,)).fetchall()
+            if not rows:
+                return None
+            new_leader = rows[0][0]
+            conn.execute('UPDATE task_history SET leader_task_id = NULL WHERE task_id = ?', (new_leader,))
+            conn.execute('''
+                UPDATE task_history SET leader_task_id = ?
+                WHERE leader_task_id = ? AND status = 'pending'
+            ''', (new_leader, leader_task_id))
+            return new_leader
+        return self._write(write)
+    
+    def get_batch_counts(self, batch_id):
+        """批次中各狀態的任務數"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT status, COUNT(*) FROM task_history 
+                WHERE batch_id = ?
+                GROUP BY status
+            ''', (batch_id,))
+            return {status: count for status, count in cursor.fetchall()}
+    
+    def get_batch_tasks(self, batch_id):
+        """批次中的所有任務，依清單順序"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT task_id, status, prompt, generation_mode, output_filename, thumbnail_filename, error_message,
+                       leader_task_id, created_at, started_at, completed_at
+                FROM task_history 
+                WHERE batch_id = ?
+                ORDER BY id
+            ''', (batch_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def cancel_batch(self, batch_id):
+        """取消批次中所有排隊中的任務；回傳 (取消的任務數, 被取消且仍有排隊中跟隨任務的 task_id)"""
+        def write(conn):
+            cursor = conn.execute('''
+                UPDATE task_history 
+                SET status = 'cancelled'
+                WHERE batch_id = ? AND status = 'pending'
+            ''', (batch_id,))
+            cancelled = cursor.rowcount
+            cursor = conn.execute('''
+                SELECT DISTINCT follower.leader_task_id
+                FROM task_history AS follower
+                JOIN task_history AS leader ON leader.task_id = follower.leader_task_id
+                WHERE leader.batch_id = ? AND leader.status = 'cancelled' AND follower.status = 'pending'
+            ''', (batch_id,))
+            return cancelled, [row[0] for row in cursor.fetchall()]
+        return self._write(write)
+    
+    def get_dispatch_candidates(self):
+        """調度器挑選用的排隊任務（不含跟隨任務），只取排序需要的欄位"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, task_id, priority, client_id, generation_mode, width, height, duration, created_at
+                FROM task_history 
+                WHERE status = 'pending' AND leader_task_id IS NULL
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_running_by_client(self):
+        """各客戶端處理中的任務數"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT client_id, COUNT(*) FROM task_history 
+                WHERE status = 'processing'
+                GROUP BY client_id
+            ''')
+            return {client_id: count for client_id, count in cursor.fetchall()}
+    
+    def get_processing_history(self, limit=2000):
+        """最近實際在 ComfyUI 執行完成的任務（不含快取命中與跟隨任務），依完成先後排列，供處理時間模型載入"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT generation_mode, width, height, duration, comfyui_backend, started_at, completed_at
+                FROM task_history 
+                WHERE status = 'completed' AND comfyui_prompt_id IS NOT NULL AND leader_task_id IS NULL
+                  AND started_at IS NOT NULL AND completed_at IS NOT NULL
+                ORDER BY id DESC LIMIT ?
+            ''', (limit,))
+            return [dict(row) for row in reversed(cursor.fetchall())]
+    
     def get_all_tasks(self, limit=50, offset=0, status=None):
         """獲取所有任務，支援分頁和狀態篩選"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._read() as conn:
             cursor = conn.cursor()
             
             query = 'SELECT * FROM task_history'
@@ -120,87 +715,147 @@ class Database:
                 query += ' WHERE status = ?'
                 params.append(status)
             
-            query += ' ORDER BY created_at DESC LIMIT ? OFFSET ?'
+            query += ' ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'
             params.extend([limit, offset])
             
             cursor.execute(query, params)
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
     
-    def search_tasks(self, search_term, limit=50, offset=0):
-        """搜尋任務"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM task_history 
-                WHERE prompt LIKE ? OR image_filename LIKE ?
-                ORDER BY created_at DESC 
-                LIMIT ? OFFSET ?
-            ''', (f'%{search_term}%', f'%{search_term}%', limit, offset))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-    
-    def count_tasks(self, status=None, search_term=None):
-        """計算任務總數"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_tasks_page(self, limit=50, status=None, after=None, before=None, from_end=False):
+        """以 (created_at, id) 做 keyset 分頁，回傳 (任務列表, 該方向是否還有更多)
+        
+        after: 取比游標更舊的一頁（下一頁）
+        before: 取比游標更新的一頁（上一頁）
+        from_end: 取最舊的一頁（末頁）
+        游標為 (created_at, id)；多取一筆判斷是否還有更多，不需要 OFFSET 掃過前面的資料
+        """
+        with self._read() as conn:
             cursor = conn.cursor()
             
-            query = 'SELECT COUNT(*) FROM task_history'
-            params = []
             conditions = []
+            params = []
             
             if status:
                 conditions.append('status = ?')
                 params.append(status)
             
-            if search_term:
-                conditions.append('(prompt LIKE ? OR image_filename LIKE ?)')
-                params.extend([f'%{search_term}%', f'%{search_term}%'])
+            ascending = False
+            if after:
+                conditions.append('(created_at, id) < (?, ?)')
+                params.extend(after)
+            elif before:
+                conditions.append('(created_at, id) > (?, ?)')
+                params.extend(before)
+                ascending = True
+            elif from_end:
+                ascending = True
             
+            query = 'SELECT * FROM task_history'
             if conditions:
                 query += ' WHERE ' + ' AND '.join(conditions)
+            order = 'ASC' if ascending else 'DESC'
+            query += f' ORDER BY created_at {order}, id {order} LIMIT ?'
+            params.append(limit + 1)
+            
+            cursor.execute(query, params)
+            rows = [dict(row) for row in cursor.fetchall()]
+            
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if ascending:
+                rows.reverse()
+            return rows, has_more
+    
+    def search_tasks(self, search_term, limit=50, offset=0, status=None):
+        """搜尋任務，依相關度排序並附上提示詞片段（snippet，以 \x02/\x03 標記命中處）"""
+        source, where, params, snippet, order = self._search_clause(search_term)
+        with self._read() as conn:
+            cursor = conn.cursor()
+            
+            query = f'SELECT t.*, {snippet} AS snippet FROM {source} WHERE {where}'
+            if status:
+                query += ' AND t.status = ?'
+                params.append(status)
+            query += f' ORDER BY {order} LIMIT ? OFFSET ?'
+            params.extend([limit, offset])
+            
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+    
+    def count_tasks(self, status=None, search_term=None):
+        """計算任務總數；沒有搜尋條件時直接讀取增量維護的狀態計數"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            
+            if not search_term:
+                if status:
+                    cursor.execute('SELECT count FROM task_status_counts WHERE status = ?', (status,))
+                    row = cursor.fetchone()
+                    return row[0] if row else 0
+                cursor.execute('SELECT COALESCE(SUM(count), 0) FROM task_status_counts')
+                return cursor.fetchone()[0]
+            
+            source, where, params, _, _ = self._search_clause(search_term)
+            query = f'SELECT COUNT(*) FROM {source} WHERE {where}'
+            if status:
+                query += ' AND t.status = ?'
+                params.append(status)
             
             cursor.execute(query, params)
             return cursor.fetchone()[0]
     
     def get_queue_status(self):
         """獲取排隊狀態統計"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._read() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT 
-                    status,
-                    COUNT(*) as count
-                FROM task_history 
+                SELECT status, count
+                FROM task_status_counts 
                 WHERE status IN ('pending', 'processing')
-                GROUP BY status
             ''')
             results = cursor.fetchall()
             
             status_counts = {'pending': 0, 'processing': 0}
             for status, count in results:
                 status_counts[status] = count
-                
+            
             return status_counts
     
-    def cleanup_old_tasks(self, days=30):
-        """清理舊任務記錄"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_status_counts(self):
+        """各狀態的任務數（取自觸發器維護的計數表，不掃描任務表）"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status, count FROM task_status_counts')
+            return dict(cursor.fetchall())
+    
+    def get_backend_load(self):
+        """獲取各ComfyUI後端處理中的任務數"""
+        with self._read() as conn:
             cursor = conn.cursor()
             cursor.execute('''
+                SELECT comfyui_backend, COUNT(*)
+                FROM task_history 
+                WHERE status = 'processing'
+                GROUP BY comfyui_backend
+            ''')
+            return {backend: count for backend, count in cursor.fetchall()}
+    
+    def cleanup_old_tasks(self, days=30):
+        """清理舊任務記錄"""
+        def write(conn):
+            cursor = conn.execute('''
                 DELETE FROM task_history 
                 WHERE created_at < datetime('now', '-{} days')
                 AND status IN ('completed', 'failed')
             '''.format(days))
-            deleted_count = cursor.rowcount
-            conn.commit()
-            return deleted_count
+            return cursor.rowcount
+        return self._write(write)
     
     def delete_task(self, task_id):
-        """刪除任務記錄"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        """刪除任務記錄；回傳的任務資訊附帶 freed_inputs（已無任務引用的輸入圖片檔名）"""
+        def write(conn):
             cursor = conn.cursor()
             
             # 先獲取任務資訊，用於刪除相關檔案
@@ -212,6 +867,13 @@ class Database:
             
             # 刪除資料庫記錄
             cursor.execute('DELETE FROM task_history WHERE task_id = ?', (task_id,))
-            conn.commit()
             
-            return dict(task)
+            # 取出引用數歸零的輸入圖片，由呼叫端刪除檔案
+            cursor.execute('SELECT filename FROM input_blobs WHERE refcount <= 0')
+            freed_inputs = [row[0] for row in cursor.fetchall()]
+            cursor.execute('DELETE FROM input_blobs WHERE refcount <= 0')
+            
+            task = dict(task)
+            task['freed_inputs'] = freed_inputs
+            return task
+        return self._write(write)
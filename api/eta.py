@@ -0,0 +1,135 @@
+"""由歷史任務學習的處理時間模型與排隊預估
+
+處理時間取 completed_at - started_at（started_at 在 ComfyUI 開始執行時重設，不含在 ComfyUI 佇列中的等待），
+依 (模式, 寬×高, 幀數, 後端) 保留最近 window 筆的滾動中位數，完成一個任務就更新一次。
+某個組合還沒有資料時逐級退回：
+    同模式同尺寸同幀數、不分後端 → 同模式每單位工作量（像素 × 幀數）的秒數 → 所有任務每單位工作量的秒數 → 固定預估
+"""
+import heapq
+import threading
+from collections import deque
+from datetime import datetime
+from scheduler import estimate_seconds
+
+def task_work(task):
+    """工作量：像素 × 幀數"""
+    return (task.get('width') or 480) * (task.get('height') or 832) * (task.get('duration') or 81)
+
+def processing_seconds(task):
+    """已完成任務的處理秒數；時間缺漏或不合理時回傳 None"""
+    if not task.get('started_at') or not task.get('completed_at'):
+        return None
+    try:
+        seconds = (datetime.fromisoformat(task['completed_at']) - datetime.fromisoformat(task['started_at'])).total_seconds()
+    except ValueError:
+        return None
+    return seconds if seconds > 0 else None
+
+class DurationModel:
+    """處理時間的滾動中位數模型，執行緒安全"""
+    
+    def __init__(self, window=50, fallback=estimate_seconds):
+        self.window = window
+        self.fallback = fallback
+        self._samples = {}  # 鍵 → 最近 window 筆樣本
+        self._medians = {}  # 鍵 → 中位數快取，該鍵有新樣本時清除
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _keys(task, backend):
+        """樣本要記錄到的鍵：(秒數鍵...) 與 (每單位工作量秒數鍵...)"""
+        mode = task.get('generation_mode') or 'single'
+        shape = ((task.get('width') or 480) * (task.get('height') or 832), task.get('duration') or 81)
+        return [('shape', mode, shape, backend), ('shape', mode, shape, None)], [('rate', mode), ('rate', None)]
+    
+    def record(self, task, seconds, backend=None):
+        """記錄一筆完成任務的處理秒數"""
+        if not seconds or seconds <= 0:
+            return
+        shape_keys, rate_keys = self._keys(task, backend)
+        rate = seconds / task_work(task)
+        with self._lock:
+            for keys, value in ((shape_keys, seconds), (rate_keys, rate)):
+                for key in keys:
+                    self._samples.setdefault(key, deque(maxlen=self.window)).append(value)
+                    self._medians.pop(key, None)
+    
+    def load(self, tasks):
+        """以歷史任務（依完成先後）建立初始樣本"""
+        loaded = 0
+        for task in tasks:
+            seconds = processing_seconds(task)
+            if seconds:
+                self.record(task, seconds, task.get('comfyui_backend'))
+                loaded += 1
+        return loaded
+    
+    def _median(self, key):
+        """鍵的中位數（呼叫端需持有 lock）；沒有樣本時回傳 None"""
+        if key not in self._medians:
+            samples = self._samples.get(key)
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            middle = len(ordered) // 2
+            self._medians[key] = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        return self._medians[key]
+    
+    def estimate(self, task, backend=None):
+        """預估任務在指定後端（None 為不分後端）上的處理秒數"""
+        shape_keys, rate_keys = self._keys(task, backend)
+        with self._lock:
+            for key in shape_keys:
+                seconds = self._median(key)
+                if seconds is not None:
+                    return seconds
+            for key in rate_keys:
+                rate = self._median(key)
+                if rate is not None:
+                    return rate * task_work(task)
+        return self.fallback(task)
+    
+    def snapshot(self):
+        """各 (模式, 尺寸, 幀數, 後端) 組合的中位數與樣本數，供 API 顯示"""
+        with self._lock:
+            return [
+                {
+                    'mode': key[1],
+                    'pixels': key[2][0],
+                    'duration': key[2][1],
+                    'backend': key[3],
+                    'median_seconds': round(self._median(key), 1),
+                    'samples': len(samples)
+                }
+                for key, samples in self._samples.items() if key[0] == 'shape'
+            ]
+
+def estimate_queue(model, order, running, backends, now):
+    """依派送順序預估每個任務的開始與完成時間（相對 now 的秒數）
+    
+    order: 依預定派送順序排列的排隊任務；running: {後端: [處理中任務（依派送先後）]}，第一個為正在執行的任務；
+    backends: 可派送的後端名稱。每台後端一次執行一個任務，下一個排隊任務交給最早空出的後端。
+    回傳 ({task_id: {'wait_seconds', 'finish_seconds', 'backend'}}, {後端: 清空排隊所需秒數})
+    """
+    estimates = {}
+    free = []
+    for backend in set(backends) | set(running):
+        busy = 0.0
+        for index, task in enumerate(running.get(backend, [])):
+            seconds = model.estimate(task, backend)
+            if index == 0 and task.get('started_at'):
+                # 正在執行的任務只算剩餘時間；已超過預估時至少再算一成
+                elapsed = max(0.0, now - datetime.fromisoformat(task['started_at']).timestamp())
+                seconds = max(seconds - elapsed, seconds * 0.1)
+            estimates[task['task_id']] = {'wait_seconds': busy, 'finish_seconds': busy + seconds, 'backend': backend}
+            busy += seconds
+        if backend in backends:
+            heapq.heappush(free, (busy, backend))
+    
+    if free:
+        for task in order:
+            start, backend = heapq.heappop(free)
+            finish = start + model.estimate(task, backend)
+            estimates[task['task_id']] = {'wait_seconds': start, 'finish_seconds': finish, 'backend': backend}
+            heapq.heappush(free, (finish, backend))
+    return estimates, {backend: busy for busy, backend in free}
@@ -0,0 +1,175 @@
+import os
+import io
+import sys
+import signal
+import time
+import math
+import hashlib
+import tempfile
+import cv2
+from PIL import Image, ImageOps
+
+# 縮圖尺寸（最長邊像素）；第一個尺寸的 JPEG 沿用舊檔名 {task_id}_thumb.jpg
+THUMBNAIL_SIZES = (320, 640)
+THUMBNAIL_FORMATS = (('jpg', 'JPEG'), ('webp', 'WEBP'))
+# 歷史頁滑過時播放的預覽動圖：均勻取樣的影格數、最長邊與每格顯示時間（毫秒）
+PREVIEW_FRAMES = 8
+PREVIEW_SIZE = 240
+PREVIEW_FRAME_MS = 250
+# 與工作流程中 ImageResizeKJv2 的 divisible_by 一致，正規化後的圖片在 ComfyUI 端不需再縮放
+IMAGE_DIVISIBLE_BY = 16
+# EXIF 方向值 5~8 表示影像需旋轉 90 度，寬高互換
+EXIF_ORIENTATION = 0x0112
+
+def init_worker():
+    """工作進程初始化：還原 SIGTERM 並改用新的 stdout/stderr 檔案物件
+    
+    工作進程由多線程的 app fork 出來（包含崩潰後重建）：繼承的 SIGTERM 處理會在子進程中等待不存在的資料庫寫入線程；
+    fork 當下其他線程可能正持有 stdout 的鎖，沿用繼承的檔案物件 print 會永遠等待，新物件直接寫入相同的檔案描述符
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.stdout = open(1, 'w', encoding=sys.stdout.encoding, errors='backslashreplace', buffering=1, closefd=False)
+    sys.stderr = open(2, 'w', encoding=sys.stderr.encoding, errors='backslashreplace', buffering=1, closefd=False)
+
+def thumbnail_filename(task_id, size=THUMBNAIL_SIZES[0], ext='jpg'):
+    """縮圖檔名；預設尺寸不加尺寸後綴，與舊資料相容"""
+    if size == THUMBNAIL_SIZES[0]:
+        return f"{task_id}_thumb.{ext}"
+    return f"{task_id}_thumb_{size}.{ext}"
+
+def preview_filename(task_id):
+    """預覽動圖檔名"""
+    return f"{task_id}_preview.webp"
+
+def media_filenames(task_id):
+    """一個任務所有衍生媒體的檔名（縮圖各尺寸/格式與預覽動圖）"""
+    names = [thumbnail_filename(task_id, size, ext) for size in THUMBNAIL_SIZES for ext, _ in THUMBNAIL_FORMATS]
+    names.append(preview_filename(task_id))
+    return names
+
+def _fit(image, max_side):
+    """等比例縮放到最長邊為 max_side"""
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    return image
+
+def _save_atomic(image, path, format, **params):
+    """寫入暫存檔後再換名，避免提供到寫到一半的檔案；暫存檔名唯一，同時寫同一個檔案的進程不會互相覆蓋"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=format, **params)
+        os.chmod(tmp_path, 0o644)  # mkstemp 預設 0600
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def frame_count(video_path):
+    """影片的影格數（取自容器資訊，不解碼）；無法取得時回傳 0"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    finally:
+        cap.release()
+
+def has_preview(video_path):
+    """影片是否能生成預覽動圖：與 read_frames 相同，影格數不超過一格時只取第一格，generate_media 不會產生預覽"""
+    return frame_count(video_path) > 1
+
+def read_frames(video_path, count=PREVIEW_FRAMES):
+    """依序解碼影片一次，回傳第一格與均勻取樣的 count 格（RGB 的 PIL 圖片）"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if total > 0:
+            wanted = sorted({int(i * total / count) for i in range(count)})
+        else:
+            wanted = [0]
+        
+        frames = []
+        index = 0
+        for target in wanted:
+            # 跳過的影格只 grab 不轉換，比逐格 read 便宜
+            while index < target:
+                if not cap.grab():
+                    return frames
+                index += 1
+            ret, frame = cap.read()
+            if not ret:
+                break
+            index += 1
+            frames.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+        return frames
+    finally:
+        cap.release()
+
+def generate_media(video_path, thumbnail_dir, task_id):
+    """生成任務的所有衍生媒體：多尺寸 JPEG/WebP 縮圖與預覽動圖
+    
+    在背景 process pool 中執行，回傳檔名與耗時；影片無法解碼時回傳 None
+    """
+    start = time.monotonic()
+    frames = read_frames(video_path)
+    if not frames:
+        print(f"Error generating media for {task_id}: no frames decoded from {video_path}")
+        return None
+    
+    thumbnails = {}
+    for size in THUMBNAIL_SIZES:
+        image = _fit(frames[0], size)
+        for ext, format in THUMBNAIL_FORMATS:
+            filename = thumbnail_filename(task_id, size, ext)
+            _save_atomic(image, os.path.join(thumbnail_dir, filename), format, quality=85)
+            thumbnails[f"{size}_{ext}"] = filename
+    
+    preview = None
+    if len(frames) > 1:
+        preview = preview_filename(task_id)
+        strip = [_fit(frame, PREVIEW_SIZE) for frame in frames]
+        _save_atomic(strip[0], os.path.join(thumbnail_dir, preview), 'WEBP',
+                     save_all=True, append_images=strip[1:], duration=PREVIEW_FRAME_MS, loop=0, quality=70)
+    
+    return {
+        'thumbnail_filename': thumbnail_filename(task_id),
+        'thumbnails': thumbnails,
+        'preview_filename': preview,
+        'seconds': round(time.monotonic() - start, 3)
+    }
+
+def target_size(width, height):
+    """工作流程實際使用的尺寸：向下取到 IMAGE_DIVISIBLE_BY 的倍數"""
+    return (max(IMAGE_DIVISIBLE_BY, width // IMAGE_DIVISIBLE_BY * IMAGE_DIVISIBLE_BY),
+            max(IMAGE_DIVISIBLE_BY, height // IMAGE_DIVISIBLE_BY * IMAGE_DIVISIBLE_BY))
+
+def normalize_image(src_path, dest_dir, width, height):
+    """將上傳圖片正規化為工作流程的輸入尺寸：置中裁切、lanczos 縮放、去除 EXIF
+    
+    JPEG 以 draft 模式直接解碼到接近目標的縮小尺寸（1/2、1/4、1/8），不必解出整張大圖。
+    在工作進程中執行；結果以內容雜湊命名寫入 dest_dir 的暫存檔，回傳 (暫存路徑, 雜湊檔名)
+    """
+    width, height = target_size(width, height)
+    with Image.open(src_path) as image:
+        # 手機照片常以 EXIF 標記旋轉，draft 的尺寸要以旋轉前的方向計算
+        src_w, src_h = image.size
+        rotated = image.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8)
+        want_w, want_h = (height, width) if rotated else (width, height)
+        scale = max(want_w / src_w, want_h / src_h)
+        if scale < 1:
+            image.draft('RGB', (math.ceil(src_w * scale), math.ceil(src_h * scale)))
+        
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS, centering=(0.5, 0.5))
+    
+    # 不帶 exif 參數儲存即去除所有 EXIF（含 GPS）
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=95, subsampling=0)
+    data = buffer.getvalue()
+    
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return tmp_path, f"{hashlib.sha256(data).hexdigest()[:32]}.jpg"
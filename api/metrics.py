@@ -0,0 +1,156 @@
+"""Prometheus 文字格式（0.0.4）的計數器、量測值與直方圖
+
+只實作 /metrics 需要的部分，不另外依賴 prometheus_client。所有指標皆為執行緒安全；
+量測值可以在輸出時由 collect 函數即時取得（例如資料庫中的任務數），不需要在每次狀態改變時更新
+"""
+import math
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    """標籤值跳脫：反斜線、雙引號與換行"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    """{name="value",...}；沒有標籤時回傳空字串"""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    """數值輸出：整數不帶小數點，無限大為 +Inf"""
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """指標共用部分：名稱、說明、標籤名稱與依標籤值分組的數值"""
+    type = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要標籤 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(Metric):
+    """只增不減的計數"""
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+class Gauge(Metric):
+    """目前數值；指定 collect 時在輸出時呼叫，回傳數值或 {標籤值 tuple: 數值}"""
+    type = 'gauge'
+    
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def render(self):
+        if self.collect:
+            values = self.collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                                for key, value in sorted(values.items(), key=lambda item: tuple(map(str, item[0])))]
+
+class Histogram(Metric):
+    """依上界分組的觀測值分佈，另記總和與次數"""
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+    
+    def render(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = self.header()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, ('le', format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Registry:
+    """指標集合，render 輸出 /metrics 的內容"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self._register(Gauge(name, documentation, labelnames, collect))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        if buckets is None:
+            return self._register(Histogram(name, documentation, labelnames))
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # 單一指標（例如資料庫查詢）失敗時不影響其他指標
+                print(f"[METRICS] Failed to collect {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,123 @@
+"""排隊任務的派送順序
+
+1. 優先級：interactive > normal > batch；等待滿 aging_seconds 後提升一級（最多一級），
+   批次任務不會被永遠擠在後面，但積壓的舊批次也不會反過來壓過新的一般任務
+2. 公平分配：同一優先級中，處理中任務最少的客戶端先派送，單一客戶端的大批任務不會佔滿 GPU
+3. 短任務優先：同一客戶端內依回應比 (等待時間 + 預估處理時間) / 預估處理時間 挑選（HRRN），
+   短的 5 秒預覽不必排在一串 8 秒影片後面；長任務的回應比隨等待增加，不會餓死，處理時間相同時即為 FIFO
+
+只依賴任務的基本欄位，app.py 的調度器與 simulate_scheduler.py 共用
+"""
+import heapq
+from datetime import datetime, timezone
+
+# 優先級名稱 → 數值（越小越先）
+PRIORITY_CLASSES = {'interactive': 0, 'normal': 1, 'batch': 2}
+PRIORITY_NAMES = {value: name for name, value in PRIORITY_CLASSES.items()}
+DEFAULT_PRIORITY = PRIORITY_CLASSES['normal']
+
+# 預估處理時間的基準：480x832、81 幀約 4 分鐘，其餘依 像素 × 幀數 等比例估算
+REFERENCE_SECONDS = 240
+REFERENCE_WORK = 480 * 832 * 81
+
+def parse_priority(value, default=DEFAULT_PRIORITY):
+    """解析優先級名稱（或數值）；空值回傳預設，無效時拋出 ValueError"""
+    value = str(value if value is not None else '').strip().lower()
+    if not value:
+        return default
+    if value in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value]
+    if value.isdigit() and int(value) in PRIORITY_NAMES:
+        return int(value)
+    raise ValueError(value)
+
+def parse_timestamp(value):
+    """秒數原樣回傳；ISO 時間轉為 epoch 秒（沒有時區的 SQLite CURRENT_TIMESTAMP 視為 UTC）"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def estimate_seconds(task):
+    """依解析度與幀數預估處理時間（秒）"""
+    work = (task.get('width') or 480) * (task.get('height') or 832) * (task.get('duration') or 81)
+    return max(1.0, REFERENCE_SECONDS * work / REFERENCE_WORK)
+
+class Scheduler:
+    """從排隊任務中挑出下一個派送的任務
+    
+    任務為 dict，需有 id、priority、client_id、submitted（提交時間，epoch 秒）、width、height、duration
+    """
+    
+    def __init__(self, aging_seconds=1800, estimate=estimate_seconds):
+        self.aging_seconds = aging_seconds
+        self.estimate = estimate
+    
+    def effective_priority(self, task, now):
+        """等待時間加權後的優先級：等待滿 aging_seconds 提升一級"""
+        priority = task.get('priority', DEFAULT_PRIORITY)
+        if self.aging_seconds > 0 and now - task['submitted'] >= self.aging_seconds:
+            priority -= 1
+        return max(0, priority)
+    
+    def response_ratio(self, task, now):
+        """(等待時間 + 預估處理時間) / 預估處理時間"""
+        cost = self.estimate(task)
+        return (max(0, now - task['submitted']) + cost) / cost
+    
+    def pick(self, pending, running=None, now=0):
+        """挑出下一個任務；running 為 {client_id: 處理中任務數}，沒有可派送的任務時回傳 None"""
+        if not pending:
+            return None
+        running = running or {}
+        
+        top = min(self.effective_priority(task, now) for task in pending)
+        
+        # 每個客戶端在最高優先級中回應比最高的任務；同分時較早提交的先
+        best = {}
+        for task in pending:
+            if self.effective_priority(task, now) != top:
+                continue
+            key = (self.response_ratio(task, now), -task['id'])
+            client = task.get('client_id')
+            if client not in best or key > best[client][0]:
+                best[client] = (key, task)
+        
+        # 處理中任務最少的客戶端先；再比回應比
+        _, (_, task) = min(best.items(), key=lambda item: (running.get(item[0], 0), -item[1][0][0], -item[1][0][1]))
+        return task
+    
+    def order(self, pending, running=None, now=0):
+        """預估全部排隊任務的派送順序（供預估等待時間使用）
+        
+        依序重複 pick 需要 O(n²)，這裡只在開始時計算一次回應比，並假設排隊期間沒有任務完成：
+        高優先級先，同優先級中以處理中任務數（含已排定派送的）最少的客戶端輪流，各客戶端內依回應比
+        """
+        running = dict(running or {})
+        groups = {}
+        for task in pending:
+            client_tasks = groups.setdefault(self.effective_priority(task, now), {})
+            client_tasks.setdefault(task.get('client_id'), []).append(task)
+        
+        ordered = []
+        for priority in sorted(groups):
+            queues = {}
+            heap = []
+            for client, tasks in groups[priority].items():
+                tasks.sort(key=lambda task: (-self.response_ratio(task, now), task['id']))
+                queues[client] = tasks
+                heap.append((running.get(client, 0), -self.response_ratio(tasks[0], now), tasks[0]['id'], client))
+            heapq.heapify(heap)
+            positions = dict.fromkeys(queues, 0)
+            while heap:
+                count, _, _, client = heapq.heappop(heap)
+                task = queues[client][positions[client]]
+                ordered.append(task)
+                positions[client] += 1
+                running[client] = count + 1
+                if positions[client] < len(queues[client]):
+                    head = queues[client][positions[client]]
+                    heapq.heappush(heap, (count + 1, -self.response_ratio(head, now), head['id'], client))
+        return ordered
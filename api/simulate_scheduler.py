@@ -0,0 +1,180 @@
+"""以記錄的到達順序重播排隊，比較不同派送策略的等待時間
+
+到達記錄可來自資料庫中實際送進 ComfyUI 的任務（以實際處理時間為服務時間），
+或 JSONL 檔，每行一個任務：
+    {"arrival": 12.5, "client_id": "a", "priority": "batch", "width": 480, "height": 832, "duration": 81, "service": 250}
+arrival 為秒數或 ISO 時間；service 省略時以解析度與幀數預估。
+
+用法（容器內）：
+    python simulate_scheduler.py                          # 重播資料庫中的任務
+    python simulate_scheduler.py --workers 2              # 假設兩台 GPU
+    python simulate_scheduler.py --trace arrivals.jsonl
+    python simulate_scheduler.py --export arrivals.jsonl  # 將資料庫中的到達記錄匯出為 JSONL
+"""
+import argparse
+import heapq
+import json
+import math
+import os
+import sqlite3
+from datetime import datetime
+from dotenv import load_dotenv
+from scheduler import PRIORITY_NAMES, Scheduler, estimate_seconds, parse_priority, parse_timestamp
+
+load_dotenv()
+
+def load_database_trace(path):
+    """資料庫中實際送進 ComfyUI 的任務（不含快取命中與跟隨任務），服務時間為 completed_at - started_at"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute('''
+            SELECT * FROM task_history
+            WHERE comfyui_prompt_id IS NOT NULL
+            ORDER BY created_at, id
+        ''').fetchall()
+    finally:
+        conn.close()
+    
+    trace = []
+    for row in map(dict, rows):
+        service = None
+        if row.get('started_at') and row.get('completed_at'):
+            # started_at 與 completed_at 都以本地時間寫入，相減即為處理時間
+            service = (datetime.fromisoformat(row['completed_at']) - datetime.fromisoformat(row['started_at'])).total_seconds()
+        trace.append({
+            'arrival': parse_timestamp(row['created_at']),
+            'client_id': row.get('client_id'),
+            'priority': row.get('priority'),
+            'width': row['width'],
+            'height': row['height'],
+            'duration': row['duration'],
+            'service': service if service and service > 0 else None
+        })
+    return trace
+
+def load_jsonl_trace(path):
+    """讀取 JSONL 到達記錄"""
+    trace = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                item['arrival'] = parse_timestamp(item['arrival'])
+                trace.append(item)
+    return trace
+
+def normalize_trace(trace):
+    """補齊預設值、以第一個到達為時間 0，並依到達時間排序"""
+    trace = sorted(trace, key=lambda item: item['arrival'])
+    start = trace[0]['arrival'] if trace else 0
+    jobs = []
+    for index, item in enumerate(trace):
+        job = {
+            'id': index,
+            'submitted': item['arrival'] - start,
+            'client_id': item.get('client_id'),
+            'priority': parse_priority(item.get('priority')),
+            'width': item.get('width') or 480,
+            'height': item.get('height') or 832,
+            'duration': item.get('duration') or 81
+        }
+        job['service'] = item.get('service') or estimate_seconds(job)
+        jobs.append(job)
+    return jobs
+
+def simulate(jobs, pick, workers=1):
+    """離散事件模擬：每台工作者一次處理一個任務，空閒時以 pick 從已到達的任務中挑選；回傳每個任務的等待時間"""
+    free_at = [0.0] * max(1, workers)
+    heapq.heapify(free_at)
+    running = []  # (結束時間, client_id)
+    pending = []
+    waits = {}
+    index = 0
+    while index < len(jobs) or pending:
+        now = heapq.heappop(free_at)
+        if not pending and jobs[index]['submitted'] > now:
+            now = jobs[index]['submitted']
+        while index < len(jobs) and jobs[index]['submitted'] <= now:
+            pending.append(jobs[index])
+            index += 1
+        
+        running = [(end, client) for end, client in running if end > now]
+        running_by_client = {}
+        for _, client in running:
+            running_by_client[client] = running_by_client.get(client, 0) + 1
+        
+        job = pick(pending, running_by_client, now)
+        pending.remove(job)
+        waits[job['id']] = now - job['submitted']
+        running.append((now + job['service'], job['client_id']))
+        heapq.heappush(free_at, now + job['service'])
+    return waits
+
+def percentile(values, p):
+    """最近秩百分位數"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def policies(aging_seconds):
+    """比較的派送策略"""
+    scheduler = Scheduler(aging_seconds=aging_seconds)
+    return {
+        'fifo': lambda pending, running, now: min(pending, key=lambda job: job['id']),
+        # 舊調度器：ORDER BY created_at DESC，最新的先派送
+        'lifo': lambda pending, running, now: max(pending, key=lambda job: job['id']),
+        'scheduler': scheduler.pick
+    }
+
+def format_row(label, waits):
+    """一行統計（分鐘）"""
+    if not waits:
+        return f"  {label:<22}{0:>7}"
+    mean = sum(waits) / len(waits)
+    return (f"  {label:<22}{len(waits):>7}{mean / 60:>12.1f}{percentile(waits, 95) / 60:>12.1f}"
+            f"{max(waits) / 60:>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='重播到達記錄，比較派送策略的平均與 p95 等待時間')
+    parser.add_argument('--database', default=os.getenv('DATABASE_PATH', '/app/database/history.db'), help='SQLite 資料庫路徑')
+    parser.add_argument('--trace', help='JSONL 到達記錄（指定時不讀資料庫）')
+    parser.add_argument('--export', help='將到達記錄寫成 JSONL 後結束')
+    parser.add_argument('--workers', type=int, default=1, help='同時處理的 GPU 數')
+    parser.add_argument('--aging', type=float, default=float(os.getenv('SCHEDULER_AGING_SECONDS', '1800')), help='每等待幾秒提升一個優先級')
+    parser.add_argument('--policy', action='append', choices=['fifo', 'lifo', 'scheduler'], help='只比較指定策略（可重複）')
+    args = parser.parse_args()
+    
+    trace = load_jsonl_trace(args.trace) if args.trace else load_database_trace(args.database)
+    if args.export:
+        with open(args.export, 'w', encoding='utf-8') as f:
+            for item in trace:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        print(f"已匯出 {len(trace)} 筆到達記錄到 {args.export}")
+        return
+    
+    jobs = normalize_trace(trace)
+    if not jobs:
+        print('沒有可重播的任務')
+        return
+    
+    span = jobs[-1]['submitted']
+    busy = sum(job['service'] for job in jobs)
+    print(f"{len(jobs)} 個任務，到達跨度 {span / 3600:.1f} 小時，總處理時間 {busy / 3600:.1f} 小時，{args.workers} 台 GPU")
+    print(f"  {'等待時間（分鐘）':<16}{'任務數':>5}{'平均':>10}{'p95':>12}{'最長':>10}")
+    
+    selected = policies(args.aging)
+    for name in args.policy or selected:
+        waits = simulate(jobs, selected[name], args.workers)
+        print(name)
+        print(format_row('全部', list(waits.values())))
+        for priority in sorted({job['priority'] for job in jobs}):
+            class_waits = [waits[job['id']] for job in jobs if job['priority'] == priority]
+            print(format_row(PRIORITY_NAMES.get(priority, str(priority)), class_waits))
+        for duration in sorted({job['duration'] for job in jobs}):
+            duration_waits = [waits[job['id']] for job in jobs if job['duration'] == duration]
+            print(format_row(f"{duration} 幀", duration_waits))
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,12 @@ function showToast(message, type='info'){
 
 async function updateQueueStatus(){
   try{
-    const res = await fetch('/queue?summary=1');
-    const html = await res.text();
-    const tmp = new DOMParser().parseFromString(html, 'text/html');
+    const res = await fetch('/api/queue');
+    const data = await res.json();
     
     // 更新排隊數量
-    const processingCount = tmp.getElementById('processingCount')?.textContent || '0';
-    const pendingCount = tmp.getElementById('pendingCount')?.textContent || '0';
+    const processingCount = String(data.local_queue?.processing ?? 0);
+    const pendingCount = String(data.local_queue?.pending ?? 0);
     
     document.getElementById('processingCount')?.replaceChildren(document.createTextNode(processingCount));
     document.getElementById('queueCount')?.replaceChildren(document.createTextNode(pendingCount));
@@ -121,6 +120,16 @@ function jumpToPage(){
   location.href = url.toString();
 }
 
+// 預覽動圖在第一次滑過時才載入，避免整頁一次下載所有動圖
+document.addEventListener('mouseover', function(e) {
+  const thumb = e.target.closest && e.target.closest('.video-thumbnail[data-preview]');
+  if(!thumb) return;
+  const strip = thumb.querySelector('.preview-strip');
+  if(strip && !strip.getAttribute('src')){
+    strip.src = thumb.dataset.preview;
+  }
+});
+
 // 支援 Enter 鍵跳轉
 document.addEventListener('DOMContentLoaded', function() {
   const jumpPageInput = document.getElementById('jumpPage');
@@ -217,6 +226,20 @@ async function deleteTask(taskId, taskTitle){
   }catch(e){ showToast(e.message,'danger'); }
 }
 
+async function cancelTask(taskId){
+  if(!confirm('確定要取消這個任務嗎？處理中的任務會立即中斷。')) return;
+  try{
+    const res = await fetch(`/api/task/${taskId}/cancel`, { method:'POST' });
+    const data = await res.json();
+    if(data.success){
+      // ComfyUI 呼叫失敗時任務仍已取消，但提示可能還在 ComfyUI 上執行
+      if(data.comfyui === 'unknown'){ showToast(data.message, 'danger'); setTimeout(()=>location.reload(), 1800); }
+      else { showToast('已取消'); setTimeout(()=>location.reload(), 800); }
+    }
+    else { throw new Error(data.error||'取消失敗'); }
+  }catch(e){ showToast(e.message,'danger'); }
+}
+
 // ===== detail.html =====
 function copyPrompt(){
   const el = document.createElement('textarea');
@@ -319,7 +342,10 @@ async function refreshStatus(){
   }catch(e){ showToast('更新失敗','danger'); }
 }
 function updateQueueDisplay(data){
-  // placeholder for compatibility with websocket push
+  // 伺服器只在 ComfyUI 排隊狀態改變時推送 queue_update
+  if(!data) return;
+  document.getElementById('comfyuiRunning')?.replaceChildren(document.createTextNode(String((data.queue_running || []).length)));
+  document.getElementById('comfyuiPending')?.replaceChildren(document.createTextNode(String((data.queue_pending || []).length)));
 }
 
 // ===== unified datetime formatting =====
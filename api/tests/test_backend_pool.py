@@ -0,0 +1,121 @@
+"""多台 ComfyUI 後端的派送：以本機 stub 伺服器模擬各後端的 /queue
+
+需在容器內執行（app 會讀取 /app 下的工作流程模板與目錄）：
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(DATABASE_DIR, 'history.db')
+os.environ.setdefault('COMFYUI_HOST', '127.0.0.1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+class StubComfyUI:
+    """只回應 GET /queue 的 ComfyUI，running 與 pending 為佇列中的 prompt 數"""
+    
+    def __init__(self, running=0, pending=0):
+        self.running = running
+        self.pending = pending
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/queue':
+                    self.send_error(404)
+                    return
+                body = json.dumps({
+                    'queue_running': [[i, f'running-{i}', {}] for i in range(stub.running)],
+                    'queue_pending': [[i, f'pending-{i}', {}] for i in range(stub.pending)]
+                }).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def closed_port_url():
+    """沒有伺服器在聽的本機位址，模擬無法連線的後端"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+class BackendPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.stubs = [StubComfyUI(running=1, pending=2), StubComfyUI(running=1, pending=0)]
+        for stub in self.stubs:
+            self.addCleanup(stub.close)
+        self.busy, self.idle = [app.ComfyUIBackend(stub.url) for stub in self.stubs]
+        # 無法連線的後端不重試，測試不必等待退避
+        with mock.patch.object(app, 'COMFYUI_RETRIES', 0):
+            self.down = app.ComfyUIBackend(closed_port_url())
+        self.pool = app.ComfyUIBackendPool([self.busy, self.idle, self.down])
+    
+    def test_queue_status_merges_backends(self):
+        merged = self.pool.get_queue_status()
+        self.assertEqual(len(merged['queue_running']), 2)
+        self.assertEqual(len(merged['queue_pending']), 2)
+        self.assertEqual([(b['name'], b['healthy'], b['queue_depth']) for b in merged['backends']],
+                         [(self.busy.name, True, 3), (self.idle.name, True, 1), (self.down.name, False, 0)])
+    
+    def test_pick_least_loaded(self):
+        self.pool.get_queue_status()
+        self.assertIs(self.pool.pick({}, depth=2), self.idle)
+    
+    def test_pick_skips_unhealthy(self):
+        # 無法連線的後端佇列深度為 0，但不健康，不會被選中
+        self.stubs[0].pending = 0
+        self.stubs[1].pending = 1
+        self.pool.get_queue_status()
+        self.assertFalse(self.down.healthy)
+        self.assertIs(self.pool.pick({}, depth=2), self.busy)
+    
+    def test_pick_skips_full(self):
+        self.pool.get_queue_status()
+        self.assertIs(self.pool.pick({self.idle.name: 2}, depth=2), self.busy)
+        self.assertIsNone(self.pool.pick({self.busy.name: 2, self.idle.name: 2}, depth=2))
+    
+    def test_pick_ties_broken_by_inflight(self):
+        self.stubs[0].pending = 0
+        self.pool.get_queue_status()
+        self.assertIs(self.pool.pick({self.busy.name: 1}, depth=2), self.idle)
+        self.assertIs(self.pool.pick({self.idle.name: 1}, depth=2), self.busy)
+    
+    def test_all_unhealthy(self):
+        pool = app.ComfyUIBackendPool([self.down])
+        self.assertIsNone(pool.get_queue_status())
+        self.assertIsNone(pool.pick({}, depth=2))
+    
+    def test_unknown_backend_falls_back_to_default(self):
+        self.assertIs(self.pool.get(self.idle.name), self.idle)
+        self.assertIs(self.pool.get(None), self.busy)
+        with mock.patch('builtins.print') as log:
+            self.assertIs(self.pool.get('removed:8188'), self.busy)
+            self.assertIs(self.pool.get('removed:8188'), self.busy)
+        # 未知名稱只記錄一次
+        self.assertEqual(log.call_count, 1)
+        self.assertIn('removed:8188', log.call_args[0][0])
+
+if __name__ == '__main__':
+    unittest.main()
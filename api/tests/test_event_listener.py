@@ -0,0 +1,130 @@
+"""ComfyUI /ws 事件分派：開始、進度、輸出、完成、失敗與中斷，以及同一個 prompt 只會被完成一次
+
+需在容器內執行（app 會讀取 /app 下的工作流程模板與目錄）：
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(DATABASE_DIR, 'history.db')
+os.environ.setdefault('COMFYUI_HOST', '127.0.0.1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+class EventListenerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.finished = []
+        self.failed = []
+        self.started = []
+        self.progress = []
+        self.listener = app.ComfyUIEventListener(
+            'ws://127.0.0.1:8188/ws', 'client',
+            on_finished=lambda task_id, prompt_id, outputs: self.finished.append((task_id, prompt_id, outputs)),
+            on_failed=lambda task_id, prompt_id, error_msg: self.failed.append((task_id, prompt_id, error_msg)),
+            on_started=lambda task_id, prompt_id: self.started.append((task_id, prompt_id)),
+            on_progress=lambda task_id, prompt_id, progress: self.progress.append((task_id, progress))
+        )
+        self.listener.watch('p1', 'task1')
+    
+    def test_execution_start(self):
+        self.listener.handle_event('execution_start', {'prompt_id': 'p1'})
+        self.assertEqual(self.started, [('task1', 'p1')])
+    
+    def test_progress(self):
+        self.listener.handle_event('executing', {'prompt_id': 'p1', 'node': '3'})
+        self.listener.handle_event('progress', {'prompt_id': 'p1', 'value': 5, 'max': 20})
+        self.assertEqual([(p['node'], p['value'], p['max']) for task_id, p in self.progress],
+                         [('3', None, None), ('3', 5, 20)])
+        self.assertEqual({task_id for task_id, p in self.progress}, {'task1'})
+    
+    def test_executed_outputs_passed_to_finished(self):
+        output = {'gifs': [{'filename': 'task1_00001.mp4'}]}
+        self.listener.handle_event('executed', {'prompt_id': 'p1', 'node': '9', 'output': output})
+        self.listener.handle_event('execution_success', {'prompt_id': 'p1'})
+        self.assertEqual(self.finished, [('task1', 'p1', {'9': output})])
+    
+    def test_executing_none_finishes(self):
+        self.listener.handle_event('executing', {'prompt_id': 'p1', 'node': None})
+        self.assertEqual(self.finished, [('task1', 'p1', {})])
+        self.assertEqual(self.progress, [])
+    
+    def test_execution_error(self):
+        self.listener.handle_event('execution_error', {'prompt_id': 'p1', 'exception_message': 'out of memory'})
+        self.assertEqual(self.failed, [('task1', 'p1', 'out of memory')])
+    
+    def test_execution_interrupted(self):
+        self.listener.handle_event('execution_interrupted', {'prompt_id': 'p1'})
+        self.assertEqual(self.failed, [('task1', 'p1', '任務已被中斷')])
+    
+    def test_claimed_once(self):
+        # 完成事件之後的 executing(node=None) 與錯誤事件都不會再處理同一個 prompt
+        self.listener.handle_event('execution_success', {'prompt_id': 'p1'})
+        self.listener.handle_event('executing', {'prompt_id': 'p1', 'node': None})
+        self.listener.handle_event('execution_error', {'prompt_id': 'p1'})
+        self.assertEqual(len(self.finished), 1)
+        self.assertEqual(self.failed, [])
+        self.assertIsNone(self.listener.claim('p1'))
+    
+    def test_unwatched_prompt_ignored(self):
+        for event_type, data in [('execution_start', {}), ('executing', {'node': '3'}), ('progress', {'value': 1, 'max': 2}),
+                                 ('executed', {'node': '9', 'output': {}}), ('execution_success', {}),
+                                 ('execution_error', {}), ('execution_interrupted', {})]:
+            self.listener.handle_event(event_type, dict(data, prompt_id='other'))
+        self.assertEqual((self.started, self.progress, self.finished, self.failed), ([], [], [], []))
+    
+    def test_finishing_prompt_not_rewatched(self):
+        self.listener.handle_event('execution_success', {'prompt_id': 'p1'})
+        self.assertFalse(self.listener.watch('p1', 'task1'))
+        self.assertIsNone(self.listener.claim('p1'))
+        
+        self.listener.release('p1')
+        self.assertTrue(self.listener.watch('p1', 'task1'))
+
+class ReconcileDuringCompletionTest(unittest.TestCase):
+    """WebSocket 完成事件的收尾期間執行對帳，不會再完成一次"""
+    
+    def setUp(self):
+        self.backend = app.backend_pool.default
+        self.prompt_id = 'prompt-reconcile'
+        app.db.add_task('reconcile', 'prompt', 'input.png', 480, 832, 81)
+        app.db.update_task_status('reconcile', 'processing', comfyui_prompt_id=self.prompt_id, comfyui_backend=self.backend.name,
+                                  lease_owner=app.INSTANCE_ID, lease_expires_at=time.time() + app.TASK_LEASE_SECONDS)
+        history = {self.prompt_id: {'outputs': {'9': {'gifs': []}}, 'status': {'completed': True}}}
+        self.completions = []
+        self.completing = threading.Event()
+        self.ingesting = threading.Event()
+        patches = [
+            mock.patch.object(self.backend.client, 'get_queue_status', return_value={'queue_running': [], 'queue_pending': []}),
+            mock.patch.object(self.backend.client, 'get_history', return_value=history),
+            mock.patch.object(app, 'complete_task', side_effect=self.slow_complete)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def slow_complete(self, task_id, prompt_id, outputs=None):
+        self.completions.append(task_id)
+        self.completing.set()
+        self.ingesting.wait(5)
+    
+    def test_reconcile_skips_finishing_prompt(self):
+        self.backend.listener.watch(self.prompt_id, 'reconcile')
+        self.backend.listener.handle_event('execution_success', {'prompt_id': self.prompt_id})
+        self.assertTrue(self.completing.wait(5))
+        
+        summary = app.reconcile_processing_tasks()
+        self.ingesting.set()
+        
+        self.assertEqual(summary['completed'], 0)
+        self.assertEqual(self.completions, ['reconcile'])
+
+if __name__ == '__main__':
+    unittest.main()
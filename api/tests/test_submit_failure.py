@@ -0,0 +1,52 @@
+"""提交到 ComfyUI 失敗時，領頭任務的跟隨任務要被釋放，不能永遠停在 pending
+
+需在容器內執行（app 會讀取 /app 下的工作流程模板與目錄）：
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = os.path.join(DATABASE_DIR, 'history.db')
+os.environ.setdefault('COMFYUI_HOST', '127.0.0.1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+class SubmitFailureTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.backend = app.backend_pool.default
+        self.emitted = []
+        patches = [
+            mock.patch.object(app.socketio, 'emit', side_effect=lambda event, data=None, **kwargs: self.emitted.append((event, data))),
+            mock.patch.object(self.backend, 'stage_input', side_effect=lambda filename: filename),
+            # ComfyUI 拒絕 /prompt
+            mock.patch.object(self.backend.client, 'queue_prompt', return_value=None)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def add_task(self, task_id, leader_task_id=None):
+        app.db.add_task(task_id, 'prompt', 'input.png', 480, 832, 81,
+                        request_fingerprint='fingerprint', leader_task_id=leader_task_id)
+    
+    def test_rejected_prompt_releases_follower(self):
+        self.add_task('leader')
+        self.add_task('follower', leader_task_id='leader')
+        
+        self.assertFalse(app.submit_task(app.db.get_task('leader'), self.backend))
+        
+        self.assertEqual(app.db.get_task('leader')['status'], 'failed')
+        follower = app.db.get_task('follower')
+        self.assertEqual(follower['status'], 'pending')
+        self.assertIsNone(follower['leader_task_id'])
+        self.assertIn('follower', [task['task_id'] for task in app.db.get_dispatch_candidates()])
+        self.assertEqual([data['task_id'] for event, data in self.emitted if event == 'task_failed'], ['leader'])
+
+if __name__ == '__main__':
+    unittest.main()
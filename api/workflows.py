@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# 每個模板必須提供的參數；圖片參數名稱同時也是上傳表單的欄位名稱
+REQUIRED_PARAMS = ('prompt', 'width', 'height', 'duration', 'seed', 'filename_prefix')
+IMAGE_PARAMS = ('image', 'first_image', 'last_image')
+# 任務記錄最多保存兩張輸入圖片（image_filename、second_image_filename）
+MAX_IMAGES = 2
+
+class WorkflowTemplateError(Exception):
+    """工作流程模板或參數對應不正確"""
+
+class WorkflowTemplate:
+    """載入時驗證並編譯好的工作流程模板
+    
+    參數對應為「參數名稱 → (節點ID, 輸入名稱)」；render 只複製被修改的節點，
+    其餘節點與模板共用，因此模板本身不可被修改
+    """
+    
+    def __init__(self, name, path, workflow, params, signature):
+        self.name = name
+        self.path = path
+        self.signature = signature
+        # 以修改前的內容計算版本，模板內容不變時舊的快取結果仍可命中
+        self.version = hashlib.sha256(json.dumps(workflow, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.params = self._compile_params(workflow, params)
+        self.image_params = [param for param in IMAGE_PARAMS if param in self.params]
+        self.defaults = {param: workflow[node_id]['inputs'][key] for param, (node_id, key) in self.params.items()}
+        
+        # 確保有輸出節點 - 將輸出檔名前綴所在的節點標記為輸出
+        output_node = self.params['filename_prefix'][0]
+        workflow[output_node].setdefault('_meta', {})['save_output'] = True
+        self.workflow = workflow
+    
+    @staticmethod
+    def _compile_params(workflow, params):
+        """將「節點ID.輸入名稱」解析為路徑並檢查每個路徑都指向模板中的實際數值"""
+        missing = [name for name in REQUIRED_PARAMS if name not in params]
+        if missing:
+            raise WorkflowTemplateError(f"缺少參數對應: {', '.join(missing)}")
+        
+        compiled = {}
+        for name, path in params.items():
+            node_id, _, key = str(path).partition('.')
+            node = workflow.get(node_id)
+            if not isinstance(node, dict) or key not in node.get('inputs', {}):
+                raise WorkflowTemplateError(f"參數 {name} 指向不存在的輸入 {path}")
+            if isinstance(node['inputs'][key], list):
+                # [節點ID, 輸出索引] 是節點間的連線，覆寫會破壞工作流程
+                raise WorkflowTemplateError(f"參數 {name} 指向節點連線 {path}")
+            compiled[name] = (node_id, key)
+        
+        images = [name for name in IMAGE_PARAMS if name in compiled]
+        if not images or len(images) > MAX_IMAGES:
+            raise WorkflowTemplateError(f"模板需要 1 到 {MAX_IMAGES} 個圖片參數（{', '.join(IMAGE_PARAMS)}）")
+        return compiled
+    
+    @classmethod
+    def load(cls, name, path, default_params=None):
+        """讀取模板 JSON；參數對應來自同名的 .params.json，沒有時使用內建對應"""
+        params_path = sidecar_path(path)
+        signature = (file_signature(path), file_signature(params_path))
+        with open(path, 'r', encoding='utf-8') as f:
+            workflow = json.load(f)
+        if signature[1]:
+            with open(params_path, 'r', encoding='utf-8') as f:
+                params = json.load(f)
+        elif default_params:
+            params = default_params
+        else:
+            raise WorkflowTemplateError(f"找不到參數對應檔 {params_path}")
+        if not isinstance(workflow, dict) or not isinstance(params, dict):
+            raise WorkflowTemplateError('模板與參數對應都必須是 JSON 物件')
+        return cls(name, path, workflow, params, signature)
+    
+    def render(self, **values):
+        """以參數值產生要提交的工作流程；值為 None 的參數沿用模板預設"""
+        workflow = dict(self.workflow)
+        copied = set()
+        for name, value in values.items():
+            if value is None:
+                continue
+            node_id, key = self.params[name]
+            if node_id not in copied:
+                node = dict(workflow[node_id])
+                node['inputs'] = dict(node['inputs'])
+                workflow[node_id] = node
+                copied.add(node_id)
+            workflow[node_id]['inputs'][key] = value
+        return workflow
+    
+    def describe(self):
+        """提供給 API 的模板摘要"""
+        return {
+            'name': self.name,
+            'version': self.version,
+            'images': self.image_params,
+            'params': {name: f"{node_id}.{key}" for name, (node_id, key) in self.params.items()}
+        }
+
+def sidecar_path(path):
+    """模板對應的參數對應檔路徑：workflow.json → workflow.params.json"""
+    return f"{os.path.splitext(path)[0]}.params.json"
+
+def file_signature(path):
+    """檔案的 (mtime_ns, size)；不存在時回傳 None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+class WorkflowRegistry:
+    """以生成模式名稱管理工作流程模板，並從目錄熱重載
+    
+    內建模板為 {名稱: (路徑, 參數對應)}；模板目錄中的 {名稱}.json 會覆蓋同名內建模板或新增模式，
+    新模式需附 {名稱}.params.json。檔案變更時重新編譯，編譯失敗則沿用上一個可用版本；
+    啟動時就無法載入的使用者模板略過，覆蓋內建模式的則改用內建模板
+    """
+    
+    def __init__(self, builtin, directory=None, reload_interval=2.0):
+        self.builtin = builtin
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.templates = {}
+        # 載入失敗的 {名稱: (路徑, 檔案簽章)}，檔案未再變更前不重試、不重複記錄錯誤
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._checked = None
+    
+    def _sources(self):
+        """目前應載入的 {名稱: (路徑, 內建參數對應)}"""
+        sources = dict(self.builtin)
+        if self.directory and os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json') and not entry.name.endswith('.params.json'):
+                    name = entry.name[:-len('.json')]
+                    sources[name] = (entry.path, self.builtin.get(name, (None, None))[1])
+        return sources
+    
+    def _load_builtin(self, name, strict):
+        """載入內建模板；strict 時失敗直接拋出，否則記錄錯誤並回傳 None"""
+        path, default_params = self.builtin[name]
+        try:
+            template = WorkflowTemplate.load(name, path, default_params)
+        except (OSError, ValueError, WorkflowTemplateError) as e:
+            if strict:
+                raise
+            print(f"[WORKFLOW] Failed to load builtin '{name}' from {path}: {e}")
+            return None
+        print(f"[WORKFLOW] Loaded '{name}' from {path} (version {template.version})")
+        return template
+    
+    def refresh(self, strict=False):
+        """檢查模板檔案是否變更並重新編譯
+        
+        strict 時（啟動時使用）內建模板載入失敗直接拋出；使用者模板只記錄錯誤，一個壞掉的檔案不會讓整個服務無法啟動
+        """
+        with self._lock:
+            templates = {}
+            for name, (path, default_params) in self._sources().items():
+                current = self.templates.get(name)
+                signature = (file_signature(path), file_signature(sidecar_path(path)))
+                if current and current.path == path and current.signature == signature:
+                    templates[name] = current
+                    continue
+                if self._failed.get(name) == (path, signature):
+                    if current:
+                        templates[name] = current
+                    continue
+                try:
+                    templates[name] = WorkflowTemplate.load(name, path, default_params)
+                    self._failed.pop(name, None)
+                    print(f"[WORKFLOW] Loaded '{name}' from {path} (version {templates[name].version})")
+                except (OSError, ValueError, WorkflowTemplateError) as e:
+                    builtin_path = self.builtin.get(name, (None, None))[0]
+                    if strict and path == builtin_path:
+                        raise
+                    self._failed[name] = (path, signature)
+                    print(f"[WORKFLOW] Failed to load '{name}' from {path}: {e}")
+                    if current:
+                        templates[name] = current
+                    elif builtin_path and path != builtin_path:
+                        # 覆蓋內建模式的使用者模板從一開始就無法載入，改用內建模板
+                        builtin = self._load_builtin(name, strict)
+                        if builtin:
+                            templates[name] = builtin
+            self.templates = templates
+            self._checked = time.monotonic()
+    
+    def _refresh_if_due(self):
+        """距上次檢查超過 reload_interval 時才檢查檔案，不在每次提交都 stat"""
+        checked = self._checked
+        if checked is None or time.monotonic() - checked >= self.reload_interval:
+            self.refresh()
+    
+    def get(self, name):
+        """取得模板，不存在時回傳 None"""
+        self._refresh_if_due()
+        return self.templates.get(name)
+    
+    def all(self):
+        """所有可用模板"""
+        self._refresh_if_due()
+        return list(self.templates.values())